@@ -46,6 +46,10 @@ class DataQuery(pydantic.BaseModel):
     avoid_dstypes_from_collections: Optional[str | list[str]] = None
     """Collections containing dataset types to avoid transferring."""
 
+    priority_weight: float = 1.0
+    """Weight of the time that the selected exposures have been eligible for
+    release, when raw transfers are prioritized across queries."""
+
     @classmethod
     def from_yaml(cls, yaml_source: Any) -> list[Self]:
         result = []
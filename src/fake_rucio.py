@@ -0,0 +1,350 @@
+# This file is part of transfer_embargo
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ["FakeDIDClient", "FakeReplicaClient", "FakeRucio"]
+
+import fnmatch
+import random
+import threading
+import time
+from collections import Counter
+from collections.abc import Generator, Iterable
+from typing import Any, Self
+
+from rucio.common.exception import (  # type: ignore
+    DatabaseException,
+    DataIdentifierAlreadyExists,
+    DataIdentifierNotFound,
+    FileAlreadyExists,
+    UnsupportedOperation,
+)
+
+
+class FakeRucio:
+    """In-process stand-in for a Rucio server.
+
+    It keeps replicas, datasets, attachments, and metadata in memory, and
+    provides `FakeReplicaClient` and `FakeDIDClient` objects with the
+    methods of the real clients that are used here.  Each call can be
+    slowed down and can fail with a `DatabaseException`, so that the
+    throughput and retry cost of registration can be measured offline.
+
+    Parameters
+    ----------
+    latency: `float`
+        Seconds that each call takes, standing in for a round trip.
+    failure_rate: `float`
+        Probability that a call fails with a `DatabaseException` before
+        doing anything.
+    seed: `int`, optional
+        Seed for the failure injection.
+    """
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, seed: int | None = None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.replicas: dict[tuple[str, str], dict[str, Any]] = {}
+        self.datasets: dict[tuple[str, str], dict[str, Any]] = {}
+        self.calls: Counter = Counter()
+        self.failures: Counter = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.replica_client = FakeReplicaClient(self)
+        self.did_client = FakeDIDClient(self)
+
+    @classmethod
+    def from_spec(cls, spec: str) -> Self:
+        """Make a fake from a comma-separated list of key=value settings.
+
+        Parameters
+        ----------
+        spec: `str`
+            Settings, e.g. ``latency=0.05,failure_rate=0.01,seed=1``.  May
+            be empty.
+
+        Returns
+        -------
+        fake: `FakeRucio`
+            The new fake.
+        """
+        kwargs: dict[str, Any] = {}
+        for item in filter(None, spec.split(",")):
+            key, _, value = item.partition("=")
+            if key == "seed":
+                kwargs[key] = int(value)
+            elif key in ("latency", "failure_rate"):
+                kwargs[key] = float(value)
+            else:
+                raise ValueError(f"Unknown fake Rucio setting: {key}")
+        return cls(**kwargs)
+
+    def add_existing_dataset(
+        self, name: str, *, scope: str = "raw", closed: bool = False, files: Iterable[str] = ()
+    ) -> None:
+        """Set up a dataset as if it had been made by an earlier run.
+
+        Parameters
+        ----------
+        name: `str`
+            Name of the dataset.
+        scope: `str`
+            Scope of the dataset.
+        closed: `bool`
+            Whether the dataset has been closed.
+        files: `~collections.abc.Iterable` [ `str` ]
+            Names of the files, in the same scope, already attached.
+        """
+        self.datasets[(scope, name)] = {
+            "open": not closed,
+            "files": {(scope, f) for f in files},
+            "meta": {},
+        }
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """Return the numbers of calls and injected failures by method.
+
+        Returns
+        -------
+        stats: `dict` [ `str`, `dict` [ `str`, `int` ] ]
+            Calls and failures keyed by method name.
+        """
+        with self._lock:
+            return {"calls": dict(self.calls), "failures": dict(self.failures)}
+
+    def call(self, method: str) -> None:
+        """Account for a call, waiting and possibly failing.
+
+        Parameters
+        ----------
+        method: `str`
+            Name of the client method.
+
+        Raises
+        ------
+        rucio.common.exception.DatabaseException
+            Raised at random with the configured failure rate.
+        """
+        with self._lock:
+            self.calls[method] += 1
+            fail = self._random.random() < self.failure_rate
+            if fail:
+                self.failures[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise DatabaseException(f"Injected failure in {method}")
+
+    def dataset(self, scope: str, name: str) -> dict[str, Any]:
+        """Return the state of a dataset.
+
+        Parameters
+        ----------
+        scope: `str`
+            Scope of the dataset.
+        name: `str`
+            Name of the dataset.
+
+        Returns
+        -------
+        state: `dict`
+            Whether the dataset is open, its files, and its metadata.
+
+        Raises
+        ------
+        rucio.common.exception.DataIdentifierNotFound
+            Raised if the dataset does not exist.
+        """
+        try:
+            return self.datasets[(scope, name)]
+        except KeyError:
+            raise DataIdentifierNotFound(f"Data identifier '{scope}:{name}' not found") from None
+
+
+class FakeReplicaClient:
+    """Stand-in for `rucio.client.replicaclient.ReplicaClient`.
+
+    Parameters
+    ----------
+    backend: `FakeRucio`
+        The fake server.
+    """
+
+    def __init__(self, backend: FakeRucio):
+        self.backend = backend
+
+    def add_replica(
+        self,
+        rse: str,
+        scope: str,
+        name: str,
+        bytes_: int,
+        adler32: str,
+        pfn: str | None = None,
+        md5: str | None = None,
+        meta: dict | None = None,
+    ) -> bool:
+        self.backend.call("add_replica")
+        self._add_replicas(
+            rse,
+            [
+                {
+                    "scope": scope,
+                    "name": name,
+                    "bytes": bytes_,
+                    "adler32": adler32,
+                    "md5": md5,
+                    "meta": meta or {},
+                }
+            ],
+        )
+        return True
+
+    def add_replicas(self, rse: str, files: list[dict]) -> bool:
+        self.backend.call("add_replicas")
+        self._add_replicas(rse, files)
+        return True
+
+    def _add_replicas(self, rse: str, files: list[dict]) -> None:
+        with self.backend._lock:
+            for f in files:
+                if (f["scope"], f["name"]) in self.backend.replicas:
+                    raise FileAlreadyExists(f"Replica {f['scope']}:{f['name']} exists")
+            for f in files:
+                self.backend.replicas[(f["scope"], f["name"])] = dict(f, rse=rse)
+
+
+class FakeDIDClient:
+    """Stand-in for `rucio.client.didclient.DIDClient`.
+
+    Parameters
+    ----------
+    backend: `FakeRucio`
+        The fake server.
+    """
+
+    def __init__(self, backend: FakeRucio):
+        self.backend = backend
+
+    def add_dataset(self, scope: str, name: str, **kwargs: Any) -> bool:
+        self.backend.call("add_dataset")
+        self._add_datasets([{"scope": scope, "name": name}])
+        return True
+
+    def add_datasets(self, dsns: list[dict]) -> bool:
+        self.backend.call("add_datasets")
+        self._add_datasets(dsns)
+        return True
+
+    def _add_datasets(self, dsns: list[dict]) -> None:
+        with self.backend._lock:
+            for dsn in dsns:
+                if (dsn["scope"], dsn["name"]) in self.backend.datasets:
+                    raise DataIdentifierAlreadyExists(
+                        f"Data identifier '{dsn['scope']}:{dsn['name']}' already exists"
+                    )
+            for dsn in dsns:
+                self.backend.add_existing_dataset(dsn["name"], scope=dsn["scope"])
+
+    def add_files_to_dataset(
+        self, scope: str, name: str, files: list[dict], rse: str | None = None
+    ) -> bool:
+        self.backend.call("add_files_to_dataset")
+        self._attach([{"scope": scope, "name": name, "dids": files}], False)
+        return True
+
+    def attach_dids_to_dids(self, attachments: list[dict], ignore_duplicate: bool = False) -> bool:
+        self.backend.call("attach_dids_to_dids")
+        self._attach(attachments, ignore_duplicate)
+        return True
+
+    def _attach(self, attachments: list[dict], ignore_duplicate: bool) -> None:
+        with self.backend._lock:
+            # Check everything first, so that a failed call changes nothing
+            for attachment in attachments:
+                dataset = self.backend.dataset(attachment["scope"], attachment["name"])
+                if not dataset["open"]:
+                    raise UnsupportedOperation(
+                        f"Data identifier '{attachment['name']}' is closed"
+                    )
+                for did in attachment["dids"]:
+                    key = (did["scope"], did["name"])
+                    if key not in self.backend.replicas:
+                        raise DataIdentifierNotFound(f"Data identifier '{key}' not found")
+                    if key in dataset["files"] and not ignore_duplicate:
+                        raise FileAlreadyExists(f"File '{key}' already attached")
+            for attachment in attachments:
+                dataset = self.backend.dataset(attachment["scope"], attachment["name"])
+                dataset["files"].update((did["scope"], did["name"]) for did in attachment["dids"])
+
+    def close(self, scope: str, name: str) -> bool:
+        self.backend.call("close")
+        with self.backend._lock:
+            self.backend.dataset(scope, name)["open"] = False
+        return True
+
+    def set_metadata(self, scope: str, name: str, key: str, value: Any, recursive: bool = False) -> bool:
+        self.backend.call("set_metadata")
+        with self.backend._lock:
+            self.backend.dataset(scope, name)["meta"][key] = value
+        return True
+
+    def set_dids_metadata_bulk(self, dids: list[dict], recursive: bool = False) -> bool:
+        self.backend.call("set_dids_metadata_bulk")
+        with self.backend._lock:
+            for did in dids:
+                self.backend.dataset(did["scope"], did["name"])
+            for did in dids:
+                self.backend.dataset(did["scope"], did["name"])["meta"].update(did["meta"])
+        return True
+
+    def get_metadata_bulk(self, dids: list[dict], inherit: bool = False) -> Generator[dict, None, None]:
+        self.backend.call("get_metadata_bulk")
+        with self.backend._lock:
+            metas = [
+                dict(
+                    self.backend.dataset(did["scope"], did["name"])["meta"],
+                    scope=did["scope"],
+                    name=did["name"],
+                    is_open=self.backend.dataset(did["scope"], did["name"])["open"],
+                )
+                for did in dids
+            ]
+        yield from metas
+
+    def list_content(self, scope: str, name: str) -> Generator[dict, None, None]:
+        self.backend.call("list_content")
+        with self.backend._lock:
+            files = sorted(self.backend.dataset(scope, name)["files"])
+        for file_scope, file_name in files:
+            yield {"scope": file_scope, "name": file_name, "type": "FILE"}
+
+    def list_dids(
+        self, scope: str, filters: dict, did_type: str = "collection", **kwargs: Any
+    ) -> Generator[str, None, None]:
+        self.backend.call("list_dids")
+        pattern = filters.get("name", "*")
+        with self.backend._lock:
+            names = [
+                name
+                for dataset_scope, name in self.backend.datasets
+                if dataset_scope == scope and fnmatch.fnmatchcase(name, pattern)
+            ]
+        yield from sorted(names)
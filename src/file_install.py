@@ -0,0 +1,138 @@
+# This file is part of transfer_embargo
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ["install_file"]
+
+import errno
+import fcntl
+import os
+import shutil
+
+FICLONE = 0x40049409
+"""Linux ioctl sharing all the extents of one file with another."""
+
+CHUNK_SIZE = 10 * 1024 * 1024
+
+# Errors meaning that a method is not available for this pair of files,
+# so the next one should be tried
+_UNSUPPORTED = {
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+}
+
+
+def _clone(src_fd: int, dest_fd: int, size: int) -> None:
+    """Share the extents of the source with the destination (reflink)."""
+    fcntl.ioctl(dest_fd, FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd: int, dest_fd: int, size: int) -> None:
+    """Copy within the kernel, letting the filesystem avoid moving data.
+
+    Some filesystems report end of file early instead of failing, so a short
+    copy is treated as unsupported and the next method is tried.
+    """
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(src_fd, dest_fd, size - copied)
+        if n == 0:
+            raise OSError(
+                errno.EOPNOTSUPP,
+                f"copy_file_range stopped after {copied} of {size} bytes",
+            )
+        copied += n
+
+
+def _copy(src_fd: int, dest_fd: int, size: int) -> None:
+    """Copy the bytes through user space."""
+    with open(src_fd, "rb", closefd=False) as src, open(
+        dest_fd, "wb", closefd=False
+    ) as dest:
+        shutil.copyfileobj(src, dest, CHUNK_SIZE)
+    copied = os.fstat(dest_fd).st_size
+    if copied != size:
+        raise OSError(errno.EIO, f"Copied {copied} of {size} bytes")
+
+
+_METHODS = [("reflink", _clone), ("copy_file_range", _copy_file_range), ("copy", _copy)]
+
+
+def install_file(src: str, dest: str) -> str:
+    """Install a local file at a new path without overwriting.
+
+    The cheapest available method is used: a hardlink when both paths are
+    on the same filesystem, then a ``FICLONE`` reflink, then
+    ``copy_file_range``, and only then a copy through user space.
+
+    Parameters
+    ----------
+    src: `str`
+        Path of the file to install.
+    dest: `str`
+        Path to install it at.  Its directory must exist.
+
+    Returns
+    -------
+    method: `str`
+        Name of the method used.
+
+    Raises
+    ------
+    FileExistsError
+        Raised if ``dest`` already exists.
+    """
+    try:
+        os.link(src, dest)
+        return "hardlink"
+    except OSError as e:
+        if isinstance(e, FileExistsError) or e.errno not in _UNSUPPORTED:
+            raise
+
+    size = os.stat(src).st_size
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            for method, func in _METHODS:
+                try:
+                    func(src_fd, dest_fd, size)
+                except OSError as e:
+                    if e.errno not in _UNSUPPORTED or func is _copy:
+                        raise
+                    # Start the next method from an empty file
+                    os.ftruncate(dest_fd, 0)
+                    os.lseek(src_fd, 0, os.SEEK_SET)
+                    os.lseek(dest_fd, 0, os.SEEK_SET)
+                else:
+                    break
+        except BaseException:
+            os.close(dest_fd)
+            os.unlink(dest)
+            raise
+        os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+    return method
@@ -0,0 +1,114 @@
+# This file is part of transfer_embargo
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ["index_headers", "make_index_pool", "read_header"]
+
+import multiprocessing
+from collections.abc import Mapping
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any
+
+from astro_metadata_translator.file_helpers import read_file_info
+from astro_metadata_translator.indexing import calculate_index
+
+
+def read_header(location: str) -> dict[str, Any] | None:
+    """Read and simplify the metadata header of one raw file.
+
+    Only the header blocks are read: the primary header, merged with the
+    first extension header when the primary one is incomplete.  The pixel
+    data are never loaded.
+
+    Parameters
+    ----------
+    location: `str`
+        Local path or URI of the file.
+
+    Returns
+    -------
+    simple: `dict` or `None`
+        Simplified metadata, or `None` if the header could not be read.
+    """
+    return read_file_info(location, -1, False, "metadata", "simple")
+
+
+def make_index_pool(jobs: int) -> ProcessPoolExecutor:
+    """Make a process pool for reading headers.
+
+    Header translation is CPU-bound Python, so it is spread over processes
+    rather than threads.  The workers are started from a fork server, which
+    is safe even though the parent holds threads and database connections.
+
+    Parameters
+    ----------
+    jobs: `int`
+        Number of worker processes.
+
+    Returns
+    -------
+    pool: `concurrent.futures.ProcessPoolExecutor`
+        The pool.
+    """
+    return ProcessPoolExecutor(
+        max_workers=jobs, mp_context=multiprocessing.get_context("forkserver")
+    )
+
+
+def index_headers(
+    locations: Mapping[str, str], executor: Executor | None = None
+) -> tuple[dict, list[str], list[str]]:
+    """Build ``_metadata_index.json`` content from the headers of raw files.
+
+    Parameters
+    ----------
+    locations: `~collections.abc.Mapping` [ `str`, `str` ]
+        Local paths or URIs of the files keyed by their names in the index.
+    executor: `concurrent.futures.Executor`, optional
+        Executor to read the headers with.  If not given, they are read
+        serially.
+
+    Returns
+    -------
+    index: `dict`
+        Index keyed by name, as produced by
+        `astro_metadata_translator.indexing.index_files`.
+    okay: `list` [ `str` ]
+        Names of the files that were indexed.
+    failed: `list` [ `str` ]
+        Names of the files whose headers could not be read.
+    """
+    names = sorted(locations)
+    if executor is None:
+        headers = map(read_header, (locations[name] for name in names))
+    else:
+        headers = executor.map(
+            read_header, [locations[name] for name in names], chunksize=8
+        )
+    content_by_file = {}
+    okay = []
+    failed = []
+    for name, simple in zip(names, headers):
+        if simple is None:
+            failed.append(name)
+        else:
+            okay.append(name)
+            content_by_file[name] = simple
+    return calculate_index(content_by_file, "metadata"), okay, failed
@@ -0,0 +1,149 @@
+# This file is part of transfer_embargo
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ["Pipeline", "Stage"]
+
+import dataclasses
+import logging
+import queue
+import threading
+from collections.abc import Callable, Iterable
+from typing import Any
+
+_DONE = object()
+"""Queue entry telling a worker that its stage has no more input."""
+
+
+@dataclasses.dataclass
+class Stage:
+    """A step of a `Pipeline`."""
+
+    name: str
+    """Name of the stage, used to name its worker threads."""
+
+    func: Callable[[Any], Any]
+    """Function applied to each item.  It returns the item to pass on to
+    the next stage, or `None` if the item needs no further processing."""
+
+    jobs: int = 1
+    """Number of worker threads for the stage."""
+
+
+class Pipeline:
+    """Run items through a sequence of stages concurrently.
+
+    Each stage has its own worker threads, and consecutive stages are
+    connected by bounded queues, so that a slow stage holds back the ones
+    before it rather than letting work pile up.  While one item is in a
+    later stage, the next can be in an earlier one.
+
+    If a stage fails, no new items are started, but items that have
+    already passed the first stage are still carried through the rest, so
+    that no item is left half-processed.  The first exception is then
+    raised by `run`.
+
+    Parameters
+    ----------
+    stages: `list` [ `Stage` ]
+        The stages, in order.
+    queue_size: `int`
+        Maximum number of items waiting between two stages.
+    logger: `logging.Logger`
+        Logger for reporting failures.
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int, logger: logging.Logger):
+        self._stages = stages
+        self._queues: list[queue.Queue] = [
+            queue.Queue(maxsize=queue_size) for _ in stages
+        ]
+        self._logger = logger
+        self._failed = threading.Event()
+        self._error: BaseException | None = None
+        self._lock = threading.Lock()
+
+    def _work(self, index: int) -> None:
+        """Process the items of one stage until it has no more input.
+
+        Parameters
+        ----------
+        index: `int`
+            Index of the stage.
+        """
+        stage = self._stages[index]
+        inbox = self._queues[index]
+        outbox = self._queues[index + 1] if index + 1 < len(self._stages) else None
+        while (item := inbox.get()) is not _DONE:
+            # After a failure, drain the first stage without starting work
+            if index == 0 and self._failed.is_set():
+                continue
+            try:
+                result = stage.func(item)
+            except BaseException as e:
+                self._logger.exception("Stage %s failed on %s", stage.name, item)
+                with self._lock:
+                    if self._error is None:
+                        self._error = e
+                self._failed.set()
+                continue
+            if result is not None and outbox is not None:
+                outbox.put(result)
+
+    def run(self, items: Iterable[Any]) -> None:
+        """Run items through all the stages and wait for them to finish.
+
+        Parameters
+        ----------
+        items: `~collections.abc.Iterable`
+            Items for the first stage.
+
+        Raises
+        ------
+        Exception
+            The first exception raised by any stage.
+        """
+        threads = []
+        for index, stage in enumerate(self._stages):
+            threads.append(
+                [
+                    threading.Thread(
+                        target=self._work, args=(index,), name=f"{stage.name}_{i}"
+                    )
+                    for i in range(stage.jobs)
+                ]
+            )
+        for stage_threads in threads:
+            for thread in stage_threads:
+                thread.start()
+
+        for item in items:
+            if self._failed.is_set():
+                break
+            self._queues[0].put(item)
+        # Each stage finishes once the one before it has finished
+        for index, stage_threads in enumerate(threads):
+            for _ in stage_threads:
+                self._queues[index].put(_DONE)
+            for thread in stage_threads:
+                thread.join()
+
+        if self._error is not None:
+            raise self._error
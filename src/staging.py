@@ -0,0 +1,187 @@
+# This file is part of transfer_embargo
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ["StagingManager"]
+
+import contextlib
+import dataclasses
+import logging
+import tempfile
+import threading
+import time
+from collections.abc import Generator
+from typing import Any
+
+
+@dataclasses.dataclass
+class _Tier:
+    """A staging directory and its byte budget."""
+
+    name: str
+    """Name of the tier, for logging."""
+
+    directory: str | None
+    """Directory holding the staging directories, or `None` for the default
+    temporary directory."""
+
+    budget: int | None
+    """Maximum bytes reserved at once, or `None` for no limit."""
+
+    used: int = 0
+    """Bytes currently reserved."""
+
+    peak: int = 0
+    """Most bytes reserved at once."""
+
+    def fits(self, nbytes: int) -> bool:
+        return self.budget is None or self.used + nbytes <= self.budget
+
+
+class StagingManager:
+    """Hand out staging directories within a byte budget.
+
+    Each user reserves the space it expects to need before writing
+    anything, and waits if that would exceed the budget, so concurrent
+    workers cannot together fill the disk.  A reservation larger than the
+    whole budget is granted when nothing else is reserved, so that it
+    cannot wait forever.
+
+    An optional fast tier, such as a tmpfs, with its own budget is used
+    for any reservation that fits in its remaining space; reservations
+    that do not fit fall back to the main tier rather than waiting.
+
+    Parameters
+    ----------
+    budget: `int`, optional
+        Maximum bytes reserved at once in the main tier.  No limit if not
+        given.
+    directory: `str`, optional
+        Directory for the main tier; the default temporary directory if
+        not given.
+    fast_directory: `str`, optional
+        Directory for the fast tier.  No fast tier if not given.
+    fast_budget: `int`
+        Maximum bytes reserved at once in the fast tier.
+    logger: `logging.Logger`, optional
+        Logger for waits.
+    """
+
+    def __init__(
+        self,
+        budget: int | None = None,
+        directory: str | None = None,
+        fast_directory: str | None = None,
+        fast_budget: int = 0,
+        logger: logging.Logger | None = None,
+    ):
+        self._main = _Tier("main", directory, budget)
+        self._fast = (
+            _Tier("fast", fast_directory, fast_budget) if fast_directory is not None else None
+        )
+        self._logger = logger or logging.getLogger(__name__)
+        self._condition = threading.Condition()
+        self._waits = 0
+        self._wait_seconds = 0.0
+
+    @property
+    def budgeted(self) -> bool:
+        """Whether reservations need to know their size (`bool`)."""
+        return self._main.budget is not None or self._fast is not None
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes: int) -> Generator[str, None, None]:
+        """Reserve space and make a staging directory.
+
+        The directory and everything in it are removed, and the space is
+        released, on exit.
+
+        Parameters
+        ----------
+        nbytes: `int`
+            Bytes that will be written in the directory.
+
+        Yields
+        ------
+        path: `str`
+            Path of the staging directory.
+        """
+        tier = self._acquire(nbytes)
+        try:
+            with tempfile.TemporaryDirectory(dir=tier.directory) as tmpdir:
+                yield tmpdir
+        finally:
+            with self._condition:
+                tier.used -= nbytes
+                self._condition.notify_all()
+
+    def _acquire(self, nbytes: int) -> _Tier:
+        """Reserve space in the fast tier if possible, else the main one.
+
+        Parameters
+        ----------
+        nbytes: `int`
+            Bytes to reserve.
+
+        Returns
+        -------
+        tier: `_Tier`
+            The tier in which the space was reserved.
+        """
+        with self._condition:
+            if self._fast is not None and self._fast.fits(nbytes):
+                tier = self._fast
+            else:
+                tier = self._main
+                start = time.monotonic()
+                waited = False
+                while not tier.fits(nbytes) and tier.used > 0:
+                    if not waited:
+                        self._logger.info(
+                            "Waiting for %d bytes of staging space (%d of %d in use)",
+                            nbytes,
+                            tier.used,
+                            tier.budget,
+                        )
+                        waited = True
+                    self._condition.wait()
+                if waited:
+                    self._waits += 1
+                    self._wait_seconds += time.monotonic() - start
+            tier.used += nbytes
+            tier.peak = max(tier.peak, tier.used)
+            return tier
+
+    def stats(self) -> dict[str, Any]:
+        """Return the peak usage of each tier and the time spent waiting.
+
+        Returns
+        -------
+        stats: `dict` [ `str`, `~typing.Any` ]
+            Peak bytes reserved in each tier, number of waits, and seconds
+            spent waiting.
+        """
+        with self._condition:
+            tiers = [self._main] if self._fast is None else [self._main, self._fast]
+            return {
+                "peak": {tier.name: tier.peak for tier in tiers},
+                "waits": self._waits,
+                "wait_seconds": self._wait_seconds,
+            }
@@ -0,0 +1,334 @@
+"""Offline benchmark of transfer_raw_zip.py.
+
+A synthetic source repo is made from the test repo in tests/data, with
+the requested number of exposures, SCIENCE and GUIDER detectors, and file
+size, plus an expectedSensors file for each exposure.  The transfer then
+runs in-process against a local destination repo, registering in an
+in-process fake Rucio, and the per-stage timings are reported as JSON so
+that runs can be compared.
+
+Example::
+
+    python benchmark_raw_zip.py --exposures 4 --detectors 189 --guiders 8 \
+        --file_size 18 --output baseline.json -- --jobs 4 --pipeline
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+from lsst.daf.butler import Butler, CollectionType, DatasetRef, DatasetType, FileDataset
+from lsst.pipe.base.script import register_instrument
+
+SRC_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(SRC_DIR))
+
+import transfer_raw_zip  # noqa: E402
+from data_query import DataQuery  # noqa: E402
+
+TEMPLATE_REPO = SRC_DIR.parent / "tests" / "data" / "from_butler"
+TEMPLATE_EXPOSURE = "MC_O_20250415_000052"
+INSTRUMENT = "LSSTCam"
+FIRST_SEQ_NUM = 1000
+
+
+def parse_args():
+    """Parses and returns command-line arguments.
+
+    Returns
+    -------
+    ns : argparse.Namespace
+        An object containing the parsed command-line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark transfer_raw_zip.py on a synthetic repo."
+    )
+    parser.add_argument(
+        "--exposures", type=int, default=2, help="Number of exposures (default=2)."
+    )
+    parser.add_argument(
+        "--detectors",
+        type=int,
+        default=9,
+        help="Number of SCIENCE detectors per exposure (default=9).",
+    )
+    parser.add_argument(
+        "--guiders",
+        type=int,
+        default=2,
+        help="Number of GUIDER detectors per exposure (default=2).",
+    )
+    parser.add_argument(
+        "--file_size",
+        type=float,
+        default=1.0,
+        help="Size of each SCIENCE file in MB (default=1).",
+    )
+    parser.add_argument(
+        "--guider_size",
+        type=float,
+        default=0.1,
+        help="Size of each GUIDER file in MB (default=0.1).",
+    )
+    parser.add_argument(
+        "--rucio_latency",
+        type=float,
+        default=0.0,
+        help="Seconds that each fake Rucio call takes (default=0).",
+    )
+    parser.add_argument(
+        "--rucio_failure_rate",
+        type=float,
+        default=0.0,
+        help="Probability that a fake Rucio call fails with a database error (default=0).",
+    )
+    parser.add_argument(
+        "--workdir",
+        type=str,
+        required=False,
+        help="Directory for the repos, kept afterwards (default: a temporary one).",
+    )
+    parser.add_argument(
+        "--output", type=str, required=False, help="Path to write the results as JSON."
+    )
+    parser.add_argument(
+        "options",
+        nargs="*",
+        help="Extra transfer_raw_zip.py options, after '--'.",
+    )
+    return parser.parse_args()
+
+
+def write_fits(path: Path, header: bytes, size: int, block: bytes) -> None:
+    """Write a FITS file of about the given size with a real header.
+
+    Parameters
+    ----------
+    path: `pathlib.Path`
+        Path of the file.
+    header: `bytes`
+        Header blocks to start the file with.
+    size: `int`
+        Approximate size in bytes; rounded up to whole FITS blocks.
+    block: `bytes`
+        Data repeated to fill the file.
+    """
+    remaining = max(0, -(-(size - len(header)) // 2880) * 2880)
+    with open(path, "wb") as f:
+        f.write(header)
+        while remaining > 0:
+            n = min(remaining, len(block))
+            f.write(block[:n])
+            remaining -= n
+
+
+def make_source_repo(root: Path, ns: argparse.Namespace) -> list[str]:
+    """Make a synthetic source repo from the test repo.
+
+    Parameters
+    ----------
+    root: `pathlib.Path`
+        Directory of the new repo.
+    ns: `argparse.Namespace`
+        Benchmark parameters.
+
+    Returns
+    -------
+    obs_ids: `list` [ `str` ]
+        Observation ids of the synthetic exposures.
+    """
+    shutil.copytree(TEMPLATE_REPO, root)
+    butler = Butler(root, writeable=True)
+    template = butler.query_dimension_records(
+        "exposure", instrument=INSTRUMENT, where=f"exposure.obs_id = '{TEMPLATE_EXPOSURE}'"
+    )[0]
+    header_path = next(
+        (root / INSTRUMENT).rglob(f"raw_*_{TEMPLATE_EXPOSURE}_R22_S11_*.fits")
+    )
+    header = header_path.read_bytes()
+
+    detectors = butler.query_dimension_records("detector", instrument=INSTRUMENT)
+    science = [d for d in detectors if d.purpose == "SCIENCE"][: ns.detectors]
+    guiders = [d for d in detectors if d.purpose == "GUIDER"][: ns.guiders]
+
+    raw_type = butler.get_dataset_type("raw")
+    guider_type = DatasetType(
+        "guider_raw",
+        ["exposure", "instrument", "detector"],
+        "Exposure",
+        universe=butler.dimensions,
+    )
+    butler.registry.registerDatasetType(guider_type)
+    butler.registry.registerCollection(f"{INSTRUMENT}/raw/guider", CollectionType.RUN)
+
+    block = os.urandom(1024 * 1024)
+    obs_ids = []
+    day_obs = template.day_obs
+    for i in range(ns.exposures):
+        seq_num = FIRST_SEQ_NUM + i
+        obs_id = f"MC_O_{day_obs}_{seq_num:06d}"
+        record = template.toDict()
+        record["id"] = day_obs * 100000 + seq_num
+        record["seq_num"] = seq_num
+        record["obs_id"] = obs_id
+        record["timespan"] = template.timespan
+        butler.registry.insertDimensionData("exposure", record)
+
+        exposure_dir = root / "synthetic" / obs_id
+        exposure_dir.mkdir(parents=True)
+        datasets = []
+        expected = {}
+        for dataset_type, run, chosen, size in (
+            (raw_type, f"{INSTRUMENT}/raw/all", science, ns.file_size),
+            (guider_type, f"{INSTRUMENT}/raw/guider", guiders, ns.guider_size),
+        ):
+            for detector in chosen:
+                path = exposure_dir / f"{dataset_type.name}_{obs_id}_{detector.full_name}.fits"
+                write_fits(path, header, int(size * 1e6), block)
+                data_id = butler.registry.expandDataId(
+                    instrument=INSTRUMENT, exposure=record["id"], detector=detector.id
+                )
+                datasets.append(
+                    (run, FileDataset(path=str(path), refs=[DatasetRef(dataset_type, data_id, run)]))
+                )
+                expected[detector.full_name] = detector.purpose
+        for run in {run for run, _ in datasets}:
+            butler.ingest(
+                *[dataset for r, dataset in datasets if r == run], transfer="direct"
+            )
+        with open(exposure_dir / f"{obs_id}_expectedSensors.json", "w") as f:
+            json.dump({"expectedSensors": expected}, f)
+        obs_ids.append(obs_id)
+    return obs_ids
+
+
+def make_dest_repo(root: Path) -> None:
+    """Make an empty destination repo for the raws.
+
+    Parameters
+    ----------
+    root: `pathlib.Path`
+        Directory of the new repo.
+    """
+    Butler.makeRepo(root)
+    butler = Butler(root, writeable=True)
+    register_instrument(str(root), ["lsst.obs.lsst.LsstCam"])
+    for name in ("raw", "guider_raw"):
+        butler.registry.registerDatasetType(
+            DatasetType(
+                name,
+                ["exposure", "instrument", "detector"],
+                "Exposure",
+                universe=butler.dimensions,
+            )
+        )
+
+
+def run_benchmark(workdir: Path, ns: argparse.Namespace) -> dict[str, Any]:
+    """Make the repos, run the transfer, and summarize the timings.
+
+    Parameters
+    ----------
+    workdir: `pathlib.Path`
+        Directory for the repos.
+    ns: `argparse.Namespace`
+        Benchmark parameters.
+
+    Returns
+    -------
+    results: `dict`
+        Parameters, per-stage totals, and overall throughput.
+    """
+    make_source_repo(workdir / "source", ns)
+    make_dest_repo(workdir / "dest")
+
+    sys.argv = [
+        "transfer_raw_zip.py",
+        "--now",
+        "2025-04-16T12:00",
+        "--dest_uri_prefix",
+        str(workdir / "raw"),
+        "--config_file",
+        os.devnull,
+        *ns.options,
+        str(workdir / "source"),
+        str(workdir / "dest"),
+    ]
+    sys.argv[1:1] = [
+        "--rucio_rse",
+        "BENCHMARK",
+        "--scope",
+        "raw",
+        "--fake_rucio",
+        f"latency={ns.rucio_latency},failure_rate={ns.rucio_failure_rate},seed=1",
+    ]
+    transfer_raw_zip.initialize()
+    query = DataQuery(
+        instrument=INSTRUMENT,
+        collections=f"{INSTRUMENT}/raw/all",
+        dataset_types="raw",
+        where=f"exposure.seq_num >= {FIRST_SEQ_NUM}",
+        embargo_hours=0,
+    )
+
+    start = time.monotonic()
+    transfer_raw_zip.transfer_all([query])
+    elapsed = time.monotonic() - start
+
+    summary = transfer_raw_zip.metrics.summary()
+    zipped = summary["stages"].get("zip", {}).get("bytes", 0)
+    return {
+        "parameters": {
+            "exposures": ns.exposures,
+            "detectors": ns.detectors,
+            "guiders": ns.guiders,
+            "file_size": ns.file_size,
+            "guider_size": ns.guider_size,
+            "rucio_latency": ns.rucio_latency,
+            "rucio_failure_rate": ns.rucio_failure_rate,
+            "options": ns.options,
+        },
+        "seconds": elapsed,
+        "bytes_zipped": zipped,
+        "bytes_per_second": zipped / elapsed if elapsed > 0 else 0.0,
+        "exposures_per_second": ns.exposures / elapsed if elapsed > 0 else 0.0,
+        "stages": summary["stages"],
+        "rucio": transfer_raw_zip.rucio_interface.did_client.backend.stats(),
+    }
+
+
+def main():
+    """Main function."""
+    ns = parse_args()
+    if ns.workdir:
+        workdir = Path(ns.workdir)
+        workdir.mkdir(parents=True)
+        results = run_benchmark(workdir, ns)
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            results = run_benchmark(Path(tmpdir), ns)
+
+    print(f"{'stage':<16}{'count':>8}{'seconds':>12}{'MB/s':>12}")
+    for stage, totals in results["stages"].items():
+        print(
+            f"{stage:<16}{totals['count']:>8}{totals['seconds']:>12.2f}"
+            f"{totals['bytes_per_second'] / 1e6:>12.1f}"
+        )
+    print(
+        f"total: {results['seconds']:.2f} s,"
+        f" {results['bytes_per_second'] / 1e6:.1f} MB/s,"
+        f" {results['exposures_per_second']:.2f} exposures/s"
+    )
+    if ns.output:
+        with open(ns.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# This file is part of transfer_embargo
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ["TransferLedger"]
+
+import datetime
+import itertools
+import sqlite3
+import threading
+from collections.abc import Iterable
+
+
+class TransferLedger:
+    """Persistent record of the completed steps of each exposure's transfer.
+
+    The ledger is a SQLite database with one row per completed step, so
+    that later runs can skip finished exposures without contacting the
+    Butlers, the destination filesystem, or Rucio, and repairs can redo only
+    the steps that are missing.  It also holds a high-water mark for each
+    data query, so that incremental runs only need to query new exposures.
+
+    Parameters
+    ----------
+    path: `str`
+        Path to the SQLite database file.  It is created if necessary.
+    """
+
+    ZIP_WRITTEN = "zip_written"
+    """The zip has been installed at its destination."""
+
+    DIMENSIONS_WRITTEN = "dimensions_written"
+    """The exported dimensions YAML has been written next to the zip."""
+
+    MEMBERS_WRITTEN = "members_written"
+    """The member index JSON has been written next to the zip."""
+
+    RUCIO_REGISTERED = "rucio_registered"
+    """The zip, dimensions, and any member index files have been registered
+    in Rucio."""
+
+    OBS_CLOSED = "obs_closed"
+    """The Obs Rucio dataset of the exposure has been closed."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        with self._lock:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS steps ("
+                " instrument TEXT NOT NULL,"
+                " obs_id TEXT NOT NULL,"
+                " step TEXT NOT NULL,"
+                " completed TEXT NOT NULL,"
+                " PRIMARY KEY (instrument, obs_id, step))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks ("
+                " query TEXT NOT NULL PRIMARY KEY,"
+                " mark TEXT NOT NULL,"
+                " updated TEXT NOT NULL)"
+            )
+
+    @staticmethod
+    def ingested(repo: str) -> str:
+        """Return the step name for ingestion into a destination repo.
+
+        Parameters
+        ----------
+        repo: `str`
+            Destination Butler repository, as given on the command line.
+
+        Returns
+        -------
+        step: `str`
+            Name of the step.
+        """
+        return f"ingested:{repo}"
+
+    def record(self, instrument: str, obs_id: str, step: str) -> None:
+        """Record that a step has been completed for an exposure.
+
+        Parameters
+        ----------
+        instrument: `str`
+            Name of the instrument.
+        obs_id: `str`
+            Observation id of the exposure.
+        step: `str`
+            Name of the step.
+        """
+        completed = datetime.datetime.now(datetime.UTC).isoformat()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?)",
+                (instrument, obs_id, step, completed),
+            )
+
+    def completed(self, instrument: str, obs_id: str) -> set[str]:
+        """Return the steps completed for an exposure.
+
+        Parameters
+        ----------
+        instrument: `str`
+            Name of the instrument.
+        obs_id: `str`
+            Observation id of the exposure.
+
+        Returns
+        -------
+        steps: `set` [ `str` ]
+            Names of the completed steps.
+        """
+        return self.completed_many(instrument, [obs_id]).get(obs_id, set())
+
+    def completed_many(
+        self, instrument: str, obs_ids: Iterable[str]
+    ) -> dict[str, set[str]]:
+        """Return the steps completed for many exposures.
+
+        Parameters
+        ----------
+        instrument: `str`
+            Name of the instrument.
+        obs_ids: `~collections.abc.Iterable` [ `str` ]
+            Observation ids of the exposures.
+
+        Returns
+        -------
+        steps: `dict` [ `str`, `set` [ `str` ] ]
+            Names of the completed steps keyed by observation id.  Exposures
+            without any completed steps are omitted.
+        """
+        result: dict[str, set[str]] = {}
+        iterator = iter(obs_ids)
+        with self._lock:
+            while batch := list(itertools.islice(iterator, 500)):
+                rows = self._connection.execute(
+                    "SELECT obs_id, step FROM steps WHERE instrument = ?"
+                    f" AND obs_id IN ({', '.join('?' * len(batch))})",
+                    (instrument, *batch),
+                )
+                for obs_id, step in rows:
+                    result.setdefault(obs_id, set()).add(step)
+        return result
+
+    def watermark(self, query: str) -> str | None:
+        """Return the high-water mark of a data query.
+
+        Parameters
+        ----------
+        query: `str`
+            Key identifying the data query.
+
+        Returns
+        -------
+        mark: `str` or `None`
+            The mark, or `None` if none has been recorded.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT mark FROM watermarks WHERE query = ?", (query,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_watermark(self, query: str, mark: str) -> None:
+        """Record the high-water mark of a data query.
+
+        Parameters
+        ----------
+        query: `str`
+            Key identifying the data query.
+        mark: `str`
+            The new mark.
+        """
+        updated = datetime.datetime.now(datetime.UTC).isoformat()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)",
+                (query, mark, updated),
+            )
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._lock:
+            self._connection.close()
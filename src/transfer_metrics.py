@@ -0,0 +1,233 @@
+# This file is part of transfer_embargo
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ["StageTimer", "TransferMetrics"]
+
+import contextlib
+import dataclasses
+import json
+import os
+import tempfile
+import threading
+import time
+from collections.abc import Generator
+from typing import Any
+
+
+@dataclasses.dataclass
+class StageTimer:
+    """Measurement of one stage of one exposure, filled in while it runs."""
+
+    nbytes: int = 0
+    """Bytes moved by the stage, if known."""
+
+
+class TransferMetrics:
+    """Wall time and bytes moved by each stage of each exposure.
+
+    The measurements can be written as a Prometheus textfile, for the node
+    exporter's textfile collector, and as a JSON run summary.  The
+    Prometheus counters are cumulative over the life of the object, while
+    the summary only covers the current run.
+
+    Parameters
+    ----------
+    prefix: `str`
+        Prefix of the Prometheus metric names.
+    """
+
+    def __init__(self, prefix: str = "transfer_raw_zip"):
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._totals: dict[str, list] = {}
+        self.start_run()
+
+    def start_run(self) -> None:
+        """Start a new run, for the summary."""
+        with self._lock:
+            self._start = time.time()
+            self._records: list[dict[str, Any]] = []
+            self._run_totals: dict[str, list] = {}
+
+    @contextlib.contextmanager
+    def stage(self, stage: str, obs_id: str) -> Generator[StageTimer, None, None]:
+        """Time a stage of an exposure.
+
+        The stage is recorded whether it succeeds or not.
+
+        Parameters
+        ----------
+        stage: `str`
+            Name of the stage.
+        obs_id: `str`
+            Observation id of the exposure, or a label for stages that
+            handle many exposures at once.
+
+        Yields
+        ------
+        timer: `StageTimer`
+            Object whose ``nbytes`` the stage may set.
+        """
+        timer = StageTimer()
+        start = time.monotonic()
+        try:
+            yield timer
+        finally:
+            self.record(stage, obs_id, time.monotonic() - start, timer.nbytes)
+
+    def record(self, stage: str, obs_id: str, seconds: float, nbytes: int = 0) -> None:
+        """Record a measurement of a stage of an exposure.
+
+        Parameters
+        ----------
+        stage: `str`
+            Name of the stage.
+        obs_id: `str`
+            Observation id of the exposure.
+        seconds: `float`
+            Wall time of the stage.
+        nbytes: `int`
+            Bytes moved by the stage.
+        """
+        with self._lock:
+            self._records.append(
+                {"stage": stage, "obs_id": obs_id, "seconds": seconds, "bytes": nbytes}
+            )
+            for all_totals in (self._totals, self._run_totals):
+                totals = all_totals.setdefault(stage, [0, 0.0, 0])
+                totals[0] += 1
+                totals[1] += seconds
+                totals[2] += nbytes
+
+    @staticmethod
+    def _stage_totals(all_totals: dict[str, list]) -> dict[str, dict[str, Any]]:
+        """Format stage totals, adding their throughput.
+
+        Parameters
+        ----------
+        all_totals: `dict` [ `str`, `list` ]
+            [count, seconds, bytes] keyed by stage.
+
+        Returns
+        -------
+        stages: `dict` [ `str`, `dict` ]
+            Totals keyed by stage.
+        """
+        return {
+            stage: {
+                "count": count,
+                "seconds": seconds,
+                "bytes": nbytes,
+                "bytes_per_second": nbytes / seconds if seconds > 0 else 0.0,
+            }
+            for stage, (count, seconds, nbytes) in sorted(all_totals.items())
+        }
+
+    def summary(self) -> dict[str, Any]:
+        """Return a summary of the measurements of the current run.
+
+        Returns
+        -------
+        summary: `dict`
+            Totals and throughput for each stage, and each measurement.
+        """
+        with self._lock:
+            return {
+                "start": self._start,
+                "end": time.time(),
+                "stages": self._stage_totals(self._run_totals),
+                "exposures": list(self._records),
+            }
+
+    def prometheus(self) -> str:
+        """Return the stage totals in the Prometheus text format.
+
+        Returns
+        -------
+        text: `str`
+            The metrics.
+        """
+        with self._lock:
+            stages = self._stage_totals(self._totals)
+        p = self._prefix
+        lines = []
+        for name, key, kind, text in (
+            ("stage_runs_total", "count", "counter", "Number of times each stage ran."),
+            ("stage_seconds_total", "seconds", "counter", "Wall time spent in each stage."),
+            ("stage_bytes_total", "bytes", "counter", "Bytes moved by each stage."),
+            (
+                "stage_bytes_per_second",
+                "bytes_per_second",
+                "gauge",
+                "Average throughput of each stage.",
+            ),
+        ):
+            lines.append(f"# HELP {p}_{name} {text}")
+            lines.append(f"# TYPE {p}_{name} {kind}")
+            for stage, totals in stages.items():
+                lines.append(f'{p}_{name}{{stage="{stage}"}} {totals[key]}')
+        lines.append(f"# HELP {p}_last_update_timestamp_seconds Time of the last update.")
+        lines.append(f"# TYPE {p}_last_update_timestamp_seconds gauge")
+        lines.append(f"{p}_last_update_timestamp_seconds {time.time()}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _write_atomic(path: str, text: str) -> None:
+        """Replace a file atomically, so readers never see part of it.
+
+        Parameters
+        ----------
+        path: `str`
+            Path of the file.
+        text: `str`
+            New contents.
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), prefix=".", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(text)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def write_prometheus(self, path: str) -> None:
+        """Write the stage totals as a Prometheus textfile.
+
+        Parameters
+        ----------
+        path: `str`
+            Path of the file, which should end in ``.prom``.
+        """
+        self._write_atomic(path, self.prometheus())
+
+    def write_json(self, path: str) -> None:
+        """Write the run summary as JSON.
+
+        Parameters
+        ----------
+        path: `str`
+            Path of the file.
+        """
+        self._write_atomic(path, json.dumps(self.summary(), indent=2) + "\n")
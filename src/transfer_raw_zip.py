@@ -21,20 +21,38 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import dataclasses
+import fnmatch
+import functools
 import hashlib
+import itertools
 import json
 import logging
 import os
 import random
-import tempfile
+import secrets
+import signal
+import threading
 import time
-import zipfile
 import zlib
+from collections.abc import Callable, Generator
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from typing import Any
 
 import rucio.common.exception  # type: ignore
-from astro_metadata_translator.indexing import index_files
 from astropy.time import Time, TimeDelta  # type: ignore
-from lsst.daf.butler import Butler, DimensionRecord, Timespan, _exceptions
+from lsst.daf.butler import (
+    Butler,
+    DatasetRef,
+    DimensionRecord,
+    Timespan,
+    _exceptions,
+)
 from lsst.daf.butler.cli.cliLog import CliLog
 from lsst.resources import ResourcePath
 from lsst.utils.timer import time_this
@@ -42,6 +60,133 @@ from rucio.client.didclient import DIDClient  # type: ignore
 from rucio.client.replicaclient import ReplicaClient  # type: ignore
 
 from data_query import DataQuery
+from file_install import install_file
+from header_index import index_headers, make_index_pool
+from pipeline import Pipeline, Stage
+from staging import StagingManager
+from transfer_ledger import TransferLedger
+from transfer_metrics import TransferMetrics
+from zip_builder import ALIGNMENT, HashingWriter, ZipBuilder, read_member_index
+
+
+@dataclasses.dataclass
+class ExposureInfo:
+    """Registry information about an exposure, looked up in bulk."""
+
+    tracts: set[int]
+    """Tracts that the exposure overlaps (empty if not on-sky)."""
+
+    science_refs: list[DatasetRef]
+    """SCIENCE (``raw``) datasets of the exposure."""
+
+    guider_refs: list[DatasetRef]
+    """GUIDER (``guider_raw``) datasets of the exposure."""
+
+    dimension_records: dict[str, list[DimensionRecord]]
+    """Records related to the exposure for each of `EXPORTED_ELEMENTS`."""
+
+
+@dataclasses.dataclass
+class ExposureJob:
+    """State of an exposure passed between the processing stages."""
+
+    exp: DimensionRecord
+    """The exposure."""
+
+    instrument: str
+    """Name of the instrument."""
+
+    info: ExposureInfo
+    """Registry information about the exposure."""
+
+    refs: list[DatasetRef]
+    """The raw datasets of the exposure."""
+
+    dest_path: ResourcePath
+    """The installed zip file."""
+
+    steps: set[str]
+    """Steps completed before processing started, according to the
+    ledger."""
+
+    need_rucio: bool
+    """Whether Rucio registration is still needed."""
+
+    hashes: tuple[int, str, str] | None
+    """Length, MD5, and Adler32 hashes of the zip, if needed for Rucio."""
+
+    dim_hashes: tuple[int, str, str] | None
+    """Length, MD5, and Adler32 hashes of the dimensions file, if needed
+    for Rucio."""
+
+    nbytes: int
+    """Size of the zip file that was created, or 0 if none was."""
+
+    members_hashes: tuple[int, str, str] | None = None
+    """Length, MD5, and Adler32 hashes of the member index file, if one was
+    written and is needed for Rucio."""
+
+    seconds: float = 0.0
+    """Seconds spent on the exposure so far, summed over the stages."""
+
+
+class IngestError(RuntimeError):
+    """Raised when a zip could not be ingested into some destination repos.
+
+    Parameters
+    ----------
+    dest_path: `lsst.resources.ResourcePath`
+        The installed zip file.
+    failures: `dict` [ `str`, `Exception` ]
+        Exceptions keyed by the repos they occurred in.
+    """
+
+    def __init__(self, dest_path: ResourcePath, failures: dict[str, Exception]):
+        super().__init__(f"Failed to ingest {dest_path} into {', '.join(sorted(failures))}")
+        self.failures = failures
+
+
+class RegistrationError(RuntimeError):
+    """Raised when files could not be registered in Rucio.
+
+    Parameters
+    ----------
+    failures: `dict` [ `str`, `Exception` ]
+        Exceptions keyed by the names of the files they occurred for.
+    """
+
+    def __init__(self, failures: dict[str, Exception]):
+        super().__init__(f"Failed to register in Rucio: {', '.join(sorted(failures))}")
+        self.failures = failures
+
+
+EXPORTED_ELEMENTS = [
+    "day_obs",
+    "group",
+    "visit",
+    "visit_definition",
+    "visit_detector_region",
+    "visit_system",
+    "visit_system_membership",
+]
+"""Dimension elements exported with each exposure, besides the exposure."""
+
+_STAGING_OVERHEAD = 1024 * 1024
+"""Staging space reserved for the dimensions file and the metadata index."""
+
+_PRIORITY_LEVEL = 3600.0
+"""Width in weighted seconds of the priority levels within which exposures
+are grouped by instrument."""
+
+_STALE_TMP_AGE = 24 * 3600
+"""Age in seconds after which a temporary zip in a destination directory is
+taken to be left over from a crashed run."""
+
+
+def _batched(items: list[Any], n: int) -> Generator:
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
 
 
 class RucioInterface:
@@ -53,14 +198,140 @@ class RucioInterface:
         Name of the RSE that the files live in.
     scope: `str`
         Rucio scope to register the files in.
+    replica_client: `rucio.client.replicaclient.ReplicaClient`, optional
+        Client for replicas; a new one is made if not given.
+    did_client: `rucio.client.didclient.DIDClient`, optional
+        Client for data identifiers; a new one is made if not given.
+
+    Notes
+    -----
+    Datasets that have been seen to exist during the run are cached, along
+    with whether they are open (`True`), closed (`False`), or in an unknown
+    state (`None`), so that attaching to them does not need to discover
+    their existence by failing.  The caches are shared by worker threads,
+    so they are guarded by a lock.
     """
 
-    def __init__(self, rucio_rse: str, scope: str):
+    def __init__(
+        self,
+        rucio_rse: str,
+        scope: str,
+        replica_client: ReplicaClient | None = None,
+        did_client: DIDClient | None = None,
+    ):
         self.rucio_rse = rucio_rse
         self.scope = scope
 
-        self.replica_client = ReplicaClient()
-        self.did_client = DIDClient()
+        self.replica_client = replica_client or ReplicaClient()
+        self.did_client = did_client or DIDClient()
+
+        self._datasets: dict[str, bool | None] = {}
+        self._prewarmed: set[tuple[str, int]] = set()
+        self._lock = threading.Lock()
+
+    def prewarm(self, instrument: str, day_obs: int) -> None:
+        """Cache the existing raw datasets for an observation day.
+
+        Parameters
+        ----------
+        instrument: `str`
+            Instrument to use.
+        day_obs: `int`
+            Observation day.
+        """
+        # global logger
+
+        with self._lock:
+            if (instrument, day_obs) in self._prewarmed:
+                return
+        pattern = f"Dataset/{instrument}/raw/*{day_obs}*"
+        names = self._retry(
+            "list_dids",
+            lambda: list(
+                self.did_client.list_dids(
+                    self.scope, filters={"name": pattern}, did_type="dataset"
+                )
+            ),
+        )
+        # Only Obs datasets are ever closed, so only their state is needed
+        obs_names = [name for name in names if "/raw/Obs/" in name]
+        states = {}
+        if obs_names:
+            for meta in self._retry(
+                "get_metadata_bulk",
+                lambda: list(
+                    self.did_client.get_metadata_bulk(
+                        [{"scope": self.scope, "name": name} for name in obs_names]
+                    )
+                ),
+            ):
+                states[meta["name"]] = bool(meta["is_open"])
+        with self._lock:
+            for name in names:
+                self._datasets.setdefault(name, states.get(name))
+            self._prewarmed.add((instrument, day_obs))
+        logger.info(
+            "Found %d existing Rucio datasets for %s, %d closed",
+            len(names),
+            pattern,
+            list(states.values()).count(False),
+        )
+
+    def _known(self, dataset_id: str) -> bool:
+        """Return whether a dataset is known to exist."""
+        with self._lock:
+            return dataset_id in self._datasets
+
+    def _is_closed(self, dataset_id: str) -> bool:
+        """Return whether a dataset is known to be closed."""
+        with self._lock:
+            return self._datasets.get(dataset_id) is False
+
+    def _set_state(self, dataset_id: str, state: bool | None) -> None:
+        """Record that a dataset exists and whether it is open."""
+        with self._lock:
+            if state is None:
+                self._datasets.setdefault(dataset_id, None)
+            else:
+                self._datasets[dataset_id] = state
+
+    def _forget(self, dataset_id: str) -> None:
+        """Forget a dataset that turned out not to exist."""
+        with self._lock:
+            self._datasets.pop(dataset_id, None)
+
+    def _closed_failures(self, dataset_id: str, names: list[str]) -> dict[str, Exception]:
+        """Return failures for files that cannot be attached to a closed
+        dataset because they are not already in it.
+
+        Parameters
+        ----------
+        dataset_id: `str`
+            Logical name of the closed Rucio dataset.
+        names: `list` [ `str` ]
+            Names of the files to attach.
+
+        Returns
+        -------
+        failures: `dict` [ `str`, `Exception` ]
+            Exceptions keyed by the names of the files missing from the
+            dataset.
+        """
+        # global logger
+
+        attached = {
+            content["name"]
+            for content in self.did_client.list_content(scope=self.scope, name=dataset_id)
+        }
+        failures: dict[str, Exception] = {}
+        for name in names:
+            if name in attached:
+                logger.info("%s is already in closed dataset %s", name, dataset_id)
+            else:
+                failures[name] = rucio.common.exception.UnsupportedOperation(
+                    f"Dataset {dataset_id} is closed, cannot attach {name}"
+                )
+        return failures
 
     @classmethod
     def compute_hashes(cls, path: str) -> tuple[int, str, str]:
@@ -192,7 +463,8 @@ class RucioInterface:
     def _add_file_to_dataset(self, did: dict, dataset_id: str, dry_run: bool) -> None:
         """Attach a file specified by a Rucio DID to a Rucio dataset.
 
-        Ignores already-attached files for idempotency.
+        Ignores already-attached files for idempotency, even if the dataset
+        has been closed.
 
         Parameters
         ----------
@@ -202,6 +474,11 @@ class RucioInterface:
             Logical name of the Rucio dataset.
         dry_run: `bool`
             If true, only log, do not write anything.
+
+        Raises
+        ------
+        rucio.common.exception.UnsupportedOperation
+            Raised if the dataset is closed and the file is not in it.
         """
         # global logger
 
@@ -210,6 +487,14 @@ class RucioInterface:
         )
         if dry_run:
             return
+        if self._is_closed(dataset_id):
+            for e in self._closed_failures(dataset_id, [did["name"]]).values():
+                raise e
+            return
+        created = False
+        if not self._known(dataset_id):
+            self._create_dataset(dataset_id)
+            created = True
         retries = 0
         max_retries = 2
         while True:
@@ -223,32 +508,315 @@ class RucioInterface:
                 return
             except rucio.common.exception.FileAlreadyExists:
                 return
+            except rucio.common.exception.UnsupportedOperation:
+                # The dataset was closed by an earlier run
+                self._set_state(dataset_id, False)
+                for e in self._closed_failures(dataset_id, [did["name"]]).values():
+                    raise e from None
+                return
             except rucio.common.exception.DataIdentifierNotFound:
-                # No such dataset, so create it
-                try:
-                    logger.info("Creating Rucio dataset %s", dataset_id)
-                    self.did_client.add_dataset(
-                        scope=self.scope,
-                        name=dataset_id,
-                        statuses={"monotonic": True},
-                        rse=self.rucio_rse,
-                    )
-                except rucio.common.exception.DataIdentifierAlreadyExists:
-                    # If someone else created it in the meantime
-                    pass
+                if created:
+                    raise
+                # The cached dataset does not exist, so create it
+                self._forget(dataset_id)
+                self._create_dataset(dataset_id)
+                created = True
                 # And then retry adding DIDs
                 logger.info("Retrying add_files_to_dataset after creation")
-                self._add_file_to_dataset(did, dataset_id, dry_run)
-                return
+                continue
             except rucio.common.exception.DatabaseException:
                 logger.info("Retrying add_files_to_dataset due to database")
                 retries += 1
                 if retries < max_retries:
                     time.sleep(random.uniform(0.5, 2))
                     continue
-            else:
                 raise
 
+    def _retry(self, label: str, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        """Call a Rucio client method, retrying on database errors.
+
+        Parameters
+        ----------
+        label: `str`
+            Name of the call for logging.
+        func: `~collections.abc.Callable`
+            Rucio client method to call.
+        *args, **kwargs
+            Arguments to the method.
+
+        Returns
+        -------
+        result: `~typing.Any`
+            Result of the method.
+        """
+        # global logger
+
+        retries = 0
+        max_retries = 2
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except rucio.common.exception.DatabaseException:
+                logger.info("Retrying %s due to database", label)
+                retries += 1
+                if retries < max_retries:
+                    time.sleep(random.uniform(0.5, 2))
+                    continue
+                raise
+
+    def _create_dataset(self, dataset_id: str) -> None:
+        """Create a Rucio dataset, ignoring it if it already exists.
+
+        Parameters
+        ----------
+        dataset_id: `str`
+            Logical name of the Rucio dataset.
+        """
+        # global logger
+
+        try:
+            logger.info("Creating Rucio dataset %s", dataset_id)
+            self._retry(
+                "add_dataset",
+                self.did_client.add_dataset,
+                scope=self.scope,
+                name=dataset_id,
+                statuses={"monotonic": True},
+                rse=self.rucio_rse,
+            )
+            self._set_state(dataset_id, True)
+        except rucio.common.exception.DataIdentifierAlreadyExists:
+            # If someone else created it in the meantime
+            self._set_state(dataset_id, None)
+
+    def _create_datasets(self, dataset_ids: list[str]) -> None:
+        """Create any Rucio datasets that are not known to exist.
+
+        Unknown datasets are created with a single ``add_datasets`` call,
+        falling back to creating them one at a time if any already exist.
+
+        Parameters
+        ----------
+        dataset_ids: `list` [ `str` ]
+            Logical names of the Rucio datasets.
+        """
+        # global logger
+
+        unknown = [d for d in dataset_ids if not self._known(d)]
+        if not unknown:
+            return
+        logger.info("Creating %d Rucio datasets", len(unknown))
+        try:
+            self._retry(
+                "add_datasets",
+                self.did_client.add_datasets,
+                [
+                    {
+                        "scope": self.scope,
+                        "name": dataset_id,
+                        "statuses": {"monotonic": True},
+                        "rse": self.rucio_rse,
+                    }
+                    for dataset_id in unknown
+                ],
+            )
+            for dataset_id in unknown:
+                self._set_state(dataset_id, True)
+        except rucio.common.exception.DataIdentifierAlreadyExists:
+            for dataset_id in unknown:
+                self._create_dataset(dataset_id)
+
+    def register_many(
+        self,
+        files: list[tuple[str, tuple[int, str, str], set[int], bool]],
+        *,
+        dry_run: bool = True,
+    ) -> dict[str, Exception]:
+        """Register many files in Rucio using bulk calls.
+
+        Replicas are added with one ``add_replicas`` call, all attachments
+        are made with one ``attach_dids_to_dids`` call, and the metadata of
+        all finished Obs datasets is set with one ``set_dids_metadata_bulk``
+        call.  If a bulk call fails, the affected files fall back to being
+        registered individually, so that failures can be attributed to
+        files.  Re-registering already-registered files is not an error.
+
+        Parameters
+        ----------
+        files: `list` [ `tuple` ]
+            Name, hashes, tracts, and finish flag of each file, as would be
+            passed to `register`.  Files that finish an Obs dataset must
+            come after the other files in that dataset.
+        dry_run: `bool`
+            If true, only log, do not write anything.
+
+        Returns
+        -------
+        failures: `dict` [ `str`, `Exception` ]
+            Exceptions raised while registering each file, keyed by name.
+        """
+        # global logger
+
+        failures: dict[str, Exception] = {}
+        dids = {}
+        dataset_files: dict[str, list[str]] = {}
+        finished = {}
+        for name, hashes, tracts, finish in files:
+            instrument, day_obs, filename = name.split("/")
+            meta = {"rubin_butler": "zip_file"} if name.endswith(".zip") else None
+            dids[name] = self._make_did(name, hashes, meta)
+            datasets = self._compute_datasets(
+                tracts, instrument, int(day_obs), filename[:20]
+            )
+            for dataset in datasets:
+                dataset_files.setdefault(dataset, []).append(name)
+            if finish:
+                # Assume "Obs" Dataset is the last one.
+                finished[datasets[-1]] = name
+
+        logger.info(
+            "Bulk registering %d files in %d datasets, RSE %s",
+            len(dids),
+            len(dataset_files),
+            self.rucio_rse,
+        )
+        if dry_run or not dids:
+            return failures
+
+        # Replicas
+        try:
+            self._retry(
+                "add_replicas",
+                self.replica_client.add_replicas,
+                rse=self.rucio_rse,
+                files=[
+                    {
+                        "scope": did["scope"],
+                        "name": did["name"],
+                        "bytes": did["bytes_"],
+                        "md5": did["md5"],
+                        "adler32": did["adler32"],
+                        "meta": did["meta"] or {},
+                    }
+                    for did in dids.values()
+                ],
+            )
+        except Exception as e:
+            logger.warning("Bulk add_replicas failed, adding individually: %s", e)
+            for name, did in dids.items():
+                try:
+                    self._add_replica(did, dry_run)
+                except Exception as e:
+                    logger.error("Unable to add replica %s: %s", name, e)
+                    failures[name] = e
+
+        # Attachments
+        def _attachments() -> list[dict]:
+            attachments = []
+            for dataset, names in dataset_files.items():
+                names = [name for name in names if name not in failures]
+                if names and self._is_closed(dataset):
+                    # Files already in the dataset need no attaching
+                    closed_failures = self._closed_failures(dataset, names)
+                    for name, e in closed_failures.items():
+                        logger.error("Unable to attach %s to dataset %s: %s", name, dataset, e)
+                    failures.update(closed_failures)
+                    continue
+                attached = [
+                    {"scope": dids[name]["scope"], "name": dids[name]["name"]} for name in names
+                ]
+                if attached:
+                    attachments.append(
+                        {
+                            "scope": self.scope,
+                            "name": dataset,
+                            "dids": attached,
+                            "rse": self.rucio_rse,
+                        }
+                    )
+            return attachments
+
+        try:
+            self._create_datasets(list(dataset_files))
+            try:
+                self._retry(
+                    "attach_dids_to_dids",
+                    self.did_client.attach_dids_to_dids,
+                    attachments=_attachments(),
+                    ignore_duplicate=True,
+                )
+            except rucio.common.exception.DataIdentifierNotFound:
+                # At least one cached dataset is missing, so create them all
+                # and retry
+                for dataset in dataset_files:
+                    self._forget(dataset)
+                    self._create_dataset(dataset)
+                logger.info("Retrying attach_dids_to_dids after creation")
+                self._retry(
+                    "attach_dids_to_dids",
+                    self.did_client.attach_dids_to_dids,
+                    attachments=_attachments(),
+                    ignore_duplicate=True,
+                )
+        except Exception as e:
+            logger.warning(
+                "Bulk attach_dids_to_dids failed, attaching individually: %s", e
+            )
+            for dataset, names in dataset_files.items():
+                for name in names:
+                    if name in failures:
+                        continue
+                    try:
+                        self._add_file_to_dataset(dids[name], dataset, dry_run)
+                    except Exception as e:
+                        logger.error(
+                            "Unable to attach %s to dataset %s: %s", name, dataset, e
+                        )
+                        failures[name] = e
+
+        # Close out Obs datasets whose files were all registered
+        closed = []
+        for dataset, name in finished.items():
+            if any(f in failures for f in dataset_files[dataset]):
+                logger.error("Not closing dataset %s after failures", dataset)
+                continue
+            if self._is_closed(dataset):
+                logger.info("Dataset %s is already closed", dataset)
+                continue
+            logger.info("Closing dataset %s", dataset)
+            try:
+                self.did_client.close(scope="raw", name=dataset)
+                closed.append(dataset)
+            except Exception as e:
+                logger.error("Unable to close dataset %s: %s", dataset, e)
+                failures[name] = e
+        if closed:
+            logger.info("Setting metadata on %d datasets", len(closed))
+            try:
+                self._retry(
+                    "set_dids_metadata_bulk",
+                    self.did_client.set_dids_metadata_bulk,
+                    dids=[
+                        {
+                            "scope": "raw",
+                            "name": dataset,
+                            "meta": {
+                                "arcBackup": "SLAC_RAW_DISK_BKUP:need",
+                                "SafeCopies": "",
+                            },
+                        }
+                        for dataset in closed
+                    ],
+                )
+                for dataset in closed:
+                    self._set_state(dataset, False)
+            except Exception as e:
+                logger.error("Unable to set metadata on closed datasets: %s", e)
+                for dataset in closed:
+                    failures[finished[dataset]] = e
+
+        return failures
+
     def register(
         self,
         name: str,
@@ -282,29 +850,172 @@ class RucioInterface:
         did = self._make_did(name, hashes, meta)
         self._add_replica(did, dry_run)
         datasets = self._compute_datasets(tracts, instrument, int(day_obs), obs_id)
+        if not dry_run:
+            self._create_datasets(datasets)
         for dataset in datasets:
             self._add_file_to_dataset(did, dataset, dry_run)
 
-        if not finish:
-            return
+        if finish:
+            self.finish(name, dry_run=dry_run)
+
+    def finish(self, name: str, *, dry_run: bool = True) -> None:
+        """Close out the Obs dataset containing a file.
+
+        Parameters
+        ----------
+        name: `str`
+            Rucio Logical File Name (LFN) in instrument/day_obs/filename form.
+        dry_run: `bool`
+            If true, only log, do not write anything.
+        """
+        # global logger
 
+        instrument, day_obs, filename = name.split("/")
         # Assume "Obs" Dataset is the last one.
-        logger.info("Closing and setting metadata on dataset %s", datasets[-1])
+        dataset = self._compute_datasets(
+            set(), instrument, int(day_obs), filename[:20]
+        )[-1]
+        if self._is_closed(dataset):
+            logger.info("Dataset %s is already closed", dataset)
+            return
+        logger.info("Closing and setting metadata on dataset %s", dataset)
         if dry_run:
             return
-        self.did_client.close(scope="raw", name=datasets[-1])
+        self.did_client.close(scope="raw", name=dataset)
         self.did_client.set_metadata(
             scope="raw",
-            name=datasets[-1],
+            name=dataset,
             key="arcBackup",
             value="SLAC_RAW_DISK_BKUP:need",
         )
         self.did_client.set_metadata(
             scope="raw",
-            name=datasets[-1],
+            name=dataset,
             key="SafeCopies",
             value='',
         )
+        self._set_state(dataset, False)
+
+
+class DestinationListing:
+    """Cache of the names of the files in destination directories.
+
+    Each directory is listed once, the first time it is needed, instead of
+    checking for the existence of each file separately.  Files installed
+    during the run are added to the cache, and individual entries can be
+    refreshed from the destination when an up-to-date answer is required.
+
+    Directories are listed without holding the lock, so a slow listing
+    only holds up the threads that need that directory, and a directory
+    being listed is marked as in flight so it is not listed twice.
+    """
+
+    def __init__(self):
+        self._names: dict[str, set[str]] = {}
+        self._in_flight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _listing(self, dirname: ResourcePath) -> set[str]:
+        """Return the cached listing of a directory, listing it if needed.
+
+        Parameters
+        ----------
+        dirname: `lsst.resources.ResourcePath`
+            Directory to list.
+
+        Returns
+        -------
+        names: `set` [ `str` ]
+            Names of the files in the directory.
+        """
+        # global logger
+
+        key = str(dirname)
+        with self._lock:
+            if key in self._names:
+                return self._names[key]
+            future = self._in_flight.get(key)
+            listing = future is None
+            if listing:
+                future = self._in_flight[key] = Future()
+        if not listing:
+            # Another thread is listing the directory
+            return future.result()
+
+        names: set[str] = set()
+        try:
+            try:
+                for _, _, filenames in dirname.walk():
+                    names.update(filenames)
+                    break
+            except FileNotFoundError:
+                pass
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        logger.debug("Listed %d files in %s", len(names), dirname)
+        with self._lock:
+            names = self._names.setdefault(key, names)
+            del self._in_flight[key]
+        future.set_result(names)
+        return names
+
+    def exists(self, path: ResourcePath) -> bool:
+        """Check whether a file exists according to the cached listing.
+
+        Parameters
+        ----------
+        path: `lsst.resources.ResourcePath`
+            File to check.
+
+        Returns
+        -------
+        exists: `bool`
+            True if the file was present when its directory was listed or
+            has been added since.
+        """
+        return path.basename() in self._listing(path.dirname())
+
+    def refresh(self, path: ResourcePath) -> bool:
+        """Check whether a file exists at the destination itself.
+
+        Parameters
+        ----------
+        path: `lsst.resources.ResourcePath`
+            File to check.
+
+        Returns
+        -------
+        exists: `bool`
+            True if the file exists.  The cached listing is updated.
+        """
+        exists = path.exists()
+        names = self._listing(path.dirname())
+        with self._lock:
+            if exists:
+                names.add(path.basename())
+            else:
+                names.discard(path.basename())
+        return exists
+
+    def add(self, path: ResourcePath) -> None:
+        """Record that a file now exists.
+
+        Parameters
+        ----------
+        path: `lsst.resources.ResourcePath`
+            File that was installed.
+        """
+        names = self._listing(path.dirname())
+        with self._lock:
+            names.add(path.basename())
+
+    def clear(self) -> None:
+        """Forget all listings, so that directories are listed again."""
+        with self._lock:
+            self._names.clear()
 
 
 def parse_args():
@@ -393,44 +1104,412 @@ def parse_args():
     )
 
     parser.add_argument(
-        "--log",
+        "--fake_rucio",
+        nargs="?",
+        const="",
         type=str,
         required=False,
-        help="Level name (WARNING, INFO, DEBUG) or comma-sepaarated list of logger=level pairs.",
+        help=(
+            "Register in an in-process fake Rucio instead of the real one,"
+            " optionally with comma-separated latency=SECONDS,"
+            " failure_rate=PROBABILITY, and seed=N settings."
+            " Requires --rucio_rse; for testing only."
+        ),
     )
 
     parser.add_argument(
-        "--repair",
-        action="store_true",
-        help="Repair partially unembargoed exposures: make up incomplete info in Rucio",
+        "--ledger",
+        type=str,
+        required=False,
+        help=(
+            "Path to a SQLite ledger of completed transfer steps, used to skip"
+            " finished exposures and to limit repairs to missing steps."
+        ),
     )
 
-    ns = parser.parse_args()
-    ns.now = Time(ns.now, format="isot", scale="tai") if ns.now else Time.now()
-    if ns.now > Time.now():
-        raise ValueError(f"--now is in the future: {ns.now}")
-    if ns.rucio_rse is not None:
-        if ns.scope is None:
-            raise ValueError("--scope required with --rucio_rse")
-
-    return ns
-
+    parser.add_argument(
+        "--watermark_overlap",
+        type=str,
+        required=False,
+        help=(
+            "Query each data query only from its high-water mark in the ledger"
+            " (the end of the last exposure fully processed), less this safety"
+            " overlap in astropy quantity_str format (e.g. '5min')."
+            " Requires --ledger.  --window is only used before a mark exists."
+        ),
+    )
+    parser.add_argument(
+        "--watermark_max_lag",
+        type=str,
+        default="1d",
+        help=(
+            "Let the high-water mark advance past unfinished exposures that"
+            " ended this long before the end of the query window, in astropy"
+            " quantity_str format (default='1d'), so that one exposure that"
+            " never completes cannot hold it back forever."
+        ),
+    )
 
-def transfer_data_query(data_query: DataQuery) -> None:
-    """Transfer all files matching a data query into zip files.
+    parser.add_argument(
+        "--write_in_place",
+        action="store_true",
+        help=(
+            "Write each zip under a temporary name in its local destination"
+            " directory and link it into place, instead of copying it there"
+            " from a temporary directory."
+        ),
+    )
 
-    Parameters
-    ----------
-    data_query: `DataQuery`
-        The query and associated embargo time.
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help=(
+            "Process exposures in a pipeline of stages connected by bounded"
+            " queues: --jobs workers write zips, --ingest_jobs ingest them,"
+            " and --register_jobs register them in Rucio."
+        ),
+    )
+    parser.add_argument(
+        "--ingest_jobs",
+        type=int,
+        default=1,
+        help="Number of pipeline workers ingesting zips (default=1).",
+    )
+    parser.add_argument(
+        "--register_jobs",
+        type=int,
+        default=1,
+        help="Number of pipeline workers registering in Rucio (default=1).",
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=2,
+        help=(
+            "Number of exposures that may wait between pipeline stages"
+            " before the earlier stage is held back (default=2)."
+        ),
+    )
+
+    parser.add_argument(
+        "--index_jobs",
+        type=int,
+        default=1,
+        help=(
+            "Number of processes reading FITS headers for the metadata index"
+            " (default=1, read serially)."
+        ),
+    )
+
+    parser.add_argument(
+        "--prioritize",
+        action="store_true",
+        help=(
+            "Merge the exposures of all data queries and transfer them in order"
+            " of how long they have been eligible for release, multiplied by"
+            " each query's priority_weight."
+        ),
+    )
+
+    parser.add_argument(
+        "--member_index",
+        action="store_true",
+        help=(
+            "Write an OBS_ID_members.json file next to each zip with the byte"
+            " offset, size, and CRC of each member, so that one member can be"
+            " read with a single ranged request, and register it in Rucio."
+        ),
+    )
+
+    parser.add_argument(
+        "--staging_dir",
+        type=str,
+        required=False,
+        help="Directory for staging zips (default: the temporary directory).",
+    )
+    parser.add_argument(
+        "--staging_budget",
+        type=float,
+        required=False,
+        help=(
+            "Maximum GB of zips staged at once; exposures wait for space"
+            " before being zipped (default: no limit)."
+        ),
+    )
+    parser.add_argument(
+        "--fast_staging_dir",
+        type=str,
+        required=False,
+        help=(
+            "Directory, such as a tmpfs, for staging zips that fit in"
+            " --fast_staging_budget, before using --staging_dir."
+        ),
+    )
+    parser.add_argument(
+        "--fast_staging_budget",
+        type=float,
+        default=0.0,
+        help="Maximum GB of zips staged at once in --fast_staging_dir (default=0).",
+    )
+
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=500,
+        help=(
+            "Number of exposures whose registry information is looked up"
+            " together (default=500)."
+        ),
+    )
+
+    parser.add_argument(
+        "--rucio_batch",
+        action="store_true",
+        help=(
+            "Register files in Rucio with bulk calls after each chunk of"
+            " exposures instead of after each exposure."
+        ),
+    )
+
+    parser.add_argument(
+        "--rucio_prewarm",
+        action="store_true",
+        help=(
+            "List the existing Rucio datasets for each day_obs once, so that"
+            " known datasets are not looked up again."
+        ),
+    )
+
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help=(
+            "Keep running, transferring newly eligible exposures every"
+            " --poll_interval with the same Butlers and Rucio clients."
+        ),
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=str,
+        default="5min",
+        help=(
+            "Time between the starts of transfers in --daemon mode,"
+            " in astropy quantity_str format (default='5min')."
+        ),
+    )
+
+    parser.add_argument(
+        "--defer_retries",
+        type=int,
+        default=0,
+        help=(
+            "Number of times to recheck exposures skipped as incomplete"
+            " before the run ends (default=0, leave them for a later run)."
+        ),
+    )
+    parser.add_argument(
+        "--defer_backoff",
+        type=str,
+        default="30s",
+        help=(
+            "Time before the first recheck of incomplete exposures, doubling"
+            " for each later one, in astropy quantity_str format (default='30s')."
+        ),
+    )
+
+    parser.add_argument(
+        "--metrics_json",
+        type=str,
+        required=False,
+        help="Path to write a JSON summary of per-stage timings after each run.",
+    )
+    parser.add_argument(
+        "--metrics_prom",
+        type=str,
+        required=False,
+        help=(
+            "Path to write per-stage timing totals in the Prometheus textfile"
+            " format after each run."
+        ),
+    )
+
+    parser.add_argument(
+        "--log",
+        type=str,
+        required=False,
+        help="Level name (WARNING, INFO, DEBUG) or comma-sepaarated list of logger=level pairs.",
+    )
+
+    parser.add_argument(
+        "--repair",
+        action="store_true",
+        help="Repair partially unembargoed exposures: make up incomplete info in Rucio",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of exposures to process concurrently (default=1).",
+    )
+
+    ns = parser.parse_args()
+    if ns.daemon and ns.now is not None:
+        raise ValueError("--now cannot be used with --daemon")
+    ns.now = Time(ns.now, format="isot", scale="tai") if ns.now else Time.now()
+    if ns.now > Time.now():
+        raise ValueError(f"--now is in the future: {ns.now}")
+    ns.poll_interval = TimeDelta(ns.poll_interval, format="quantity_str")
+    if ns.defer_retries < 0:
+        raise ValueError(f"--defer_retries must not be negative: {ns.defer_retries}")
+    ns.defer_backoff = TimeDelta(ns.defer_backoff, format="quantity_str")
+    if ns.rucio_rse is not None:
+        if ns.scope is None:
+            raise ValueError("--scope required with --rucio_rse")
+    if ns.fake_rucio is not None and ns.rucio_rse is None:
+        raise ValueError("--rucio_rse required with --fake_rucio")
+    if ns.watermark_overlap is not None:
+        if ns.ledger is None:
+            raise ValueError("--ledger required with --watermark_overlap")
+        ns.watermark_overlap = TimeDelta(ns.watermark_overlap, format="quantity_str")
+    ns.watermark_max_lag = TimeDelta(ns.watermark_max_lag, format="quantity_str")
+    if ns.jobs < 1:
+        raise ValueError(f"--jobs must be at least 1: {ns.jobs}")
+    if ns.write_in_place and not ResourcePath(ns.dest_uri_prefix).isLocal:
+        raise ValueError(f"--write_in_place requires a local destination: {ns.dest_uri_prefix}")
+    for name in ("ingest_jobs", "register_jobs", "queue_size"):
+        if getattr(ns, name) < 1:
+            raise ValueError(f"--{name} must be at least 1: {getattr(ns, name)}")
+    if ns.index_jobs < 1:
+        raise ValueError(f"--index_jobs must be at least 1: {ns.index_jobs}")
+    if ns.staging_budget is not None and ns.staging_budget <= 0:
+        raise ValueError(f"--staging_budget must be positive: {ns.staging_budget}")
+    if ns.fast_staging_dir is not None and ns.fast_staging_budget <= 0:
+        raise ValueError("--fast_staging_budget required with --fast_staging_dir")
+    if ns.chunk_size < 1:
+        raise ValueError(f"--chunk_size must be at least 1: {ns.chunk_size}")
+
+    return ns
+
+
+def transfer_data_query(data_query: DataQuery) -> None:
+    """Transfer all files matching a data query into zip files.
+
+    Parameters
+    ----------
+    data_query: `DataQuery`
+        The query and associated embargo time.
+    """
+    # global config
+
+    queried, exposures, mark = select_exposures(data_query)
+    stats: dict[str, list] = {}
+    try:
+        transfer_exposures(exposures, data_query.instrument, stats)
+        process_deferred(data_query.instrument, stats)
+    finally:
+        # Advance past whatever was finished, even if processing failed
+        if config.watermark_overlap is not None and not config.dry_run:
+            advance_watermark(data_query, queried, mark)
+    _log_stats(stats)
+
+
+def transfer_prioritized(data_queries: list[DataQuery]) -> None:
+    """Transfer the exposures of all data queries in order of priority.
+
+    The exposures selected by all queries are merged into one queue,
+    ordered by how long each has been eligible for release multiplied by
+    its query's ``priority_weight``, so that after a backlog builds up the
+    most overdue exposures are transferred first.  An exposure selected by
+    more than one query gets its highest priority.  Within each priority
+    level of ``_PRIORITY_LEVEL`` seconds, exposures are grouped by
+    instrument, keeping their order, so that interleaved instruments are
+    still transferred in large batches.
+
+    Parameters
+    ----------
+    data_queries: `list` [ `DataQuery` ]
+        The queries and associated embargo times.
     """
-    # global logger, config, source_butler
+    # global config, logger
+
+    selections = []
+    priorities: dict[tuple[str, int], tuple[float, DimensionRecord]] = {}
+    stats: dict[str, list] = {}
+    try:
+        for data_query in data_queries:
+            logger.info("Selecting %s", data_query)
+            queried, exposures, mark = select_exposures(data_query)
+            selections.append((data_query, queried, mark))
+            embargo = TimeDelta(data_query.embargo_hours * 3600, format="sec")
+            for exp in exposures:
+                eligible = (config.now - (exp.timespan.end + embargo)).to_value("sec")
+                priority = max(eligible, 0.0) * data_query.priority_weight
+                key = (data_query.instrument, exp.id)
+                if key not in priorities or priority > priorities[key][0]:
+                    priorities[key] = (priority, exp)
+        if not priorities:
+            return
+
+        queue = sorted(priorities.items(), key=lambda item: (-item[1][0], item[0]))
+        _, (priority, exp) = queue[0]
+        logger.info(
+            "Prioritized %d exposures from %d queries, starting with %s (%.0f)",
+            len(queue),
+            len(data_queries),
+            exp.obs_id,
+            priority,
+        )
+        for _, level in itertools.groupby(queue, key=lambda item: int(item[1][0] // _PRIORITY_LEVEL)):
+            groups: dict[str, list[DimensionRecord]] = {}
+            for (instrument, _), (_, exp) in level:
+                groups.setdefault(instrument, []).append(exp)
+            for instrument, exposures in groups.items():
+                transfer_exposures(exposures, instrument, stats)
+        for instrument in sorted({instrument for instrument, _ in priorities}):
+            process_deferred(instrument, stats)
+    finally:
+        # Advance past whatever was finished, even if processing failed
+        if config.watermark_overlap is not None and not config.dry_run:
+            for data_query, queried, mark in selections:
+                advance_watermark(data_query, queried, mark)
+        _log_stats(stats)
+
+
+def select_exposures(
+    data_query: DataQuery,
+) -> tuple[list[DimensionRecord], list[DimensionRecord], str | None]:
+    """Find the exposures matching a data query that need transferring.
+
+    Parameters
+    ----------
+    data_query: `DataQuery`
+        The query and associated embargo time.
+
+    Returns
+    -------
+    queried: `list` [ `lsst.daf.butler.DimensionRecord` ]
+        All exposures matching the query, in order.
+    exposures: `list` [ `lsst.daf.butler.DimensionRecord` ]
+        Those exposures not yet completed according to the ledger.
+    mark: `str` or `None`
+        The query's high-water mark that the search started from, if any.
+    """
+    # global logger, config, source_butler, ledger, rucio_interface
 
     # End of window is now - embargo length
     end_time = config.now - TimeDelta(data_query.embargo_hours * 3600, format="sec")
-    # If window is defined, then start is that much before the end
+    # If there is a high-water mark, start that much before it
+    # Otherwise, if window is defined, then start is that much before the end
     # Otherwise, start is infinitely previous
-    if config.window is not None:
+    mark = None
+    if config.watermark_overlap is not None:
+        mark = ledger.watermark(_watermark_key(data_query))
+    if mark is not None:
+        start_time = Time(mark, format="isot", scale="tai") - config.watermark_overlap
+        logger.info("Starting from watermark %s", mark)
+    elif config.window is not None:
         start_time = end_time - TimeDelta(config.window, format="quantity_str")
     else:
         start_time = None
@@ -452,7 +1531,7 @@ def transfer_data_query(data_query: DataQuery) -> None:
     )
     if not exposures:
         logger.info("No matching records")
-        return
+        return [], [], mark
     logger.info(
         "Result is %d exposures from %s to %s",
         len(exposures),
@@ -460,11 +1539,564 @@ def transfer_data_query(data_query: DataQuery) -> None:
         exposures[-1].id,
     )
 
-    for exp in exposures:
-        process_exposure(exp, data_query.instrument)
+    queried = exposures
+    if ledger is not None:
+        completed = ledger.completed_many(
+            data_query.instrument, (exp.obs_id for exp in exposures)
+        )
+        required = required_steps()
+        remaining = [
+            exp
+            for exp in exposures
+            if not required <= completed.get(exp.obs_id, set())
+        ]
+        logger.info(
+            "Skipping %d exposures completed according to the ledger",
+            len(exposures) - len(remaining),
+        )
+        exposures = remaining
+
+    if config.rucio_rse and config.rucio_prewarm:
+        for day_obs in sorted({exp.day_obs for exp in exposures}):
+            rucio_interface.prewarm(data_query.instrument, day_obs)
+    return queried, exposures, mark
+
+
+def transfer_exposures(
+    exposures: list[DimensionRecord], instrument: str, stats: dict[str, list]
+) -> None:
+    """Transfer exposures of one instrument, in chunks, in the given order.
+
+    Parameters
+    ----------
+    exposures: `list` [ `lsst.daf.butler.DimensionRecord` ]
+        The exposures to transfer.
+    instrument: `str`
+        The name of the instrument corresponding to the exposures.
+    stats: `dict` [ `str`, `list` ]
+        Per-worker throughput accumulator.
+    """
+    # global config
+
+    for chunk in _batched(exposures, config.chunk_size):
+        infos = query_exposure_info(chunk, instrument)
+        try:
+            process_exposures(chunk, instrument, infos, stats)
+        finally:
+            # Register whatever was installed, even if processing failed
+            if config.rucio_batch:
+                flush_registrations()
+
+
+def _log_stats(stats: dict[str, list]) -> None:
+    """Log the throughput of each worker.
+
+    Parameters
+    ----------
+    stats: `dict` [ `str`, `list` ]
+        Per-worker [exposure count, bytes zipped, seconds], keyed by
+        thread name.
+    """
+    # global logger
+
+    for worker, (count, nbytes, seconds) in sorted(stats.items()):
+        logger.info(
+            "Worker %s: %d exposures, %.1f MB in %.1f s (%.1f MB/s)",
+            worker,
+            count,
+            nbytes / 1e6,
+            seconds,
+            nbytes / 1e6 / seconds if seconds > 0 else 0.0,
+        )
+
+
+def _watermark_key(data_query: DataQuery) -> str:
+    """Return the key identifying a data query's high-water mark.
+
+    Parameters
+    ----------
+    data_query: `DataQuery`
+        The query.
+
+    Returns
+    -------
+    key: `str`
+        The key; any change to the selection gives the query a new mark.
+    """
+    return data_query.model_dump_json(exclude={"priority_weight"})
+
+
+def advance_watermark(
+    data_query: DataQuery, exposures: list[DimensionRecord], mark: str | None
+) -> None:
+    """Advance a data query's high-water mark past finished exposures.
+
+    The mark only moves up to the end of the last exposure in the leading
+    run of finished ones, so that exposures that were skipped as
+    incomplete or that failed are queried again next time.  Unfinished
+    exposures more than ``--watermark_max_lag`` older than the end of the
+    query window are passed over with a warning, so that one that never
+    completes does not make every later query cover an ever-growing span.
+
+    Parameters
+    ----------
+    data_query: `DataQuery`
+        The query.
+    exposures: `list` [ `lsst.daf.butler.DimensionRecord` ]
+        All exposures returned by the query, in order.
+    mark: `str` or `None`
+        The previous mark, if any.
+    """
+    # global logger, config, ledger, dest_listing
+
+    instrument = data_query.instrument
+    completed = ledger.completed_many(instrument, (exp.obs_id for exp in exposures))
+    required = required_steps()
+    dest_dir = ResourcePath(config.dest_uri_prefix).join(instrument)
+    end = Time(mark, format="isot", scale="tai") if mark is not None else None
+    give_up = (
+        config.now
+        - TimeDelta(data_query.embargo_hours * 3600, format="sec")
+        - config.watermark_max_lag
+    )
+    for exp in exposures:
+        steps = completed.get(exp.obs_id, set())
+        if not required <= steps:
+            # An exposure unknown to the ledger whose zip already exists was
+            # handled by another run; a partially recorded one is unfinished
+            zip_path = dest_dir.join(f"{exp.day_obs}").join(f"{exp.obs_id}.zip")
+            if steps or not dest_listing.exists(zip_path):
+                if exp.timespan.end >= give_up:
+                    logger.info("Watermark held at unfinished exposure %s", exp.obs_id)
+                    break
+                logger.warning(
+                    "Advancing watermark past unfinished exposure %s, which ended"
+                    " before %s",
+                    exp.obs_id,
+                    give_up.tai.isot,
+                )
+        if end is None or exp.timespan.end > end:
+            end = exp.timespan.end
+    if end is not None and end.tai.isot != mark:
+        logger.info("Advancing watermark to %s", end.tai.isot)
+        ledger.set_watermark(_watermark_key(data_query), end.tai.isot)
+
+
+def query_exposure_info(
+    exposures: list[DimensionRecord], instrument: str
+) -> dict[int, ExposureInfo]:
+    """Look up the registry information for a chunk of exposures in bulk.
+
+    Parameters
+    ----------
+    exposures: `list` [ `lsst.daf.butler.DimensionRecord` ]
+        The exposures to look up.
+    instrument: `str`
+        The name of the instrument corresponding to the exposures.
+
+    Returns
+    -------
+    infos: `dict` [ `int`, `ExposureInfo` ]
+        Registry information for each exposure, keyed by exposure id.
+    """
+    exposure_ids = [exp.id for exp in exposures]
+    tracts = query_tracts(exposure_ids, instrument)
+    science_refs = query_refs("raw", f"{instrument}/raw/all", exposure_ids, instrument)
+    if has_guider_raws(instrument):
+        guider_refs = query_refs(
+            "guider_raw", f"{instrument}/raw/guider", exposure_ids, instrument
+        )
+    else:
+        guider_refs = {exposure_id: [] for exposure_id in exposure_ids}
+    dimension_records = query_dimension_records(exposure_ids, instrument)
+    return {
+        exposure_id: ExposureInfo(
+            tracts=tracts[exposure_id],
+            science_refs=science_refs[exposure_id],
+            guider_refs=guider_refs[exposure_id],
+            dimension_records=dimension_records[exposure_id],
+        )
+        for exposure_id in exposure_ids
+    }
+
+
+@functools.cache
+def has_guider_raws(instrument: str) -> bool:
+    """Determine whether the source repo can hold GUIDER datasets.
+
+    This is checked once per run rather than once per exposure.
+
+    Parameters
+    ----------
+    instrument: `str`
+        The name of the instrument.
+
+    Returns
+    -------
+    exists: `bool`
+        True if the ``guider_raw`` dataset type and the instrument's guider
+        collection both exist.
+    """
+    # global logger, source_butler
+
+    try:
+        source_butler.get_dataset_type("guider_raw")
+        source_butler.collections.get_info(f"{instrument}/raw/guider")
+    except (_exceptions.MissingDatasetTypeError, _exceptions.MissingCollectionError):
+        logger.warning("No GUIDER datasets for %s", instrument)
+        return False
+    return True
+
+
+def query_refs(
+    dataset_type: str, collection: str, exposure_ids: list[int], instrument: str
+) -> dict[int, list[DatasetRef]]:
+    """Find the datasets of a given type for many exposures at once.
+
+    Parameters
+    ----------
+    dataset_type: `str`
+        Name of the dataset type.
+    collection: `str`
+        Collection to search.
+    exposure_ids: `list` [ `int` ]
+        The exposures to search for.
+    instrument: `str`
+        The name of the instrument corresponding to the exposures.
+
+    Returns
+    -------
+    refs: `dict` [ `int`, `list` [ `lsst.daf.butler.DatasetRef` ] ]
+        Datasets for each exposure, keyed by exposure id.
+    """
+    # global source_butler
+
+    refs: dict[int, list[DatasetRef]] = {
+        exposure_id: [] for exposure_id in exposure_ids
+    }
+    for ref in source_butler.query_datasets(
+        dataset_type,
+        collections=collection,
+        where="exposure.id IN (_exposures)",
+        bind={"_exposures": exposure_ids},
+        instrument=instrument,
+        limit=None,
+        explain=False,
+    ):
+        refs[ref.dataId["exposure"]].append(ref)
+    return refs
+
+
+def query_dimension_records(
+    exposure_ids: list[int], instrument: str
+) -> dict[int, dict[str, list[DimensionRecord]]]:
+    """Find the records to export with many exposures at once.
+
+    Each of `EXPORTED_ELEMENTS` is queried once for all the exposures, and
+    the records are split by the exposure that they were joined to.  This
+    gives each exposure the same records as querying the element with an
+    ``exposure`` data ID constraint would.
+
+    Parameters
+    ----------
+    exposure_ids: `list` [ `int` ]
+        The exposures to search for.
+    instrument: `str`
+        The name of the instrument corresponding to the exposures.
+
+    Returns
+    -------
+    records: `dict` [ `int`, `dict` [ `str`, `list` ] ]
+        Records of each element, for each exposure keyed by exposure id.
+    """
+    # global source_butler
+
+    by_exposure: dict[int, dict[str, dict]] = {
+        exposure_id: {} for exposure_id in exposure_ids
+    }
+    for element in EXPORTED_ELEMENTS:
+        dimensions = set(source_butler.dimensions[element].minimal_group.names)
+        dimensions.add("exposure")
+        with source_butler.query() as q:
+            q = q.where(
+                "exposure.id IN (_exposures)",
+                instrument=instrument,
+                bind={"_exposures": exposure_ids},
+            )
+            for data_id in q.data_ids(dimensions).with_dimension_records():
+                record = data_id.records[element]
+                if record is not None:
+                    records = by_exposure[data_id["exposure"]].setdefault(element, {})
+                    records.setdefault(record.dataId, record)
+    return {
+        exposure_id: {
+            element: list(records.values()) for element, records in elements.items()
+        }
+        for exposure_id, elements in by_exposure.items()
+    }
+
+
+def query_tracts(exposure_ids: list[int], instrument: str) -> dict[int, set[int]]:
+    """Map exposures to the tracts that their visits overlap.
+
+    Parameters
+    ----------
+    exposure_ids: `list` [ `int` ]
+        The exposures to map.
+    instrument: `str`
+        The name of the instrument corresponding to the exposures.
+
+    Returns
+    -------
+    tracts: `dict` [ `int`, `set` [ `int` ] ]
+        Set of tracts for each exposure, empty if it is not on-sky.
+    """
+    # global logger, source_butler
+
+    tracts: dict[int, set[int]] = {exposure_id: set() for exposure_id in exposure_ids}
+    with source_butler.query() as q:
+        q = q.join_dimensions(["visit", "tract"]).where(
+            "visit IN (_visits)",
+            instrument=instrument,
+            skymap="lsst_cells_v1",
+            bind={"_visits": exposure_ids},
+        )
+        for data_id in q.data_ids(["visit", "tract"]):
+            tracts[data_id["visit"]].add(int(data_id["tract"]))
+    logger.debug("Tracts: %s", tracts)
+    return tracts
+
+
+def process_exposures(
+    exposures: list[DimensionRecord],
+    instrument: str,
+    infos: dict[int, ExposureInfo],
+    stats: dict[str, list],
+) -> None:
+    """Process exposures, concurrently if so configured.
+
+    Parameters
+    ----------
+    exposures: `list` [ `lsst.daf.butler.DimensionRecord` ]
+        The exposures to process.
+    instrument: `str`
+        The name of the instrument corresponding to the exposures.
+    infos: `dict` [ `int`, `ExposureInfo` ]
+        Registry information for each exposure, keyed by exposure id.
+    stats: `dict` [ `str`, `list` ]
+        Per-worker throughput accumulator.
+    """
+    # global config, logger
+
+    if config.pipeline:
+        run_pipeline(exposures, instrument, infos, stats)
+        return
+
+    if config.jobs == 1:
+        for exp in exposures:
+            _process_and_account(exp, instrument, infos[exp.id], stats)
+        return
+
+    with ThreadPoolExecutor(
+        max_workers=config.jobs, thread_name_prefix="exposure"
+    ) as pool:
+        futures = {
+            pool.submit(
+                _process_and_account, exp, instrument, infos[exp.id], stats
+            ): exp
+            for exp in exposures
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logger.exception(
+                    "Failed to process exposure %s", futures[future].obs_id
+                )
+                pool.shutdown(wait=True, cancel_futures=True)
+                raise
+
+
+def flush_registrations() -> None:
+    """Register all queued files in Rucio with bulk calls.
+
+    Files that could not be registered are reported individually.  With a
+    ledger, their exposures are left incomplete for a later run; without
+    one, nothing would retry them, so the failures are raised.
+
+    Raises
+    ------
+    RegistrationError
+        Raised if some files could not be registered and there is no
+        ledger.
+    """
+    # global logger, config, ledger, rucio_interface, metrics
+
+    with _registrations_lock:
+        files = list(_pending_registrations)
+        _pending_registrations.clear()
+    if not files:
+        return
+    logger.info("Registering %d files in Rucio", len(files))
+    with time_this(logger, "Registering in Rucio"), metrics.stage(
+        "register_batch", f"{len(files)} files"
+    ):
+        failures = rucio_interface.register_many(files, dry_run=config.dry_run)
+    for name, e in failures.items():
+        logger.error("Failed to register %s in Rucio: %s", name, e)
+
+    # Exposures are only complete if both of their files were registered
+    failed = set()
+    for name, _, _, _ in files:
+        instrument, _, filename = name.split("/")
+        if name in failures:
+            failed.add((instrument, filename[:20]))
+    for name, _, _, finish in files:
+        instrument, _, filename = name.split("/")
+        if finish and (instrument, filename[:20]) not in failed:
+            _record_step(instrument, filename[:20], TransferLedger.RUCIO_REGISTERED)
+            _record_step(instrument, filename[:20], TransferLedger.OBS_CLOSED)
+    if failures and ledger is None:
+        raise RegistrationError(failures) from next(iter(failures.values()))
+
+
+def _process_and_account(
+    exp: DimensionRecord, instrument: str, info: ExposureInfo, stats: dict[str, list]
+) -> None:
+    """Process an exposure and accumulate throughput for the current worker.
+
+    Parameters
+    ----------
+    exp: `lsst.daf.butler.DimensionRecord`
+        The exposure to process.
+    instrument: `str`
+        The name of the instrument corresponding to the exposure.
+    info: `ExposureInfo`
+        Registry information about the exposure.
+    stats: `dict` [ `str`, `list` ]
+        Per-worker [exposure count, bytes zipped, seconds] accumulator,
+        keyed by thread name.
+    """
+    start = time.monotonic()
+    nbytes = process_exposure(exp, instrument, info)
+    elapsed = time.monotonic() - start
+    _account(stats, nbytes, elapsed)
+    metrics.record("exposure", exp.obs_id, elapsed, nbytes)
+
+
+def _account(
+    stats: dict[str, list], nbytes: int, elapsed: float, count: int = 1
+) -> None:
+    """Accumulate the throughput of one exposure for the current worker.
+
+    Parameters
+    ----------
+    stats: `dict` [ `str`, `list` ]
+        Per-worker [exposure count, bytes zipped, seconds] accumulator,
+        keyed by thread name.
+    nbytes: `int`
+        Bytes zipped for the exposure.
+    elapsed: `float`
+        Seconds spent on the exposure.
+    count: `int`, optional
+        Number of exposures finished; 0 for a stage that only adds time.
+    """
+    with _stats_lock:
+        entry = stats.setdefault(threading.current_thread().name, [0, 0, 0.0])
+        entry[0] += count
+        entry[1] += nbytes
+        entry[2] += elapsed
+
+
+def run_pipeline(
+    exposures: list[DimensionRecord],
+    instrument: str,
+    infos: dict[int, ExposureInfo],
+    stats: dict[str, list],
+) -> None:
+    """Process exposures in a pipeline of write, ingest, and register stages.
+
+    Each stage has its own workers, so that one exposure can be ingested
+    and registered while the next ones are being zipped.  Every stage adds
+    its time to its worker's throughput, but an exposure is only counted,
+    with its bytes, by the worker of the stage it finishes in.
+
+    Parameters
+    ----------
+    exposures: `list` [ `lsst.daf.butler.DimensionRecord` ]
+        The exposures to process.
+    instrument: `str`
+        The name of the instrument corresponding to the exposures.
+    infos: `dict` [ `int`, `ExposureInfo` ]
+        Registry information for each exposure, keyed by exposure id.
+    stats: `dict` [ `str`, `list` ]
+        Per-worker throughput accumulator.
+    """
+    # global config, logger, metrics
+
+    def _finish(exp: DimensionRecord, nbytes: int, elapsed: float, seconds: float) -> None:
+        _account(stats, nbytes, elapsed)
+        metrics.record("exposure", exp.obs_id, seconds, nbytes)
+
+    def _write(exp: DimensionRecord) -> ExposureJob | None:
+        start = time.monotonic()
+        job = write_exposure(exp, instrument, infos[exp.id])
+        elapsed = time.monotonic() - start
+        if job is None:
+            _finish(exp, 0, elapsed, elapsed)
+        else:
+            job.seconds = elapsed
+            _account(stats, 0, elapsed, count=0)
+        return job
+
+    def _ingest(job: ExposureJob) -> ExposureJob | None:
+        start = time.monotonic()
+        result = ingest_exposure(job)
+        elapsed = time.monotonic() - start
+        job.seconds += elapsed
+        if result is None:
+            _finish(job.exp, job.nbytes, elapsed, job.seconds)
+        else:
+            _account(stats, 0, elapsed, count=0)
+        return result
 
+    def _register(job: ExposureJob) -> None:
+        start = time.monotonic()
+        register_exposure(job)
+        elapsed = time.monotonic() - start
+        job.seconds += elapsed
+        _finish(job.exp, job.nbytes, elapsed, job.seconds)
 
-def process_exposure(exp: DimensionRecord, instrument: str) -> None:
+    stages = [
+        Stage("write", _write, config.jobs),
+        Stage("ingest", _ingest, config.ingest_jobs),
+        Stage("register", _register, config.register_jobs),
+    ]
+    Pipeline(stages, config.queue_size, logger).run(exposures)
+
+
+def _get_butlers() -> tuple[Butler, list[Butler]]:
+    """Return the source and destination Butlers for the current thread.
+
+    Butlers should not be shared between threads, so each worker thread
+    lazily gets its own clones of the global Butlers.
+
+    Returns
+    -------
+    butlers: `tuple` [ `Butler`, `list` [ `Butler` ] ]
+        Source Butler and destination Butlers.
+    """
+    # global source_butler, dest_butlers
+
+    if threading.current_thread() is threading.main_thread():
+        return source_butler, dest_butlers
+    if not hasattr(_worker_butlers, "source"):
+        _worker_butlers.source = source_butler.clone()
+        _worker_butlers.dest = [butler.clone() for butler in dest_butlers]
+    return _worker_butlers.source, _worker_butlers.dest
+
+
+def process_exposure(exp: DimensionRecord, instrument: str, info: ExposureInfo) -> int:
     """Process an exposure by zipping, ingesting, and registering it in Rucio.
 
     Parameters
@@ -473,8 +2105,44 @@ def process_exposure(exp: DimensionRecord, instrument: str) -> None:
         The exposure to process.
     instrument: `str`
         The name of the instrument corresponding to the exposure.
+    info: `ExposureInfo`
+        Registry information about the exposure.
+
+    Returns
+    -------
+    nbytes: `int`
+        Size of the zip file that was created, or 0 if none was.
+    """
+    job = write_exposure(exp, instrument, info)
+    if job is None:
+        return 0
+    if ingest_exposure(job) is not None:
+        register_exposure(job)
+    return job.nbytes
+
+
+def write_exposure(
+    exp: DimensionRecord, instrument: str, info: ExposureInfo
+) -> ExposureJob | None:
+    """Write the zip and dimensions files of an exposure at the destination.
+
+    Parameters
+    ----------
+    exp: `lsst.daf.butler.DimensionRecord`
+        The exposure to process.
+    instrument: `str`
+        The name of the instrument corresponding to the exposure.
+    info: `ExposureInfo`
+        Registry information about the exposure.
+
+    Returns
+    -------
+    job: `ExposureJob` or `None`
+        State for the later stages, or `None` if the exposure was skipped.
     """
-    # global logger, config, source_butler, dest_butlers, rucio_interface
+    # global logger, config, dest_listing, metrics, staging
+
+    source_butler, _ = _get_butlers()
 
     # Check several times (before each major step) for existence of the
     # result to avoid work in case of race conditions
@@ -483,240 +2151,850 @@ def process_exposure(exp: DimensionRecord, instrument: str) -> None:
         ResourcePath(config.dest_uri_prefix).join(instrument).join(f"{exp.day_obs}")
     )
     dest_path = dest_dir.join(zip_name)
-    if dest_path.exists() and not config.repair:
+    if not config.repair and dest_listing.exists(dest_path):
         logger.info("Zip exists, skipping processing: %s", dest_path)
-        return
-
-    # Map exposure to tracts
-    with source_butler.query() as q:
-        q = q.join_dimensions(["tract"]).where(
-            "visit = _exposure",
-            instrument=instrument,
-            skymap="lsst_cells_v1",
-            bind={"_exposure": exp.id},
-        )
-        tracts = {int(id["tract"]) for id in q.data_ids(["tract"])}
+        return None
 
-    # Find all SCIENCE datasets for this exposure and its source directory
-    science_refs = source_butler.query_datasets(
-        "raw",
-        exposure=exp.id,
-        instrument=instrument,
-        collections=f"{instrument}/raw/all",
-        explain=False,
-    )
-    if not science_refs:
+    # All SCIENCE and GUIDER datasets for this exposure
+    if not info.science_refs:
         logger.warning("No SCIENCE datasets for exposure %s", exp.obs_id)
-        return
-
-    # Find all GUIDER datasets for this exposure and its source directory
-    # If they exists:
-    try:
-        guider_refs = source_butler.query_datasets(
-            "guider_raw",
-            exposure=exp.id,
-            instrument=instrument,
-            collections=f"{instrument}/raw/guider",
-            explain=False,
-        )
-        if not guider_refs:
-            logger.warning("No GUIDER datasets for exposure %s", exp.obs_id)
-    except (_exceptions.MissingDatasetTypeError, _exceptions.MissingCollectionError):
+        return None
+    if not info.guider_refs:
         logger.warning("No GUIDER datasets for exposure %s", exp.obs_id)
-        guider_refs = []
 
-    refs = science_refs.copy()
-    refs.extend(guider_refs)
+    refs = info.science_refs.copy()
+    refs.extend(info.guider_refs)
 
     logger.info("Handling exposure: %s (%s)", exp.obs_id, len(refs))
 
     source_uri_dir = source_butler.getURI(refs[0]).dirname()
     logger.debug("Source directory: %s", source_uri_dir)
 
+    expected_refs = expected_ref_count(exp, source_uri_dir)
+    if expected_refs is not None and len(refs) < expected_refs:
+        logger.warning(
+            "Skipping incomplete exposure %s: %s < %s",
+            exp.obs_id,
+            len(refs),
+            expected_refs,
+        )
+        if config.defer_retries > 0:
+            with _deferred_lock:
+                _deferred.setdefault(instrument, {})[exp.id] = exp
+        return None
+
+    # Steps already completed, according to the ledger
+    steps = ledger.completed(instrument, exp.obs_id) if ledger is not None else set()
+    need_rucio = config.rucio_rse and not (
+        {TransferLedger.RUCIO_REGISTERED, TransferLedger.OBS_CLOSED} <= steps
+    )
+
+    nbytes = 0
+    hashes = dim_hashes = members_hashes = None
+    members = None
+    # Reserve staging space for the zip, unless it is not staged
+    staged_zip = not (config.repair and TransferLedger.ZIP_WRITTEN in steps) and not (
+        config.write_in_place and not config.dry_run and not config.repair
+    )
+    if staging.budgeted and staged_zip:
+        with time_this(logger, "Staging estimate"):
+            reservation = estimate_staging_size(source_butler, refs, source_uri_dir)
+    else:
+        reservation = _STAGING_OVERHEAD
+    # Make a zip file for this exposure
+    with staging.reserve(reservation) as tmpdir:
+        if config.repair and TransferLedger.ZIP_WRITTEN in steps:
+            # Repairs never reinstall the zip, so do not rebuild it
+            logger.info("Zip already written, not rebuilding: %s", dest_path)
+            if need_rucio:
+                hashes = RucioInterface.compute_hashes(dest_path.path)
+        else:
+            # Second race condition check
+            if not config.repair and dest_listing.exists(dest_path):
+                logger.info("Zip exists, not building zip: %s", dest_path)
+                return None
+
+            if config.write_in_place and not config.dry_run and not config.repair:
+                # The zip is written next to its destination and linked into
+                # place, so there is no copy to check
+                logger.info("Writing zip in place: %s", dest_path)
+                try:
+                    with time_this(logger, "Zip creation in place"), metrics.stage(
+                        "zip", exp.obs_id
+                    ) as timer:
+                        hashes, members = build_zip_in_place(
+                            source_butler, refs, source_uri_dir, dest_path
+                        )
+                        timer.nbytes = hashes[0]
+                except FileExistsError:
+                    dest_listing.add(dest_path)
+                    logger.info("Zip exists when installing: %s", dest_path)
+                    return None
+                nbytes = hashes[0]
+                dest_listing.add(dest_path)
+                _record_step(instrument, exp.obs_id, TransferLedger.ZIP_WRITTEN)
+            else:
+                zip_path = os.path.join(tmpdir, zip_name)
+                with time_this(logger, "Zip creation"), metrics.stage(
+                    "zip", exp.obs_id
+                ) as timer:
+                    zip_hashes, members = build_zip(
+                        source_butler, refs, source_uri_dir, zip_path, obs_id=exp.obs_id
+                    )
+                    timer.nbytes = zip_hashes[0]
+                after_creation_stat = os.stat(zip_path)
+                nbytes = after_creation_stat.st_size
+
+                # Use the Rucio hashes computed while the zip was written.
+                # This captures the state of the file just after creation, in
+                # case the transfer to its final destination is corrupted,
+                # without reading it back.  In repair mode, the installed file
+                # is re-read.
+                if need_rucio:
+                    if not config.repair:
+                        hashes = zip_hashes
+                        if hashes[0] != after_creation_stat.st_size:
+                            logger.error(
+                                f"File size mismatch for {zip_path}:"
+                                f" {after_creation_stat.st_size} written as {hashes[0]}"
+                            )
+                    else:
+                        hashes = RucioInterface.compute_hashes(dest_path.path)
+
+                # Final race condition check, refreshing the cached listing
+                if not config.repair and dest_listing.refresh(dest_path):
+                    logger.info("Zip exists, not installing: %s", dest_path)
+                    return None
+                # Copy to destination
+                logger.info("Installing zip in %s", dest_path)
+                with time_this(logger, "Installing zip"), metrics.stage(
+                    "install", exp.obs_id
+                ) as timer:
+                    if not config.dry_run and not config.repair:
+                        # The final race condition check is that installation
+                        # will not overwrite.
+                        try:
+                            before_copy_stat = os.stat(zip_path)
+                            if before_copy_stat.st_size != after_creation_stat.st_size:
+                                logger.error(
+                                    f"File size mismatch for {zip_path}:"
+                                    f" {after_creation_stat.st_size} is now"
+                                    f" {before_copy_stat.st_size} before copy"
+                                )
+                            install_zip(zip_path, dest_path)
+                            timer.nbytes = after_creation_stat.st_size
+                            dest_listing.add(dest_path)
+                            _record_step(instrument, exp.obs_id, TransferLedger.ZIP_WRITTEN)
+                            after_copy_stat = os.stat(dest_path.ospath)
+                            if after_copy_stat.st_size != after_creation_stat.st_size:
+                                logger.error(
+                                    f"File size mismatch for {zip_path}:"
+                                    f" {after_creation_stat.st_size} is now"
+                                    f" {after_copy_stat.st_size} after copy"
+                                )
+                        except FileExistsError:
+                            dest_listing.add(dest_path)
+                            logger.info("Zip exists when installing: %s", dest_path)
+                            return None
+
+        dimensions_dest = dest_dir.join(f"{exp.obs_id}_dimensions.yaml")
+        if config.repair and TransferLedger.DIMENSIONS_WRITTEN in steps:
+            logger.info("Dimensions already written: %s", dimensions_dest)
+            if need_rucio:
+                dim_hashes = RucioInterface.compute_hashes(dimensions_dest.path)
+        else:
+            logger.debug("exporting dimensions")
+            dimensions_file = os.path.join(tmpdir, "_dimensions.yaml")
+            with source_butler.export(filename=dimensions_file) as export:
+                export.saveDimensionData("exposure", [exp])
+                for dim in EXPORTED_ELEMENTS:
+                    recs = info.dimension_records.get(dim)
+                    if recs:
+                        logger.info("%s: %s", dim, recs)
+                        export.saveDimensionData(dim, recs)
+            with open(dimensions_file, "rb") as fd:
+                dimensions_data = fd.read()
+            logger.info("Saving exported dimensions in %s", dimensions_dest)
+            if not config.dry_run:
+                dimensions_dest.write(dimensions_data, overwrite=config.repair)
+                _record_step(
+                    instrument, exp.obs_id, TransferLedger.DIMENSIONS_WRITTEN
+                )
+            if need_rucio:
+                dim_hashes = HashingWriter.hash_bytes(dimensions_data)
+
+        if config.member_index:
+            members_dest = dest_dir.join(f"{exp.obs_id}_members.json")
+            if config.repair and TransferLedger.MEMBERS_WRITTEN in steps:
+                logger.info("Member index already written: %s", members_dest)
+                if need_rucio:
+                    members_hashes = RucioInterface.compute_hashes(members_dest.path)
+            else:
+                if members is None or config.repair:
+                    # Repairs never reinstall the zip, so any rebuilt one was
+                    # thrown away; index the installed one instead
+                    with dest_path.open("rb") as fd:
+                        members = read_member_index(fd)
+                members_data = json.dumps(
+                    {"zip": zip_name, "members": members}, separators=(",", ":")
+                ).encode()
+                logger.info("Saving member index in %s", members_dest)
+                if not config.dry_run:
+                    members_dest.write(members_data, overwrite=config.repair)
+                    _record_step(
+                        instrument, exp.obs_id, TransferLedger.MEMBERS_WRITTEN
+                    )
+                if need_rucio:
+                    members_hashes = HashingWriter.hash_bytes(members_data)
+
+        # Done with tmpdir
+
+    return ExposureJob(
+        exp=exp,
+        instrument=instrument,
+        info=info,
+        refs=refs,
+        dest_path=dest_path,
+        steps=steps,
+        need_rucio=need_rucio,
+        hashes=hashes,
+        dim_hashes=dim_hashes,
+        nbytes=nbytes,
+        members_hashes=members_hashes,
+    )
+
+
+def expected_ref_count(exp: DimensionRecord, source_uri_dir: ResourcePath) -> int | None:
+    """Return the number of datasets expected for an exposure.
+
+    The count is read from the exposure's ``_expectedSensors.json`` file
+    the first time it is needed and cached, so that rechecking a deferred
+    exposure does not read the file again.
+
+    Parameters
+    ----------
+    exp: `lsst.daf.butler.DimensionRecord`
+        The exposure.
+    source_uri_dir: `lsst.resources.ResourcePath`
+        Directory of the exposure's datasets in the source repo.
+
+    Returns
+    -------
+    count: `int` or `None`
+        Number of SCIENCE and GUIDER datasets expected, or `None` if there
+        is no expected sensors file.
+    """
+    with _deferred_lock:
+        if exp.obs_id in _expected_refs:
+            return _expected_refs[exp.obs_id]
     expected_sensors_path = ResourcePath(source_uri_dir).join(
         f"{exp.obs_id}_expectedSensors.json"
     )
-    if expected_sensors_path.exists():
-        with expected_sensors_path.open("rb") as fd:
-            expected_sensors = json.load(fd)["expectedSensors"]
-        expected_refs = len([t for t in expected_sensors.values() if t == "SCIENCE" or t == 'GUIDER'])
-        if len(refs) < expected_refs:
-            logger.warning(
-                "Skipping incomplete exposure %s: %s < %s",
+    if not expected_sensors_path.exists():
+        return None
+    with expected_sensors_path.open("rb") as fd:
+        expected_sensors = json.load(fd)["expectedSensors"]
+    count = len([t for t in expected_sensors.values() if t == "SCIENCE" or t == 'GUIDER'])
+    with _deferred_lock:
+        _expected_refs[exp.obs_id] = count
+    return count
+
+
+def process_deferred(instrument: str, stats: dict[str, list]) -> None:
+    """Recheck exposures that were skipped as incomplete, with backoff.
+
+    Exposures are only processed again once they have as many datasets as
+    their cached expected count.  The wait between rechecks starts at
+    ``--defer_backoff`` and doubles each time; exposures still incomplete
+    after ``--defer_retries`` rechecks are left for a later run.
+
+    Parameters
+    ----------
+    instrument: `str`
+        The name of the instrument whose deferred exposures are rechecked.
+    stats: `dict` [ `str`, `list` ]
+        Per-worker throughput accumulator.
+    """
+    # global config, logger
+
+    def _take() -> list[DimensionRecord]:
+        with _deferred_lock:
+            deferred = _deferred.pop(instrument, {})
+        return sorted(deferred.values(), key=lambda exp: exp.id)
+
+    def _defer(exposures: list[DimensionRecord]) -> None:
+        with _deferred_lock:
+            _deferred.setdefault(instrument, {}).update((exp.id, exp) for exp in exposures)
+
+    delay = config.defer_backoff.to_value("sec")
+    for attempt in range(config.defer_retries):
+        deferred = _take()
+        if not deferred:
+            return
+        logger.info(
+            "Rechecking %d incomplete %s exposures in %.0f s",
+            len(deferred),
+            instrument,
+            delay,
+        )
+        if _shutdown.wait(delay):
+            _defer(deferred)
+            break
+        exposure_ids = [exp.id for exp in deferred]
+        counts = {
+            exposure_id: len(refs)
+            for exposure_id, refs in query_refs(
+                "raw", f"{instrument}/raw/all", exposure_ids, instrument
+            ).items()
+        }
+        if has_guider_raws(instrument):
+            for exposure_id, refs in query_refs(
+                "guider_raw", f"{instrument}/raw/guider", exposure_ids, instrument
+            ).items():
+                counts[exposure_id] = counts.get(exposure_id, 0) + len(refs)
+
+        ready = []
+        waiting = []
+        for exp in deferred:
+            with _deferred_lock:
+                expected = _expected_refs.get(exp.obs_id)
+            if expected is None or counts.get(exp.id, 0) >= expected:
+                logger.info("Exposure %s is now complete", exp.obs_id)
+                ready.append(exp)
+            else:
+                waiting.append(exp)
+        _defer(waiting)
+        if ready:
+            transfer_exposures(ready, instrument, stats)
+        delay *= 2
+
+    deferred = _take()
+    if deferred:
+        logger.warning(
+            "Leaving %d incomplete exposures for a later run: %s",
+            len(deferred),
+            ", ".join(exp.obs_id for exp in deferred),
+        )
+
+
+def estimate_staging_size(
+    source_butler: Butler, refs: list[DatasetRef], source_uri_dir: ResourcePath
+) -> int:
+    """Estimate the staging space needed to zip an exposure.
+
+    FITS files are stored uncompressed, so the zip is no larger than the
+    files going into it plus their headers and alignment padding.  The
+    sizes of the raws come from the source datastore's records, so only the
+    other files in the directory, and any raws without a recorded size, are
+    looked up one at a time.
+
+    Parameters
+    ----------
+    source_butler: `lsst.daf.butler.Butler`
+        Butler holding the datasets.
+    refs: `list` [ `lsst.daf.butler.DatasetRef` ]
+        The raw datasets of the exposure.
+    source_uri_dir: `lsst.resources.ResourcePath`
+        Source directory, whose other files are also included.
+
+    Returns
+    -------
+    nbytes: `int`
+        Estimated bytes, including the dimensions file.
+    """
+    sources = {
+        uris.primaryURI.basename(): uris.primaryURI
+        for uris in source_butler.get_many_uris(refs).values()
+    }
+    for dirpath, dirnames, filenames in source_uri_dir.walk():
+        for f in filenames:
+            sources.setdefault(f, dirpath.join(f))
+    known = _recorded_sizes(source_butler, refs)
+    nbytes = sum(known[name] if name in known else uri.size() for name, uri in sources.items())
+    per_member = ALIGNMENT + 1024
+    return nbytes + per_member * len(sources) + _STAGING_OVERHEAD
+
+
+def _recorded_sizes(source_butler: Butler, refs: list[DatasetRef]) -> dict[str, int]:
+    """Return the file sizes recorded by the source datastore.
+
+    Parameters
+    ----------
+    source_butler: `lsst.daf.butler.Butler`
+        Butler holding the datasets.
+    refs: `list` [ `lsst.daf.butler.DatasetRef` ]
+        The datasets.
+
+    Returns
+    -------
+    sizes: `dict` [ `str`, `int` ]
+        Sizes in bytes, keyed by file name.  Empty if the records could not
+        be read.
+    """
+    # global logger
+
+    sizes: dict[str, int] = {}
+    # Butler has no public way to get the recorded sizes, which are read in
+    # one query.  This is only an estimate, so if the private datastore API
+    # changes, any error just falls back to looking up each size.
+    try:
+        exported = source_butler._datastore.export_records(refs)
+        for record_data in exported.values():
+            for tables in record_data.records.values():
+                for infos in tables.values():
+                    for info in infos:
+                        # Files ingested without a size have -1
+                        if info.file_size >= 0:
+                            sizes[info.path.rsplit("/", 1)[-1]] = info.file_size
+    except Exception as e:
+        logger.debug("No datastore records for file sizes: %s", e)
+        return {}
+    return sizes
+
+
+def ingest_exposure(job: ExposureJob) -> ExposureJob | None:
+    """Ingest the zip of an exposure into the destination repos.
+
+    If the zip could not be ingested into every repo, the exposure is not
+    registered in Rucio.  With a ledger, the repos that succeeded are
+    recorded and the rest are left for ``--repair``; without one, the
+    failure is raised, since nothing else would record it.
+
+    Parameters
+    ----------
+    job: `ExposureJob`
+        State of the exposure.
+
+    Returns
+    -------
+    job: `ExposureJob` or `None`
+        The same state, for the next stage, or `None` if the ingest failed.
+
+    Raises
+    ------
+    IngestError
+        Raised if the ingest failed and there is no ledger.
+    """
+    # global logger, config, ledger, metrics
+
+    source_butler, dest_butlers = _get_butlers()
+    exp, steps, dest_path = job.exp, job.steps, job.dest_path
+
+    # Repairs only ingest zips that the ledger shows were written but never
+    # ingested; otherwise, ingest into every destination.
+    ingest_repos = [
+        (repo, dest_butler)
+        for repo, dest_butler in zip(config.torepo, dest_butlers)
+        if not config.repair
+        or (
+            TransferLedger.ZIP_WRITTEN in steps
+            and TransferLedger.ingested(repo) not in steps
+        )
+    ]
+    logger.info("Ingesting zip: %s", dest_path)
+    if not config.dry_run:
+        failures: dict[str, Exception] = {}
+        try:
+            with time_this(logger, "Ingesting zip"), metrics.stage("ingest", exp.obs_id):
+                ingest_into_repos(ingest_repos, source_butler, job.refs, dest_path)
+        except IngestError as e:
+            if ledger is None:
+                raise
+            failures = e.failures
+        for repo, dest_butler in ingest_repos:
+            if repo not in failures:
+                _record_step(job.instrument, exp.obs_id, TransferLedger.ingested(repo))
+        if failures:
+            logger.error(
+                "Not registering %s after failed ingests; rerun with --repair",
                 exp.obs_id,
-                len(refs),
-                expected_refs,
             )
-            return
+            return None
+    return job
 
-    # Make a zip file for this exposure
-    with tempfile.TemporaryDirectory() as tmpdir:
-        prepdir = os.path.join(tmpdir, "inputs")
-        os.mkdir(prepdir)
-        os.chdir(prepdir)
-        # Second race condition check
-        if dest_path.exists() and not config.repair:
-            logger.info("Zip exists, not retrieving datasets: %s", dest_path)
-            return
 
-        # Get the raw datasets
-        with time_this(logger, "Artifact retrieval"):
-            logger.debug("Retrieving artifacts")
-            retrieved = source_butler.retrieveArtifacts(
-                refs, destination=prepdir, preserve_path=False
+def register_exposure(job: ExposureJob) -> None:
+    """Register the files of an exposure in Rucio, if so configured.
+
+    Parameters
+    ----------
+    job: `ExposureJob`
+        State of the exposure.
+    """
+    # global logger, config, rucio_interface, metrics
+
+    exp, instrument, info, steps = job.exp, job.instrument, job.info, job.steps
+    hashes, dim_hashes = job.hashes, job.dim_hashes
+    zip_name = job.dest_path.basename()
+    members_name = f"{instrument}/{exp.day_obs}/{exp.obs_id}_members.json"
+    if job.need_rucio and config.rucio_batch:
+        logger.info("Queueing zip and dimensions for Rucio registration")
+        with _registrations_lock:
+            _pending_registrations.append(
+                (
+                    f"{instrument}/{exp.day_obs}/{zip_name}",
+                    hashes,
+                    info.tracts,
+                    False,
+                )
+            )
+            if job.members_hashes is not None:
+                _pending_registrations.append(
+                    (members_name, job.members_hashes, info.tracts, False)
+                )
+            _pending_registrations.append(
+                (
+                    f"{instrument}/{exp.day_obs}/{exp.obs_id}_dimensions.yaml",
+                    dim_hashes,
+                    info.tracts,
+                    True,
+                )
             )
+    elif job.need_rucio:
+        logger.info("Registering zip in Rucio")
+        with time_this(logger, "Registering in Rucio"), metrics.stage(
+            "register", exp.obs_id
+        ):
+            dimensions_name = f"{instrument}/{exp.day_obs}/{exp.obs_id}_dimensions.yaml"
+            if TransferLedger.RUCIO_REGISTERED not in steps:
+                rucio_interface.register(
+                    f"{instrument}/{exp.day_obs}/{zip_name}",
+                    hashes,
+                    info.tracts,
+                    dry_run=config.dry_run,
+                )
+                if job.members_hashes is not None:
+                    logger.info("Registering member index in Rucio")
+                    rucio_interface.register(
+                        members_name,
+                        job.members_hashes,
+                        info.tracts,
+                        dry_run=config.dry_run,
+                    )
+                logger.info("Registering dimensions in Rucio")
+                rucio_interface.register(
+                    dimensions_name,
+                    dim_hashes,
+                    info.tracts,
+                    dry_run=config.dry_run,
+                )
+                _record_step(
+                    instrument, exp.obs_id, TransferLedger.RUCIO_REGISTERED
+                )
+            rucio_interface.finish(dimensions_name, dry_run=config.dry_run)
+            _record_step(instrument, exp.obs_id, TransferLedger.OBS_CLOSED)
+
 
-        # Generate the index
-        _index, okay, failed = index_files(
-            [f.basename() for f in retrieved],
-            "",
-            -1,
-            False,
-            "metadata",
+def build_zip(
+    source_butler: Butler,
+    refs: list[DatasetRef],
+    source_uri_dir: ResourcePath,
+    zip_path: str,
+    *,
+    obs_id: str,
+    fsync: bool = False,
+) -> tuple[tuple[int, str, str], dict[str, dict[str, Any]]]:
+    """Stream the files of an exposure into a zip file.
+
+    Parameters
+    ----------
+    source_butler: `lsst.daf.butler.Butler`
+        Butler holding the datasets.
+    refs: `list` [ `lsst.daf.butler.DatasetRef` ]
+        The raw datasets of the exposure.
+    source_uri_dir: `lsst.resources.ResourcePath`
+        Source directory, whose other files are also included.
+    zip_path: `str`
+        Path of the zip file to write.  It must not already exist.
+    obs_id: `str`
+        Observation id of the exposure, for the metrics.
+    fsync: `bool`
+        If true, sync the zip file to storage before returning.
+
+    Returns
+    -------
+    hashes: `tuple` [ `int`, `str`, `str` ]
+        Size in bytes, MD5 hex, and Adler32 hex hashes of the zip file.
+    members: `dict` [ `str`, `dict` ]
+        Location of the data of each member of the zip, keyed by name.
+    """
+    # global logger, index_pool, metrics
+
+    # Locate the raw datasets and the other files in their directory
+    sources = {
+        uris.primaryURI.basename(): uris.primaryURI
+        for uris in source_butler.get_many_uris(refs).values()
+    }
+    dataset_names = sorted(sources)
+    for dirpath, dirnames, filenames in source_uri_dir.walk():
+        for f in filenames:
+            if f not in sources:
+                sources[f] = dirpath.join(f)
+    logger.debug("Also zipping %s", sorted(sources.keys() - set(dataset_names)))
+
+    # Generate the index from the source headers
+    with time_this(logger, "Header indexing"), metrics.stage("index", obs_id):
+        _index, okay, failed = index_headers(
+            {
+                name: uri.ospath if uri.isLocal else str(uri)
+                for name, uri in sources.items()
+                if name in dataset_names
+            },
+            index_pool,
         )
-        logger.debug("indexed")
-        # ingest-raws needs to be changed to understand this change from
-        # the default of _index.json.
-        with open("_metadata_index.json", "w") as fd:
-            json.dump(_index, fd)
-        logger.debug("index written")
-
-        # Transfer non-dataset files
-        transfer_list = []
-        for dirpath, dirnames, filenames in source_uri_dir.walk():
-            for f in filenames:
-                if not os.path.exists(f):
-                    transfer_list.append((dirpath.join(f), ResourcePath(f)))
-        # Third race condition check
-        if dest_path.exists() and not config.repair:
-            logger.info("Zip exists, not copying others: %s", dest_path)
-            return
-        logger.debug("Also copying %s", [t[0] for t in transfer_list])
-        ResourcePath.mtransfer("copy", transfer_list)
-
-        # Zip everything.
-        with time_this(logger, "Zip creation"):
-            zip_path = os.path.join(tmpdir, zip_name)
-            logger.debug("Writing to %s", zip_path)
-            with zipfile.ZipFile(zip_path, "w") as zip_file:
-                for f in os.listdir():
-                    logger.debug("adding %s", f)
-                    if f.endswith(".fits"):
-                        zip_file.write(f, f, compress_type=zipfile.ZIP_STORED)
-                    else:
-                        zip_file.write(f, f, compress_type=zipfile.ZIP_DEFLATED)
-        after_creation_stat = os.stat(zip_path)
-
-        # Compute the Rucio hashes
-        # We do this here rather than internally in RucioInterface so that we
-        # can take advantage of the OS cache since we just wrote the file and
-        # also so that we capture the state of the file just after creation,
-        # in case the transfer to its final destination is corrupted.
-        if config.rucio_rse:
-            if not config.repair:
-                hashes = RucioInterface.compute_hashes(zip_path)
-                if hashes[0] != after_creation_stat.st_size:
-                    logger.error(
-                        f"File size mismatch for {zip_path}:"
-                        f" {after_creation_stat.st_size} reads as {hashes[0]}"
-                    )
-            else:
-                hashes = RucioInterface.compute_hashes(dest_path.path)
+    logger.info("Indexed %d of %d headers", len(okay), len(dataset_names))
+    if failed:
+        logger.warning("Unable to read headers, not indexed: %s", failed)
+
+    # Stream everything into the zip.
+    logger.debug("Writing to %s", zip_path)
+    with open(zip_path, "xb") as fd:
+        zip_writer = HashingWriter(fd)
+        with ZipBuilder(zip_writer) as zip_builder:
+            for name, uri in sources.items():
+                logger.debug("adding %s", name)
+                zip_builder.add(name, uri)
+            # ingest-raws needs to be changed to understand this change from
+            # the default of _index.json.
+            zip_builder.add_bytes("_metadata_index.json", json.dumps(_index).encode())
+        if fsync:
+            fd.flush()
+            os.fsync(fd.fileno())
+    return zip_writer.hashes, zip_builder.member_index()
+
+
+def sweep_stale_tmp(dest_dir: str) -> None:
+    """Remove temporary zips left in a destination directory by crashes.
+
+    Each directory is only swept once per process.  Only files older than
+    ``_STALE_TMP_AGE`` are removed, so that zips still being written by
+    other runs are left alone.
+
+    Parameters
+    ----------
+    dest_dir: `str`
+        Local destination directory.
+    """
+    # global logger
 
-        # Fourth race condition check
-        if dest_path.exists() and not config.repair:
-            logger.info("Zip exists, not installing: %s", dest_path)
+    with _swept_lock:
+        if dest_dir in _swept_dirs:
             return
-        # Copy to destination
-        logger.info("Installing zip in %s", dest_path)
-        with time_this(logger, "Installing zip"):
-            if not config.dry_run and not config.repair:
-                # The final race condition check is that transfer_from()
-                # will not overwrite.
+        _swept_dirs.add(dest_dir)
+    cutoff = time.time() - _STALE_TMP_AGE
+    with os.scandir(dest_dir) as entries:
+        for entry in entries:
+            if not fnmatch.fnmatch(entry.name, ".*.zip.*.tmp"):
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+                    continue
+                logger.warning("Removing stale temporary file %s", entry.path)
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def build_zip_in_place(
+    source_butler: Butler,
+    refs: list[DatasetRef],
+    source_uri_dir: ResourcePath,
+    dest_path: ResourcePath,
+) -> tuple[tuple[int, str, str], dict[str, dict[str, Any]]]:
+    """Stream the files of an exposure into a zip file at its destination.
+
+    The zip is written under a hidden temporary name in the destination
+    directory, synced, and then hardlinked to its final name, which is
+    atomic and, unlike a rename, never replaces an existing file.  The
+    temporary file is removed afterwards, and ones left behind by crashes
+    are removed by `sweep_stale_tmp`.
+
+    Parameters
+    ----------
+    source_butler: `lsst.daf.butler.Butler`
+        Butler holding the datasets.
+    refs: `list` [ `lsst.daf.butler.DatasetRef` ]
+        The raw datasets of the exposure.
+    source_uri_dir: `lsst.resources.ResourcePath`
+        Source directory, whose other files are also included.
+    dest_path: `lsst.resources.ResourcePath`
+        Local destination of the zip file.
+
+    Returns
+    -------
+    hashes: `tuple` [ `int`, `str`, `str` ]
+        Size in bytes, MD5 hex, and Adler32 hex hashes of the zip file.
+    members: `dict` [ `str`, `dict` ]
+        Location of the data of each member of the zip, keyed by name.
+
+    Raises
+    ------
+    FileExistsError
+        Raised if the destination already exists.
+    """
+    dest_dir = dest_path.dirname()
+    dest_dir.mkdir()
+    sweep_stale_tmp(dest_dir.ospath)
+    tmp_path = os.path.join(
+        dest_dir.ospath, f".{dest_path.basename()}.{secrets.token_hex(8)}.tmp"
+    )
+    try:
+        hashes, members = build_zip(
+            source_butler,
+            refs,
+            source_uri_dir,
+            tmp_path,
+            obs_id=dest_path.basename().removesuffix(".zip"),
+            fsync=True,
+        )
+        os.link(tmp_path, dest_path.ospath)
+    finally:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+    # Make the new name durable
+    dir_fd = os.open(dest_dir.ospath, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return hashes, members
+
+
+def install_zip(zip_path: str, dest_path: ResourcePath) -> None:
+    """Install a zip file at its destination without overwriting.
+
+    Local destinations are hardlinked or reflinked when the filesystem
+    allows it, so that the bytes are only copied when necessary.
+
+    Parameters
+    ----------
+    zip_path: `str`
+        Local path of the zip file.
+    dest_path: `lsst.resources.ResourcePath`
+        Destination of the zip file.
+
+    Raises
+    ------
+    FileExistsError
+        Raised if the destination already exists.
+    """
+    # global logger
+
+    if dest_path.isLocal:
+        dest_path.dirname().mkdir()
+        method = install_file(zip_path, dest_path.ospath)
+    else:
+        dest_path.transfer_from(ResourcePath(zip_path), "copy")
+        method = "transfer_from"
+    logger.info("Installed %s by %s", dest_path, method)
+
+
+def ingest_into_repos(
+    repos: list[tuple[str, Butler]],
+    source_butler: Butler,
+    refs: list[DatasetRef],
+    dest_path: ResourcePath,
+) -> None:
+    """Ingest a zip into several destination repos concurrently.
+
+    Each repo gets its own worker, so a slow or unavailable repo does not
+    hold up the others.  Failures are logged, and raised together once
+    every repo has finished.
+
+    Parameters
+    ----------
+    repos: `list` [ `tuple` [ `str`, `lsst.daf.butler.Butler` ] ]
+        Destination repos and writeable Butlers for them.
+    source_butler: `lsst.daf.butler.Butler`
+        Butler to transfer the dimension records from.
+    refs: `list` [ `lsst.daf.butler.DatasetRef` ]
+        The raw datasets of the exposure.
+    dest_path: `lsst.resources.ResourcePath`
+        The installed zip file.
+
+    Raises
+    ------
+    IngestError
+        Raised if the zip could not be ingested into some of the repos.
+    """
+    # global logger
+
+    def _ingest(repo: str, dest_butler: Butler, source: Butler) -> None:
+        start = time.monotonic()
+        dest_butler.transfer_dimension_records_from(source, refs)
+        dest_butler.ingest_zip(dest_path, transfer="direct")
+        logger.info(
+            "Ingested %s into %s in %.1f s",
+            dest_path.basename(),
+            repo,
+            time.monotonic() - start,
+        )
+
+    failures: dict[str, Exception] = {}
+    if len(repos) == 1:
+        repo, dest_butler = repos[0]
+        try:
+            _ingest(repo, dest_butler, source_butler)
+        except Exception as e:
+            failures[repo] = e
+    elif repos:
+        # Butlers are not thread-safe, so each worker reads its own clone
+        # of the source; each destination Butler is only used by its worker
+        with ThreadPoolExecutor(
+            max_workers=len(repos), thread_name_prefix="ingest"
+        ) as pool:
+            futures = {
+                pool.submit(_ingest, repo, dest_butler, source_butler.clone()): repo
+                for repo, dest_butler in repos
+            }
+            for future in as_completed(futures):
                 try:
-                    before_copy_stat = os.stat(zip_path)
-                    if before_copy_stat.st_size != after_creation_stat.st_size:
-                        logger.error(
-                            f"File size mismatch for {zip_path}:"
-                            f" {after_creation_stat.st_size} is now"
-                            f" {before_copy_stat.st_size} before copy"
-                        )
-                    dest_path.transfer_from(ResourcePath(zip_path), "copy")
-                    after_copy_stat = os.stat(dest_path.ospath)
-                    if after_copy_stat.st_size != after_creation_stat.st_size:
-                        logger.error(
-                            f"File size mismatch for {zip_path}:"
-                            f" {after_creation_stat.st_size} is now"
-                            f" {after_copy_stat.st_size} after copy"
-                        )
-                except FileExistsError:
-                    logger.info("Zip exists in transfer_from: %s", dest_path)
-                    return
-
-        logger.debug("exporting dimensions")
-        dimensions_file = os.path.join(tmpdir, "_dimensions.yaml")
-        with source_butler.export(filename=dimensions_file) as export:
-            export.saveDimensionData("exposure", [exp])
-            dims = [
-                "day_obs",
-                "group",
-                "visit",
-                "visit_definition",
-                "visit_detector_region",
-                "visit_system",
-                "visit_system_membership",
-            ]
-            for dim in dims:
-                recs = source_butler.query_dimension_records(
-                    dim,
-                    exposure=exp.id,
-                    limit=None,
-                    instrument=instrument,
-                    explain=False,
-                )
-                if recs:
-                    logger.info("%s: %s", dim, recs)
-                    export.saveDimensionData(dim, recs)
-        dimensions_dest = dest_dir.join(f"{exp.obs_id}_dimensions.yaml")
-        logger.info("Saving exported dimensions in %s", dimensions_dest)
-        if not config.dry_run:
-            if not config.repair:
-                dimensions_dest.transfer_from(ResourcePath(dimensions_file), "copy")
-            else:
-                dimensions_dest.transfer_from(ResourcePath(dimensions_file), "copy", overwrite=True)
-        if config.rucio_rse:
-            dim_hashes = RucioInterface.compute_hashes(dimensions_file)
+                    future.result()
+                except Exception as e:
+                    failures[futures[future]] = e
+    for repo, e in failures.items():
+        logger.error("Failed to ingest %s into %s: %s", dest_path, repo, e)
+    if failures:
+        raise IngestError(dest_path, failures) from next(iter(failures.values()))
 
-        # Done with tmpdir
 
-    logger.info("Transferring dimension records to destination Butler repo")
-    if not config.dry_run and not config.repair:
-        for dest_butler in dest_butlers:
-            dest_butler.transfer_dimension_records_from(source_butler, refs)
+def _record_step(instrument: str, obs_id: str, step: str) -> None:
+    """Record a completed step in the ledger, if there is one.
 
-    logger.info("Ingesting zip: %s", dest_path)
-    if not config.dry_run and not config.repair:
-        with time_this(logger, "Ingesting zip"):
-            for dest_butler in dest_butlers:
-                dest_butler.ingest_zip(dest_path, transfer="direct")
+    Parameters
+    ----------
+    instrument: `str`
+        Name of the instrument.
+    obs_id: `str`
+        Observation id of the exposure.
+    step: `str`
+        Name of the step.
+    """
+    # global config, ledger
+
+    if ledger is not None and not config.dry_run:
+        ledger.record(instrument, obs_id, step)
 
+
+def required_steps() -> set[str]:
+    """Return the ledger steps that complete an exposure's transfer.
+
+    Returns
+    -------
+    steps: `set` [ `str` ]
+        Names of the steps.
+    """
+    # global config
+
+    steps = {TransferLedger.ZIP_WRITTEN, TransferLedger.DIMENSIONS_WRITTEN}
+    steps.update(TransferLedger.ingested(repo) for repo in config.torepo)
+    if config.member_index:
+        steps.add(TransferLedger.MEMBERS_WRITTEN)
     if config.rucio_rse:
-        logger.info("Registering zip in Rucio")
-        with time_this(logger, "Registering in Rucio"):
-            rucio_interface.register(
-                f"{instrument}/{exp.day_obs}/{zip_name}",
-                hashes,
-                tracts,
-                dry_run=config.dry_run,
-            )
-            logger.info("Registering dimensions in Rucio")
-            rucio_interface.register(
-                f"{instrument}/{exp.day_obs}/{exp.obs_id}_dimensions.yaml",
-                dim_hashes,
-                tracts,
-                finish=True,
-                dry_run=config.dry_run,
-            )
+        steps.update({TransferLedger.RUCIO_REGISTERED, TransferLedger.OBS_CLOSED})
+    return steps
 
 
 # Global variables
@@ -726,11 +3004,27 @@ logger: logging.Logger = None
 source_butler: Butler = None
 dest_butlers: list[Butler] = None
 rucio_interface: RucioInterface = None
+dest_listing: DestinationListing = None
+ledger: TransferLedger = None
+index_pool: ProcessPoolExecutor = None
+staging: StagingManager = None
+metrics: TransferMetrics = None
+_worker_butlers = threading.local()
+_pending_registrations: list[tuple[str, tuple[int, str, str], set[int], bool]] = []
+_registrations_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_deferred: dict[str, dict[int, DimensionRecord]] = {}
+_expected_refs: dict[str, int] = {}
+_deferred_lock = threading.Lock()
+_shutdown = threading.Event()
+_swept_dirs: set[str] = set()
+_swept_lock = threading.Lock()
 
 
 def initialize():
     """Set up the global variables."""
     global config, source_butler, dest_butlers, logger, rucio_interface
+    global dest_listing, ledger, index_pool, metrics, staging
 
     config = parse_args()
 
@@ -752,14 +3046,102 @@ def initialize():
 
     source_butler = Butler(config.fromrepo, skymap="lsst_cells_v1")
     dest_butlers = [Butler(repo, writeable=True) for repo in config.torepo]
-
-    if config.rucio_rse:
+    dest_listing = DestinationListing()
+    metrics = TransferMetrics()
+    staging = StagingManager(
+        budget=int(config.staging_budget * 1e9) if config.staging_budget else None,
+        directory=config.staging_dir,
+        fast_directory=config.fast_staging_dir,
+        fast_budget=int(config.fast_staging_budget * 1e9),
+        logger=logger,
+    )
+    if config.ledger:
+        ledger = TransferLedger(config.ledger)
+    if config.index_jobs > 1:
+        index_pool = make_index_pool(config.index_jobs)
+
+    if config.rucio_rse and config.fake_rucio is not None:
+        # Only for testing, so not shipped in the container image
+        from fake_rucio import FakeRucio
+
+        fake = FakeRucio.from_spec(config.fake_rucio)
+        logger.warning("Registering in a fake Rucio: %s", config.fake_rucio)
+        rucio_interface = RucioInterface(
+            config.rucio_rse, config.scope, fake.replica_client, fake.did_client
+        )
+    elif config.rucio_rse:
         rucio_interface = RucioInterface(config.rucio_rse, config.scope)
 
 
+def transfer_all(data_queries: list[DataQuery]) -> None:
+    """Transfer the exposures matching each data query once.
+
+    Parameters
+    ----------
+    data_queries: `list` [ `DataQuery` ]
+        The queries and associated embargo times.
+    """
+    # global config, logger, metrics
+
+    metrics.start_run()
+    try:
+        if config.prioritize:
+            transfer_prioritized(data_queries)
+        else:
+            for data_query in data_queries:
+                logger.info("Processing %s", data_query)
+                transfer_data_query(data_query)
+    finally:
+        if config.metrics_json:
+            metrics.write_json(config.metrics_json)
+        if config.metrics_prom:
+            metrics.write_prometheus(config.metrics_prom)
+
+
+def run_daemon(data_queries: list[DataQuery]) -> None:
+    """Transfer the exposures matching each data query repeatedly.
+
+    The Butlers and Rucio clients created by `initialize` are reused for
+    every poll, while the query windows are recomputed from the current
+    time.  A failed poll is logged and retried at the next one.  SIGTERM
+    or SIGINT stops the daemon after the current poll.
+
+    Parameters
+    ----------
+    data_queries: `list` [ `DataQuery` ]
+        The queries and associated embargo times.
+    """
+    # global config, logger, dest_listing
+
+    def _stop(signum: int, frame: Any) -> None:
+        logger.info("Received signal %d, stopping after this poll", signum)
+        _shutdown.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    interval = config.poll_interval.to_value("sec")
+    while not _shutdown.is_set():
+        start = time.monotonic()
+        config.now = Time.now()
+        # Other writers may have changed the destination and the source
+        # registry since the last poll
+        dest_listing.clear()
+        has_guider_raws.cache_clear()
+        with _deferred_lock:
+            _expected_refs.clear()
+        logger.info("Polling at %s", config.now.isot)
+        try:
+            transfer_all(data_queries)
+        except Exception:
+            logger.exception("Poll failed, retrying at the next one")
+        _shutdown.wait(max(0.0, interval - (time.monotonic() - start)))
+    logger.info("Daemon stopped")
+
+
 def main():
     """Main function."""
-    # global config, logger
+    # global config, logger, index_pool, rucio_interface, staging
     initialize()
 
     with open(config.config_file, "r") as f:
@@ -772,9 +3154,18 @@ def main():
         ):
             raise ValueError(f"Invalid data query for raws: {query}")
 
-    for data_query in data_queries:
-        logger.info("Processing %s", data_query)
-        transfer_data_query(data_query)
+    try:
+        if config.daemon:
+            run_daemon(data_queries)
+        else:
+            transfer_all(data_queries)
+    finally:
+        if index_pool is not None:
+            index_pool.shutdown(cancel_futures=True)
+        if config.fake_rucio is not None:
+            logger.info("Fake Rucio: %s", rucio_interface.did_client.backend.stats())
+        if staging.budgeted:
+            logger.info("Staging: %s", staging.stats())
 
 
 if __name__ == "__main__":
@@ -8,6 +8,7 @@
 # WINDOW = time window to scan for eligible files, previous to $NOW, as "NNmin" or "NNhr"
 # DEST = destination directory for raw zips
 # RUCIO = (optional) arguments for Rucio RSE and scope
+# OPTIONS = (optional) additional arguments, e.g. "--jobs 4" or "--daemon"
 # FROMREPO = source Butler repo
 # TOREPO = destination Butler repo
 
@@ -24,7 +25,7 @@ export SHELL=/bin/bash
 source /opt/lsst/software/stack/loadLSST.sh
 setup lsst_distrib
 # DRY_RUN and NOW may be empty, so do not quote them.
-# RUCIO may hold multiple options, so do not quote it.
+# RUCIO and OPTIONS may hold multiple options, so do not quote them.
 echo python "$SWDIR"/transfer_raw_zip.py \
     $DRY_RUN \
     $NOW \
@@ -32,6 +33,7 @@ echo python "$SWDIR"/transfer_raw_zip.py \
     --window "$WINDOW" \
     -d "$DEST" \
     $RUCIO \
+    $OPTIONS \
     "$FROMREPO" "$TOREPO"
 python "$SWDIR"/transfer_raw_zip.py \
     $DRY_RUN \
@@ -40,6 +42,7 @@ python "$SWDIR"/transfer_raw_zip.py \
     --window "$WINDOW" \
     -d "$DEST" \
     $RUCIO \
+    $OPTIONS \
     "$FROMREPO" "$TOREPO" \
     2>&1 |
     if [ -d "$LOGDIR" ]; then
@@ -0,0 +1,314 @@
+# This file is part of transfer_embargo
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ["HashingWriter", "ZipBuilder", "read_member_index"]
+
+import hashlib
+import io
+import shutil
+import struct
+import time
+import zipfile
+import zlib
+from typing import Any, BinaryIO, Self
+
+CHUNK_SIZE = 10 * 1024 * 1024
+
+ALIGNMENT = 4096
+"""Boundary on which the data of STORED members start, in bytes."""
+
+_ALIGNMENT_EXTRA_ID = 0xD935
+"""Extra field ID used by zipalign for padding to an alignment."""
+
+
+class HashingWriter(io.RawIOBase):
+    """Write-only stream that computes Rucio hashes of everything written.
+
+    The size, MD5, and Adler32 are updated as bytes go out, so they are
+    available without reading the file back.  The stream is deliberately
+    not seekable: `zipfile` then writes each member's sizes and CRC in a
+    trailing data descriptor rather than seeking back to rewrite its
+    header, so every byte passes through exactly once, in order.
+
+    Parameters
+    ----------
+    fileobj: `typing.BinaryIO`, optional
+        File object to pass the data on to.  If not given, the data are
+        only hashed.
+    """
+
+    def __init__(self, fileobj: BinaryIO | None = None):
+        self._fileobj = fileobj
+        self._size = 0
+        self._md5 = hashlib.md5()
+        self._adler32 = zlib.adler32(b"")
+
+    @classmethod
+    def hash_bytes(cls, data: bytes) -> tuple[int, str, str]:
+        """Compute the length, MD5, and Adler32 hashes for in-memory data.
+
+        Parameters
+        ----------
+        data: `bytes`
+            Data to hash.
+
+        Returns
+        -------
+        hashes: `tuple` [ `int`, `str`, `str` ]
+            Size in bytes, MD5 hex, and Adler32 hex hashes.
+        """
+        writer = cls()
+        writer.write(data)
+        return writer.hashes
+
+    @property
+    def hashes(self) -> tuple[int, str, str]:
+        """Size in bytes, MD5 hex, and Adler32 hex hashes of the data
+        written so far (`tuple` [ `int`, `str`, `str` ]).
+        """
+        return (self._size, self._md5.hexdigest(), f"{self._adler32:08x}")
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self._size
+
+    def write(self, data: Any) -> int:
+        if self._fileobj is not None:
+            self._fileobj.write(data)
+        self._md5.update(data)
+        self._adler32 = zlib.adler32(data, self._adler32)
+        nbytes = memoryview(data).nbytes
+        self._size += nbytes
+        return nbytes
+
+    def flush(self) -> None:
+        if self._fileobj is not None:
+            self._fileobj.flush()
+
+
+class ZipBuilder:
+    """Build a zip file by streaming each member from its source.
+
+    Members are copied directly from their sources into the zip, so they
+    never need to be staged on local disk first.  FITS files are STORED so
+    that they can be read directly from the zip; everything else is
+    DEFLATED.
+
+    The local header of each STORED member is padded with a zipalign-style
+    extra field so that the member's data start on an ``alignment``
+    boundary, letting readers mmap or range-read them with page-aligned
+    I/O.  The padding is left out of the central directory, so it does not
+    grow, and the zip remains standard.
+
+    The location of each member's data is recorded as it is written, so
+    that an index allowing single-request reads of members can be made
+    without reading the zip back.
+
+    Parameters
+    ----------
+    fileobj: `typing.BinaryIO`
+        Writable binary file object that receives the zip data.
+    alignment: `int`
+        Boundary in bytes for the data of STORED members; 1 for none.
+    """
+
+    def __init__(self, fileobj: BinaryIO, alignment: int = ALIGNMENT):
+        self._zip = zipfile.ZipFile(fileobj, "w")
+        self._alignment = alignment
+        self._members: dict[str, dict[str, Any]] = {}
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    @staticmethod
+    def _make_info(name: str) -> zipfile.ZipInfo:
+        """Make a zip member description with the compression for its type.
+
+        Parameters
+        ----------
+        name: `str`
+            Name of the member in the zip.
+
+        Returns
+        -------
+        zinfo: `zipfile.ZipInfo`
+            Member description.
+        """
+        zinfo = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        zinfo.external_attr = 0o644 << 16
+        if name.endswith(".fits"):
+            zinfo.compress_type = zipfile.ZIP_STORED
+        else:
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+        return zinfo
+
+    def _align(self, zinfo: zipfile.ZipInfo) -> None:
+        """Pad a STORED member's local header so its data are aligned.
+
+        Parameters
+        ----------
+        zinfo: `zipfile.ZipInfo`
+            Description of the member about to be written.
+        """
+        if zinfo.compress_type != zipfile.ZIP_STORED or self._alignment <= 1:
+            return
+        # Local header: fixed part, name, existing extra fields, then ours
+        # with its ID, size, and alignment
+        data_start = (
+            self._zip.fp.tell()
+            + zipfile.sizeFileHeader
+            + len(zinfo.filename.encode("utf-8"))
+            + len(zinfo.extra)
+            + 6
+        )
+        padding = -data_start % self._alignment
+        zinfo.extra += struct.pack(
+            "<HHH", _ALIGNMENT_EXTRA_ID, 2 + padding, self._alignment
+        ) + bytes(padding)
+
+    def add(self, name: str, source: Any) -> None:
+        """Stream a source into a new zip member.
+
+        Parameters
+        ----------
+        name: `str`
+            Name of the member in the zip.
+        source: `lsst.resources.ResourcePath` or `pathlib.Path`
+            Any object with an ``open("rb")`` method returning a binary
+            file object.
+        """
+        zinfo = self._make_info(name)
+        self._align(zinfo)
+        with source.open("rb") as src, self._zip.open(zinfo, "w") as dest:
+            shutil.copyfileobj(src, dest, CHUNK_SIZE)
+        self._finish(zinfo)
+
+    def add_bytes(self, name: str, data: bytes) -> None:
+        """Write in-memory data as a new zip member.
+
+        Parameters
+        ----------
+        name: `str`
+            Name of the member in the zip.
+        data: `bytes`
+            Contents of the member.
+        """
+        zinfo = self._make_info(name)
+        self._align(zinfo)
+        self._zip.writestr(zinfo, data)
+        self._finish(zinfo)
+
+    def _finish(self, zinfo: zipfile.ZipInfo) -> None:
+        """Record where a written member's data are and drop its padding.
+
+        Parameters
+        ----------
+        zinfo: `zipfile.ZipInfo`
+            Description of the member just written.
+        """
+        offset = (
+            zinfo.header_offset
+            + zipfile.sizeFileHeader
+            + len(zinfo.filename.encode("utf-8"))
+            + len(zinfo.extra)
+        )
+        self._members[zinfo.filename] = _member_entry(zinfo, offset)
+        # The padding is only needed in the local header
+        zinfo.extra = b""
+
+    def member_index(self) -> dict[str, dict[str, Any]]:
+        """Return the location of the data of each member written so far.
+
+        Returns
+        -------
+        members: `dict` [ `str`, `dict` ]
+            Offset of the data, compressed size, uncompressed size, CRC-32
+            as hex, and compression method of each member, keyed by name.
+        """
+        return dict(self._members)
+
+    def namelist(self) -> list[str]:
+        """Return the names of the members written so far."""
+        return self._zip.namelist()
+
+    def close(self) -> None:
+        """Write the central directory and close the zip."""
+        self._zip.close()
+
+
+def _member_entry(zinfo: zipfile.ZipInfo, offset: int) -> dict[str, Any]:
+    """Make the member index entry of a zip member.
+
+    Parameters
+    ----------
+    zinfo: `zipfile.ZipInfo`
+        Description of the member.
+    offset: `int`
+        Offset of the member's data in the zip.
+
+    Returns
+    -------
+    entry: `dict` [ `str`, `~typing.Any` ]
+        Offset, sizes, CRC-32, and compression method.
+    """
+    return {
+        "offset": offset,
+        "size": zinfo.compress_size,
+        "file_size": zinfo.file_size,
+        "crc": f"{zinfo.CRC:08x}",
+        "compress_type": zinfo.compress_type,
+    }
+
+
+def read_member_index(fileobj: BinaryIO) -> dict[str, dict[str, Any]]:
+    """Read the location of the data of each member of an existing zip.
+
+    This gives the same result as `ZipBuilder.member_index` for a zip
+    that it wrote, reading the central directory and each local header.
+
+    Parameters
+    ----------
+    fileobj: `typing.BinaryIO`
+        Seekable binary file object holding the zip.
+
+    Returns
+    -------
+    members: `dict` [ `str`, `dict` ]
+        Offset of the data, compressed size, uncompressed size, CRC-32 as
+        hex, and compression method of each member, keyed by name.
+    """
+    members = {}
+    with zipfile.ZipFile(fileobj) as zip_file:
+        for zinfo in zip_file.infolist():
+            fileobj.seek(zinfo.header_offset)
+            header = fileobj.read(zipfile.sizeFileHeader)
+            name_length, extra_length = struct.unpack("<HH", header[26:30])
+            offset = zinfo.header_offset + len(header) + name_length + extra_length
+            members[zinfo.filename] = _member_entry(zinfo, offset)
+    return members
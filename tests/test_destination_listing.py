@@ -0,0 +1,89 @@
+import logging
+import sys
+import threading
+import time
+import unittest
+from pathlib import Path
+
+TEST_DIR = Path(__file__).parent
+sys.path.insert(0, str(TEST_DIR.parent / "src"))
+
+import transfer_raw_zip  # noqa: E402
+from transfer_raw_zip import DestinationListing  # noqa: E402
+
+
+class SlowDirectory:
+    """Directory whose listing takes a while and is counted."""
+
+    def __init__(self, name, filenames, delay=0.2):
+        self.name = name
+        self.filenames = filenames
+        self.delay = delay
+        self.walks = 0
+
+    def __str__(self):
+        return self.name
+
+    def walk(self):
+        self.walks += 1
+        time.sleep(self.delay)
+        yield self, [], list(self.filenames)
+
+
+class File:
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+
+    def dirname(self):
+        return self.directory
+
+    def basename(self):
+        return self.name
+
+
+class TestDestinationListing(unittest.TestCase):
+    def setUp(self):
+        transfer_raw_zip.logger = logging.getLogger("test_destination_listing")
+
+    def test_listed_once_outside_lock(self):
+        listing = DestinationListing()
+        slow = SlowDirectory("slow", ["a.zip"])
+        fast = SlowDirectory("fast", ["b.zip"], delay=0.0)
+        results = []
+
+        def check(path):
+            results.append(listing.exists(path))
+
+        threads = [threading.Thread(target=check, args=(File(slow, "a.zip"),)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        # Another directory can be listed while the slow one is in flight
+        start = time.monotonic()
+        assert listing.exists(File(fast, "b.zip"))
+        assert time.monotonic() - start < 0.1
+        for thread in threads:
+            thread.join()
+        assert results == [True] * 4
+        assert slow.walks == 1
+        listing.add(File(slow, "c.zip"))
+        assert listing.exists(File(slow, "c.zip"))
+
+    def test_failed_listing(self):
+        class Broken(SlowDirectory):
+            def walk(self):
+                self.walks += 1
+                raise PermissionError("denied")
+
+        listing = DestinationListing()
+        broken = Broken("broken", [])
+        for _ in range(2):
+            with self.assertRaises(PermissionError):
+                listing.exists(File(broken, "a.zip"))
+        # A failed listing is not cached
+        assert broken.walks == 2
+
+
+if __name__ == "__main__":
+    unittest.main()
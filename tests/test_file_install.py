@@ -0,0 +1,100 @@
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+TEST_DIR = Path(__file__).parent
+sys.path.insert(0, str(TEST_DIR.parent / "src"))
+
+import file_install  # noqa: E402
+from file_install import install_file  # noqa: E402
+
+
+class TestInstallFile(unittest.TestCase):
+    def setUp(self):
+        """
+        Creates a source file to install
+        """
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.src = self.temp_dir / "MC_O_20250415_000052.zip"
+        self.src.write_bytes(os.urandom(3 * 1024 * 1024 + 17))
+
+    def tearDown(self):
+        """
+        Removes all test files created by tests
+        """
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_hardlink(self):
+        dest = self.temp_dir / "dest.zip"
+        assert install_file(str(self.src), str(dest)) == "hardlink"
+        assert os.path.samefile(self.src, dest)
+        with self.assertRaises(FileExistsError):
+            install_file(str(self.src), str(dest))
+
+    def test_fallbacks(self):
+        def unsupported(*args):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        with mock.patch("os.link", unsupported):
+            dest = self.temp_dir / "copied.zip"
+            assert install_file(str(self.src), str(dest)) in (
+                "reflink",
+                "copy_file_range",
+            )
+            assert dest.read_bytes() == self.src.read_bytes()
+            with self.assertRaises(FileExistsError):
+                install_file(str(self.src), str(dest))
+
+            with mock.patch("fcntl.ioctl", unsupported), mock.patch(
+                "os.copy_file_range", unsupported
+            ):
+                dest = self.temp_dir / "plain.zip"
+                assert install_file(str(self.src), str(dest)) == "copy"
+                assert dest.read_bytes() == self.src.read_bytes()
+
+    def test_short_copy(self):
+        def unsupported(*args):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        real_copy_file_range = os.copy_file_range
+
+        def short(src_fd, dest_fd, count):
+            # Reports end of file after the first megabyte
+            if os.lseek(src_fd, 0, os.SEEK_CUR) >= 1024 * 1024:
+                return 0
+            return real_copy_file_range(src_fd, dest_fd, min(count, 1024 * 1024))
+
+        with mock.patch("os.link", unsupported), mock.patch("fcntl.ioctl", unsupported):
+            with mock.patch("os.copy_file_range", short):
+                dest = self.temp_dir / "short.zip"
+                assert install_file(str(self.src), str(dest)) == "copy"
+                assert dest.read_bytes() == self.src.read_bytes()
+
+            # The source shrinks while it is copied
+            with mock.patch("os.copy_file_range", short), mock.patch("os.stat") as stat:
+                stat.return_value.st_size = 4 * 1024 * 1024
+                dest = self.temp_dir / "truncated.zip"
+                with self.assertRaises(OSError):
+                    install_file(str(self.src), str(dest))
+            assert not dest.exists()
+
+    def test_failure_removes_partial_file(self):
+        def broken(*args):
+            raise OSError(errno.EIO, "Input/output error")
+
+        dest = self.temp_dir / "broken.zip"
+        with mock.patch("os.link", side_effect=OSError(errno.EXDEV, "")), mock.patch.object(
+            file_install, "_METHODS", [("broken", broken)]
+        ):
+            with self.assertRaises(OSError):
+                install_file(str(self.src), str(dest))
+        assert not dest.exists()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import logging
+import sys
+import threading
+import time
+import unittest
+from pathlib import Path
+
+TEST_DIR = Path(__file__).parent
+sys.path.insert(0, str(TEST_DIR.parent / "src"))
+
+from pipeline import Pipeline, Stage  # noqa: E402
+
+logger = logging.getLogger("test_pipeline")
+
+
+class TestPipeline(unittest.TestCase):
+    def test_all_stages(self):
+        done = []
+        lock = threading.Lock()
+
+        def finish(item):
+            with lock:
+                done.append(item)
+
+        stages = [
+            Stage("double", lambda item: item * 2, 3),
+            # Odd items need no further processing
+            Stage("drop", lambda item: item if item % 4 == 0 else None),
+            Stage("finish", finish, 2),
+        ]
+        Pipeline(stages, 2, logger).run(range(20))
+        assert sorted(done) == [item * 2 for item in range(0, 20, 2)]
+
+    def test_stages_overlap(self):
+        # The second stage holds the first item until the first stage has
+        # started another, which only happens if the stages run together
+        started = threading.Semaphore(0)
+
+        def first(item):
+            started.release()
+            return item
+
+        def second(item):
+            assert started.acquire(timeout=10)
+            return None
+
+        Pipeline([Stage("first", first), Stage("second", second)], 1, logger).run(
+            range(5)
+        )
+
+    def test_backpressure(self):
+        written = []
+
+        def write(item):
+            written.append(item)
+            return item
+
+        def slow(item):
+            time.sleep(0.1)
+            # The writer can only be ahead by the queue size and the items
+            # held by the workers
+            assert len(written) <= item + 3
+
+        Pipeline([Stage("write", write), Stage("slow", slow)], 1, logger).run(
+            range(10)
+        )
+        assert written == list(range(10))
+
+    def test_failure(self):
+        finished = []
+
+        def first(item):
+            if item == 3:
+                raise RuntimeError("boom")
+            return item
+
+        def second(item):
+            time.sleep(0.01)
+            finished.append(item)
+
+        with self.assertRaises(RuntimeError):
+            Pipeline([Stage("first", first), Stage("second", second)], 1, logger).run(
+                range(100)
+            )
+        # Items already past the first stage are finished; no new ones are
+        # started after the failure
+        assert finished[:3] == [0, 1, 2]
+        assert 3 not in finished
+        assert len(finished) < 99
+
+
+if __name__ == "__main__":
+    unittest.main()
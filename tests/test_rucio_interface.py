@@ -0,0 +1,114 @@
+import logging
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+TEST_DIR = Path(__file__).parent
+sys.path.insert(0, str(TEST_DIR.parent / "src"))
+
+import rucio.common.exception  # noqa: E402
+import transfer_raw_zip  # noqa: E402
+from fake_rucio import FakeRucio  # noqa: E402
+from transfer_raw_zip import RucioInterface  # noqa: E402
+
+ZIP = "LSSTCam/20250415/MC_O_20250415_000052.zip"
+DIMENSIONS = "LSSTCam/20250415/MC_O_20250415_000052_dimensions.yaml"
+OBS = "Dataset/LSSTCam/raw/Obs/20250415/MC_O_20250415_000052"
+NO_TRACT = "Dataset/LSSTCam/raw/NoTract/20250415"
+HASHES = (1234, "0123456789abcdef0123456789abcdef", "01234567")
+
+
+class TestRucioInterface(unittest.TestCase):
+    def setUp(self):
+        """
+        Sets up the module logger, which is normally made by initialize
+        """
+        transfer_raw_zip.logger = logging.getLogger("test_rucio_interface")
+        # Do not wait between retries
+        patcher = mock.patch.object(transfer_raw_zip.time, "sleep")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_interface(self, fake):
+        return RucioInterface("TEST_RSE", "raw", fake.replica_client, fake.did_client)
+
+    def test_register(self):
+        fake = FakeRucio()
+        interface = self.make_interface(fake)
+        interface.register(ZIP, HASHES, set(), dry_run=False)
+        interface.register(DIMENSIONS, HASHES, set(), finish=True, dry_run=False)
+        assert ("raw", ZIP) in fake.replicas
+        assert fake.datasets[("raw", OBS)]["files"] == {("raw", ZIP), ("raw", DIMENSIONS)}
+        assert fake.datasets[("raw", NO_TRACT)]["open"]
+        assert not fake.datasets[("raw", OBS)]["open"]
+        assert fake.datasets[("raw", OBS)]["meta"]["arcBackup"] == "SLAC_RAW_DISK_BKUP:need"
+        # The closed dataset is known, so it is not closed again
+        calls = fake.stats()["calls"]["close"]
+        interface.finish(DIMENSIONS, dry_run=False)
+        assert fake.stats()["calls"]["close"] == calls
+
+    def test_register_many_with_failures(self):
+        fake = FakeRucio(failure_rate=0.2, seed=3)
+        interface = self.make_interface(fake)
+        files = []
+        for seq_num in range(52, 62):
+            prefix = f"LSSTCam/20250415/MC_O_20250415_{seq_num:06d}"
+            files.append((f"{prefix}.zip", HASHES, {10463}, False))
+            files.append((f"{prefix}_dimensions.yaml", HASHES, {10463}, True))
+        failures = interface.register_many(files, dry_run=False)
+        stats = fake.stats()
+        assert sum(stats["failures"].values()) > 0
+        # Every file that was not reported as failed is fully registered
+        for name, _, _, _ in files:
+            if name in failures:
+                continue
+            assert ("raw", name) in fake.replicas
+            assert ("raw", name) in fake.datasets[
+                ("raw", "Dataset/LSSTCam/raw/Tract10463/20250415")
+            ]["files"]
+
+    def test_closed_dataset(self):
+        fake = FakeRucio()
+        fake.add_existing_dataset(OBS, closed=True, files=[DIMENSIONS])
+        interface = self.make_interface(fake)
+        interface.prewarm("LSSTCam", 20250415)
+        assert fake.stats()["calls"]["list_dids"] == 1
+        failures = interface.register_many(
+            [(ZIP, HASHES, set(), False), (DIMENSIONS, HASHES, set(), True)],
+            dry_run=False,
+        )
+        assert fake.stats()["calls"]["get_metadata_bulk"] == 1
+        # The closed dataset is known, so it is not closed again, and the
+        # file missing from it is a failure
+        assert set(failures) == {ZIP}
+        assert fake.datasets[("raw", OBS)]["files"] == {("raw", DIMENSIONS)}
+        assert fake.datasets[("raw", NO_TRACT)]["files"] == {("raw", ZIP), ("raw", DIMENSIONS)}
+        assert "close" not in fake.stats()["calls"]
+
+    def test_closed_dataset_unknown(self):
+        # Without prewarming, the closed dataset is found by attaching, with
+        # the same result
+        fake = FakeRucio()
+        fake.add_existing_dataset(OBS, closed=True, files=[DIMENSIONS])
+        interface = self.make_interface(fake)
+        failures = interface.register_many(
+            [(ZIP, HASHES, set(), False), (DIMENSIONS, HASHES, set(), True)],
+            dry_run=False,
+        )
+        assert set(failures) == {ZIP}
+        assert fake.datasets[("raw", NO_TRACT)]["files"] == {("raw", ZIP), ("raw", DIMENSIONS)}
+        # Single files behave the same way
+        with self.assertRaises(rucio.common.exception.UnsupportedOperation):
+            interface.register(ZIP, HASHES, set(), dry_run=False)
+        interface.register(DIMENSIONS, HASHES, set(), finish=True, dry_run=False)
+
+    def test_latency(self):
+        fake = FakeRucio.from_spec("latency=0.01,failure_rate=0,seed=1")
+        assert fake.latency == 0.01
+        with self.assertRaises(ValueError):
+            FakeRucio.from_spec("bogus=1")
+
+
+if __name__ == "__main__":
+    unittest.main()
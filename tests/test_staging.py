@@ -0,0 +1,88 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+TEST_DIR = Path(__file__).parent
+sys.path.insert(0, str(TEST_DIR.parent / "src"))
+
+from staging import StagingManager  # noqa: E402
+
+
+class TestStagingManager(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.main_dir = self.temp_dir / "main"
+        self.fast_dir = self.temp_dir / "fast"
+        self.main_dir.mkdir()
+        self.fast_dir.mkdir()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_reserve(self):
+        staging = StagingManager(directory=str(self.main_dir))
+        assert not staging.budgeted
+        with staging.reserve(100) as tmpdir:
+            assert Path(tmpdir).parent == self.main_dir
+            Path(tmpdir, "file").write_bytes(b"x")
+        assert not os.listdir(self.main_dir)
+
+    def test_budget(self):
+        staging = StagingManager(budget=100, directory=str(self.main_dir))
+        assert staging.budgeted
+        in_use = []
+        peak = []
+        lock = threading.Lock()
+
+        def work():
+            with staging.reserve(40):
+                with lock:
+                    in_use.append(40)
+                    peak.append(sum(in_use))
+                time.sleep(0.05)
+                with lock:
+                    in_use.remove(40)
+
+        threads = [threading.Thread(target=work) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Only two reservations of 40 fit in 100
+        assert max(peak) == 80
+        stats = staging.stats()
+        assert stats["peak"]["main"] == 80
+        assert stats["waits"] > 0
+
+    def test_oversized(self):
+        # A reservation larger than the budget is granted when alone
+        staging = StagingManager(budget=100, directory=str(self.main_dir))
+        with staging.reserve(1000):
+            pass
+        assert staging.stats()["peak"]["main"] == 1000
+
+    def test_fast_tier(self):
+        staging = StagingManager(
+            budget=1000,
+            directory=str(self.main_dir),
+            fast_directory=str(self.fast_dir),
+            fast_budget=100,
+        )
+        with staging.reserve(60) as first:
+            assert Path(first).parent == self.fast_dir
+            # Does not fit in the rest of the fast tier
+            with staging.reserve(60) as second:
+                assert Path(second).parent == self.main_dir
+            # Too big for the fast tier at all
+            with staging.reserve(500) as third:
+                assert Path(third).parent == self.main_dir
+        assert staging.stats()["peak"] == {"main": 500, "fast": 60}
+
+
+if __name__ == "__main__":
+    unittest.main()
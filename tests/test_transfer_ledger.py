@@ -0,0 +1,76 @@
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+TEST_DIR = Path(__file__).parent
+sys.path.insert(0, str(TEST_DIR.parent / "src"))
+
+from transfer_ledger import TransferLedger  # noqa: E402
+
+
+class TestLedger(unittest.TestCase):
+    def setUp(self):
+        """
+        Creates a directory for the ledger database
+        """
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.path = str(self.temp_dir / "ledger.sqlite3")
+
+    def tearDown(self):
+        """
+        Removes all test files created by tests
+        """
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_record_and_reopen(self):
+        ledger = TransferLedger(self.path)
+        assert ledger.completed("LSSTCam", "MC_O_20250415_000052") == set()
+        ledger.record("LSSTCam", "MC_O_20250415_000052", TransferLedger.ZIP_WRITTEN)
+        ledger.record(
+            "LSSTCam", "MC_O_20250415_000052", TransferLedger.ingested("/repo/main")
+        )
+        # Recording a step twice is harmless
+        ledger.record("LSSTCam", "MC_O_20250415_000052", TransferLedger.ZIP_WRITTEN)
+        ledger.record("LSSTComCam", "MC_O_20250415_000052", TransferLedger.OBS_CLOSED)
+        ledger.close()
+
+        ledger = TransferLedger(self.path)
+        assert ledger.completed("LSSTCam", "MC_O_20250415_000052") == {
+            TransferLedger.ZIP_WRITTEN,
+            "ingested:/repo/main",
+        }
+        assert ledger.completed("LSSTComCam", "MC_O_20250415_000052") == {
+            TransferLedger.OBS_CLOSED
+        }
+        ledger.close()
+
+    def test_completed_many(self):
+        ledger = TransferLedger(self.path)
+        obs_ids = [f"MC_O_20250415_{i:06d}" for i in range(1200)]
+        for obs_id in obs_ids[::2]:
+            ledger.record("LSSTCam", obs_id, TransferLedger.DIMENSIONS_WRITTEN)
+        completed = ledger.completed_many("LSSTCam", obs_ids)
+        assert set(completed) == set(obs_ids[::2])
+        assert all(
+            steps == {TransferLedger.DIMENSIONS_WRITTEN} for steps in completed.values()
+        )
+        ledger.close()
+
+    def test_watermark(self):
+        ledger = TransferLedger(self.path)
+        assert ledger.watermark("query") is None
+        ledger.set_watermark("query", "2025-04-16T00:10:00.000")
+        ledger.set_watermark("query", "2025-04-16T00:20:00.000")
+        ledger.set_watermark("other", "2025-04-15T00:00:00.000")
+        ledger.close()
+
+        ledger = TransferLedger(self.path)
+        assert ledger.watermark("query") == "2025-04-16T00:20:00.000"
+        assert ledger.watermark("other") == "2025-04-15T00:00:00.000"
+        ledger.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
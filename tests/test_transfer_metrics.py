@@ -0,0 +1,72 @@
+import json
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+TEST_DIR = Path(__file__).parent
+sys.path.insert(0, str(TEST_DIR.parent / "src"))
+
+from transfer_metrics import TransferMetrics  # noqa: E402
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        """
+        Creates a directory for the metrics files
+        """
+        self.temp_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        """
+        Removes all test files created by tests
+        """
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_stages(self):
+        metrics = TransferMetrics()
+        with metrics.stage("zip", "MC_O_20250415_000052") as timer:
+            timer.nbytes = 1000
+        metrics.record("zip", "MC_O_20250415_000053", 2.0, 3000)
+        with self.assertRaises(RuntimeError):
+            with metrics.stage("ingest", "MC_O_20250415_000052"):
+                raise RuntimeError("failures are timed too")
+
+        summary = metrics.summary()
+        assert summary["stages"]["zip"]["count"] == 2
+        assert summary["stages"]["zip"]["bytes"] == 4000
+        assert summary["stages"]["zip"]["seconds"] >= 2.0
+        assert summary["stages"]["ingest"]["count"] == 1
+        assert [r["obs_id"] for r in summary["exposures"]] == [
+            "MC_O_20250415_000052",
+            "MC_O_20250415_000053",
+            "MC_O_20250415_000052",
+        ]
+
+        # A new run has its own summary, but the counters keep counting
+        metrics.start_run()
+        metrics.record("zip", "MC_O_20250415_000054", 1.0, 500)
+        assert metrics.summary()["stages"]["zip"]["count"] == 1
+        prometheus = metrics.prometheus()
+        assert 'transfer_raw_zip_stage_runs_total{stage="zip"} 3' in prometheus
+        assert 'transfer_raw_zip_stage_bytes_total{stage="zip"} 4500' in prometheus
+        assert "# TYPE transfer_raw_zip_stage_seconds_total counter" in prometheus
+
+    def test_write(self):
+        metrics = TransferMetrics()
+        metrics.record("install", "MC_O_20250415_000052", 0.5, 1000)
+        metrics.write_json(str(self.temp_dir / "summary.json"))
+        metrics.write_prometheus(str(self.temp_dir / "transfer.prom"))
+        summary = json.loads((self.temp_dir / "summary.json").read_text())
+        assert summary["stages"]["install"]["bytes_per_second"] == 2000.0
+        assert 'stage="install"' in (self.temp_dir / "transfer.prom").read_text()
+        # Nothing else is left behind
+        assert sorted(p.name for p in self.temp_dir.iterdir()) == [
+            "summary.json",
+            "transfer.prom",
+        ]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,10 @@
+import json
+import os
 import shutil
+import signal
 import subprocess
 import tempfile
+import time
 import unittest
 import zipfile
 from pathlib import Path
@@ -19,25 +23,26 @@ class TestZip(unittest.TestCase):
         """
         self.source_butler = Butler(TEST_DIR / "data" / "from_butler")
         self.temp_dir = Path(tempfile.mkdtemp())
-        Butler.makeRepo(self.temp_dir)
-        self.dest_butler = Butler(self.temp_dir, writeable=True)
-        register_instrument(self.temp_dir, ["lsst.obs.lsst.LsstCam"])
-        self.dest_butler.registry.registerDatasetType(
-            DatasetType(
-                "raw",
-                ["exposure", "instrument", "detector"],
-                "Exposure",
-                universe=self.dest_butler.dimensions,
-            )
-        )
-        self.dest_butler.registry.registerDatasetType(
-            DatasetType(
-                "guider_raw",
-                ["exposure", "instrument", "detector"],
-                "Exposure",
-                universe=self.dest_butler.dimensions,
+        self.dest_butler = self.make_dest_butler(self.temp_dir)
+
+    @staticmethod
+    def make_dest_butler(root):
+        """
+        Creates a destination repo with the raw dataset types registered
+        """
+        Butler.makeRepo(root)
+        dest_butler = Butler(root, writeable=True)
+        register_instrument(root, ["lsst.obs.lsst.LsstCam"])
+        for name in ("raw", "guider_raw"):
+            dest_butler.registry.registerDatasetType(
+                DatasetType(
+                    name,
+                    ["exposure", "instrument", "detector"],
+                    "Exposure",
+                    universe=dest_butler.dimensions,
+                )
             )
-        )
+        return dest_butler
 
     def tearDown(self):
         """
@@ -128,6 +133,525 @@ class TestZip(unittest.TestCase):
         assert b"Handling exposure: MC_O_20250415_000054" in result.stderr
         assert b"Handling exposure: MC_O_20250415_000055" in result.stderr
 
+    def test_zip_jobs(self):
+        result = subprocess.run(
+            [
+                "python",
+                TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+                "--window",
+                "30min",
+                "--now",
+                "2025-04-16T00:40",
+                "--jobs",
+                "2",
+                "--index_jobs",
+                "2",
+                "--metrics_json",
+                self.temp_dir / "metrics.json",
+                "--dest_uri_prefix",
+                self.temp_dir / "raw",
+                "--config_file",
+                TEST_DIR.parent / "src" / "config_raw.yaml",
+                TEST_DIR / "data" / "from_butler",
+                self.temp_dir,
+            ],
+            capture_output=True,
+        )
+        assert b"Handling exposure: MC_O_20250415_000052" in result.stderr
+        assert b"Handling exposure: MC_O_20250415_000053" in result.stderr
+        assert b"Worker exposure_" in result.stderr
+        assert b"Unable to read headers" not in result.stderr
+        for obs_id in ("MC_O_20250415_000052", "MC_O_20250415_000053"):
+            zip_file = (
+                self.temp_dir / "raw" / "LSSTCam" / "20250415" / f"{obs_id}.zip"
+            )
+            assert zip_file.exists()
+            fits_name = f"raw_LSSTCam_i_39_{obs_id}_R22_S11_LSSTCam_raw_all.fits"
+            assert (zipfile.Path(zip_file) / fits_name).exists()
+            index = json.loads(
+                (zipfile.Path(zip_file) / "_metadata_index.json").read_text()
+            )
+            assert fits_name in index
+        metrics = json.loads((self.temp_dir / "metrics.json").read_text())
+        for stage in ("index", "zip", "install", "ingest", "exposure"):
+            assert metrics["stages"][stage]["count"] == 2
+
+    def test_zip_two_repos(self):
+        second_dir = self.temp_dir / "second"
+        second_butler = self.make_dest_butler(second_dir)
+        result = subprocess.run(
+            [
+                "python",
+                TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+                "--window",
+                "8min",
+                "--now",
+                "2025-04-16T00:40",
+                "--dest_uri_prefix",
+                self.temp_dir / "raw",
+                "--config_file",
+                TEST_DIR.parent / "src" / "config_raw.yaml",
+                TEST_DIR / "data" / "from_butler",
+                self.temp_dir,
+                second_dir,
+            ],
+            capture_output=True,
+        )
+        assert f"into {self.temp_dir} in".encode() in result.stderr
+        assert f"into {second_dir} in".encode() in result.stderr
+        assert b"Failed to ingest" not in result.stderr
+        for butler in (self.dest_butler, second_butler):
+            butler.registry.refresh()
+            assert butler.query_datasets("raw", collections="LSSTCam/raw/all")
+
+    def test_zip_ingest_failure(self):
+        # The second repo has no instrument, so ingesting into it fails
+        broken_dir = self.temp_dir / "broken"
+        Butler.makeRepo(broken_dir)
+        args = [
+            "python",
+            TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+            "--window",
+            "8min",
+            "--now",
+            "2025-04-16T00:40",
+            "--dest_uri_prefix",
+            self.temp_dir / "raw",
+            "--config_file",
+            TEST_DIR.parent / "src" / "config_raw.yaml",
+            TEST_DIR / "data" / "from_butler",
+            self.temp_dir,
+            broken_dir,
+        ]
+        result = subprocess.run(args, capture_output=True)
+        assert result.returncode != 0
+        assert f"into {self.temp_dir} in".encode() in result.stderr
+        assert f"Failed to ingest {self.temp_dir / 'raw'}".encode() in result.stderr
+        assert f"into {broken_dir}".encode() in result.stderr
+
+        # With a ledger, the good repo is recorded and the run continues
+        shutil.rmtree(self.temp_dir / "raw")
+        args[2:2] = ["--ledger", self.temp_dir / "ledger.sqlite3"]
+        result = subprocess.run(args, capture_output=True)
+        assert result.returncode == 0
+        assert b"Not registering MC_O_20250415_000053 after failed ingests" in (
+            result.stderr
+        )
+
+    def test_zip_pipeline(self):
+        result = subprocess.run(
+            [
+                "python",
+                TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+                "--window",
+                "30min",
+                "--now",
+                "2025-04-16T00:40",
+                "--pipeline",
+                "--jobs",
+                "2",
+                "--queue_size",
+                "1",
+                # Less than one exposure, so the writers take turns
+                "--staging_budget",
+                "0.000001",
+                "--metrics_json",
+                self.temp_dir / "metrics.json",
+                "--dest_uri_prefix",
+                self.temp_dir / "raw",
+                "--config_file",
+                TEST_DIR.parent / "src" / "config_raw.yaml",
+                TEST_DIR / "data" / "from_butler",
+                self.temp_dir,
+            ],
+            capture_output=True,
+        )
+        assert b"Worker write_" in result.stderr
+        # Exposures are counted once, by the last stage
+        assert b"Worker ingest_0: 0 exposures" in result.stderr
+        assert b"Worker register_0: 2 exposures" in result.stderr
+        metrics = json.loads((self.temp_dir / "metrics.json").read_text())
+        assert metrics["stages"]["exposure"]["count"] == 2
+        assert b"Staging: {'peak': {'main': " in result.stderr
+        assert b"failed" not in result.stderr
+        self.dest_butler.registry.refresh()
+        for obs_id in ("MC_O_20250415_000052", "MC_O_20250415_000053"):
+            assert (
+                self.temp_dir / "raw" / "LSSTCam" / "20250415" / f"{obs_id}.zip"
+            ).exists()
+            assert self.dest_butler.query_datasets(
+                "raw", collections="LSSTCam/raw/all", where=f"exposure.obs_id = '{obs_id}'"
+            )
+
+    def test_zip_write_in_place(self):
+        # Temporary zips left by a crash long ago, and by a run in progress
+        dest_dir = self.temp_dir / "raw" / "LSSTCam" / "20250415"
+        dest_dir.mkdir(parents=True)
+        stale = dest_dir / ".MC_O_20250415_000051.zip.0123456789abcdef.tmp"
+        stale.write_bytes(b"partial")
+        os.utime(stale, (time.time() - 2 * 86400,) * 2)
+        fresh = dest_dir / ".MC_O_20250415_000056.zip.fedcba9876543210.tmp"
+        fresh.write_bytes(b"partial")
+        result = subprocess.run(
+            [
+                "python",
+                TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+                "--window",
+                "30min",
+                "--now",
+                "2025-04-16T00:40",
+                "--write_in_place",
+                "--dest_uri_prefix",
+                self.temp_dir / "raw",
+                "--config_file",
+                TEST_DIR.parent / "src" / "config_raw.yaml",
+                TEST_DIR / "data" / "from_butler",
+                self.temp_dir,
+            ],
+            capture_output=True,
+        )
+        assert b"Writing zip in place" in result.stderr
+        for obs_id in ("MC_O_20250415_000052", "MC_O_20250415_000053"):
+            with zipfile.ZipFile(dest_dir / f"{obs_id}.zip") as zip_file:
+                assert zip_file.testzip() is None
+        # No temporary files are left behind, and only the stale one is swept
+        assert b"Removing stale temporary file" in result.stderr
+        assert list(dest_dir.glob(".*.tmp")) == [fresh]
+
+    def test_zip_member_index(self):
+        result = subprocess.run(
+            [
+                "python",
+                TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+                "--window",
+                "8min",
+                "--now",
+                "2025-04-16T00:40",
+                "--member_index",
+                "--dest_uri_prefix",
+                self.temp_dir / "raw",
+                "--config_file",
+                TEST_DIR.parent / "src" / "config_raw.yaml",
+                TEST_DIR / "data" / "from_butler",
+                self.temp_dir,
+            ],
+            capture_output=True,
+        )
+        assert b"Saving member index" in result.stderr
+        dest_dir = self.temp_dir / "raw" / "LSSTCam" / "20250415"
+        index = json.loads((dest_dir / "MC_O_20250415_000053_members.json").read_text())
+        assert index["zip"] == "MC_O_20250415_000053.zip"
+        fits_name = "raw_LSSTCam_i_39_MC_O_20250415_000053_R22_S11_LSSTCam_raw_all.fits"
+        entry = index["members"][fits_name]
+        assert entry["offset"] % 4096 == 0
+        # One ranged read gets the detector
+        with open(dest_dir / "MC_O_20250415_000053.zip", "rb") as f:
+            f.seek(entry["offset"])
+            data = f.read(entry["size"])
+        with zipfile.ZipFile(dest_dir / "MC_O_20250415_000053.zip") as zip_file:
+            assert data == zip_file.read(fits_name)
+
+    def test_zip_member_index_repair(self):
+        args = [
+            "python",
+            TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+            "--window",
+            "8min",
+            "--now",
+            "2025-04-16T00:40",
+            "--dest_uri_prefix",
+            self.temp_dir / "raw",
+            "--config_file",
+            TEST_DIR.parent / "src" / "config_raw.yaml",
+            TEST_DIR / "data" / "from_butler",
+            self.temp_dir,
+        ]
+        subprocess.run(args, capture_output=True)
+        # Replace the installed zip with an unaligned one, as written before
+        # members were aligned
+        dest_dir = self.temp_dir / "raw" / "LSSTCam" / "20250415"
+        zip_path = dest_dir / "MC_O_20250415_000053.zip"
+        with zipfile.ZipFile(zip_path) as zip_file:
+            contents = {name: zip_file.read(name) for name in zip_file.namelist()}
+        zip_path.unlink()
+        with zipfile.ZipFile(zip_path, "w") as zip_file:
+            for name, data in contents.items():
+                zip_file.writestr(name, data)
+
+        # Without a ledger, the repair rebuilds the zip but keeps the
+        # installed one, so the index must describe the installed one
+        args[2:2] = ["--repair", "--member_index"]
+        result = subprocess.run(args, capture_output=True)
+        assert b"Saving member index" in result.stderr
+        index = json.loads((dest_dir / "MC_O_20250415_000053_members.json").read_text())
+        assert set(index["members"]) == set(contents)
+        with open(zip_path, "rb") as f:
+            for name, entry in index["members"].items():
+                f.seek(entry["offset"])
+                assert f.read(entry["size"]) == contents[name]
+
+    def test_dimensions_export(self):
+        subprocess.run(
+            [
+                "python",
+                TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+                "--window",
+                "10min",
+                "--now",
+                "2025-05-16T00:42",
+                "--dest_uri_prefix",
+                self.temp_dir / "raw",
+                "--config_file",
+                TEST_DIR.parent / "src" / "config_raw.yaml",
+                TEST_DIR / "data" / "from_butler",
+                self.temp_dir,
+            ],
+            capture_output=True,
+        )
+        for obs_id in ("MC_O_20250415_000054", "MC_O_20250415_000055"):
+            dimensions_file = (
+                self.temp_dir
+                / "raw"
+                / "LSSTCam"
+                / "20250415"
+                / f"{obs_id}_dimensions.yaml"
+            )
+            assert dimensions_file.exists()
+            # Export the same records one exposure at a time
+            (exp,) = self.source_butler.query_dimension_records(
+                "exposure", instrument="LSSTCam", where=f"exposure.obs_id = '{obs_id}'"
+            )
+            expected_file = self.temp_dir / f"{obs_id}_expected.yaml"
+            with self.source_butler.export(filename=str(expected_file)) as export:
+                export.saveDimensionData("exposure", [exp])
+                for dim in (
+                    "day_obs",
+                    "group",
+                    "visit",
+                    "visit_definition",
+                    "visit_detector_region",
+                    "visit_system",
+                    "visit_system_membership",
+                ):
+                    recs = self.source_butler.query_dimension_records(
+                        dim,
+                        exposure=exp.id,
+                        limit=None,
+                        instrument="LSSTCam",
+                        explain=False,
+                    )
+                    if recs:
+                        export.saveDimensionData(dim, recs)
+            assert dimensions_file.read_bytes() == expected_file.read_bytes()
+
+    def test_zip_ledger(self):
+        args = [
+            "python",
+            TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+            "--window",
+            "30min",
+            "--now",
+            "2025-04-16T00:40",
+            "--ledger",
+            self.temp_dir / "ledger.sqlite3",
+            "--dest_uri_prefix",
+            self.temp_dir / "raw",
+            "--config_file",
+            TEST_DIR.parent / "src" / "config_raw.yaml",
+            TEST_DIR / "data" / "from_butler",
+            self.temp_dir,
+        ]
+        result = subprocess.run(args, capture_output=True)
+        assert b"Handling exposure: MC_O_20250415_000052" in result.stderr
+        assert b"Handling exposure: MC_O_20250415_000053" in result.stderr
+        # The second run skips the finished exposures without looking at them
+        result = subprocess.run(args, capture_output=True)
+        assert b"Skipping 2 exposures completed according to the ledger" in (
+            result.stderr
+        )
+        assert b"Handling exposure" not in result.stderr
+        assert b"Zip exists" not in result.stderr
+
+    def test_zip_watermark(self):
+        args = [
+            "python",
+            TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+            "--window",
+            "30min",
+            "--now",
+            "2025-04-16T00:40",
+            "--ledger",
+            self.temp_dir / "ledger.sqlite3",
+            "--watermark_overlap",
+            "1min",
+            "--dest_uri_prefix",
+            self.temp_dir / "raw",
+            "--config_file",
+            TEST_DIR.parent / "src" / "config_raw.yaml",
+            TEST_DIR / "data" / "from_butler",
+            self.temp_dir,
+        ]
+        result = subprocess.run(args, capture_output=True)
+        assert b"Handling exposure: MC_O_20250415_000053" in result.stderr
+        assert b"Advancing watermark to" in result.stderr
+        # The second run starts from the mark instead of the window
+        result = subprocess.run(args, capture_output=True)
+        assert b"Starting from watermark" in result.stderr
+        assert b"Handling exposure" not in result.stderr
+        assert b"Advancing watermark to" not in result.stderr
+
+    def test_zip_deferred(self):
+        # Expect one more sensor than the source repo has for the exposure
+        source = self.temp_dir / "source"
+        shutil.copytree(TEST_DIR / "data" / "from_butler", source)
+        exposure_dir = (
+            source / "LSSTCam" / "raw" / "all" / "raw" / "20250415" / "MC_O_20250415_000053"
+        )
+        with open(exposure_dir / "MC_O_20250415_000053_expectedSensors.json", "w") as f:
+            json.dump({"expectedSensors": {"R22_S11": "SCIENCE", "R22_S12": "SCIENCE"}}, f)
+        result = subprocess.run(
+            [
+                "python",
+                TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+                "--window",
+                "8min",
+                "--now",
+                "2025-04-16T00:40",
+                "--defer_retries",
+                "2",
+                "--defer_backoff",
+                "1s",
+                "--dest_uri_prefix",
+                self.temp_dir / "raw",
+                "--config_file",
+                TEST_DIR.parent / "src" / "config_raw.yaml",
+                source,
+                self.temp_dir,
+            ],
+            capture_output=True,
+        )
+        assert b"Skipping incomplete exposure MC_O_20250415_000053" in result.stderr
+        assert result.stderr.count(b"Rechecking 1 incomplete LSSTCam exposures") == 2
+        assert b"Leaving 1 incomplete exposures for a later run" in result.stderr
+        assert not (
+            self.temp_dir / "raw" / "LSSTCam" / "20250415" / "MC_O_20250415_000053.zip"
+        ).exists()
+
+    def test_zip_prioritize(self):
+        # The later exposure's query is weighted enough to go first
+        config_file = self.temp_dir / "config.yaml"
+        with open(config_file, "w") as f:
+            for seq_num, weight in ((52, 1), (53, 100)):
+                f.write(
+                    "- instrument: LSSTCam\n"
+                    f"  where: exposure.seq_num = {seq_num}\n"
+                    "  embargo_hours: 0\n"
+                    f"  priority_weight: {weight}\n"
+                    "  collections: LSSTCam/raw/all\n"
+                    "  dataset_types: raw\n"
+                )
+        result = subprocess.run(
+            [
+                "python",
+                TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+                "--window",
+                "30min",
+                "--now",
+                "2025-04-16T00:40",
+                "--prioritize",
+                "--dest_uri_prefix",
+                self.temp_dir / "raw",
+                "--config_file",
+                config_file,
+                TEST_DIR / "data" / "from_butler",
+                self.temp_dir,
+            ],
+            capture_output=True,
+        )
+        assert b"Prioritized 2 exposures from 2 queries" in result.stderr
+        first = result.stderr.index(b"Handling exposure: MC_O_20250415_000053")
+        second = result.stderr.index(b"Handling exposure: MC_O_20250415_000052")
+        assert first < second
+
+    def test_zip_watermark_stuck(self):
+        # An exposure that never completes
+        source = self.temp_dir / "source"
+        shutil.copytree(TEST_DIR / "data" / "from_butler", source)
+        exposure_dir = (
+            source / "LSSTCam" / "raw" / "all" / "raw" / "20250415" / "MC_O_20250415_000053"
+        )
+        with open(exposure_dir / "MC_O_20250415_000053_expectedSensors.json", "w") as f:
+            json.dump({"expectedSensors": {"R22_S11": "SCIENCE", "R22_S12": "SCIENCE"}}, f)
+
+        def run(ledger, *options):
+            return subprocess.run(
+                [
+                    "python",
+                    TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+                    "--window",
+                    "3h",
+                    "--now",
+                    "2025-04-16T02:40",
+                    "--ledger",
+                    self.temp_dir / ledger,
+                    "--watermark_overlap",
+                    "1min",
+                    *options,
+                    "--dest_uri_prefix",
+                    self.temp_dir / "raw",
+                    "--config_file",
+                    TEST_DIR.parent / "src" / "config_raw.yaml",
+                    source,
+                    self.temp_dir,
+                ],
+                capture_output=True,
+            )
+
+        # Recent enough to wait for
+        result = run("held.sqlite3")
+        assert b"Skipping incomplete exposure MC_O_20250415_000053" in result.stderr
+        assert b"Watermark held at unfinished exposure MC_O_20250415_000053" in result.stderr
+        # Too old to hold the mark back
+        result = run("advanced.sqlite3", "--watermark_max_lag", "1h")
+        assert (
+            b"Advancing watermark past unfinished exposure MC_O_20250415_000053"
+            in result.stderr
+        )
+        assert b"Watermark held" not in result.stderr
+        assert b"Advancing watermark to" in result.stderr
+
+    def test_zip_daemon(self):
+        proc = subprocess.Popen(
+            [
+                "python",
+                TEST_DIR.parent / "src" / "transfer_raw_zip.py",
+                "--window",
+                "30min",
+                "--daemon",
+                "--poll_interval",
+                "1s",
+                "--dest_uri_prefix",
+                self.temp_dir / "raw",
+                "--config_file",
+                TEST_DIR.parent / "src" / "config_raw.yaml",
+                TEST_DIR / "data" / "from_butler",
+                self.temp_dir,
+            ],
+            stderr=subprocess.PIPE,
+        )
+        # Wait for the second poll, then stop the daemon
+        polls = 0
+        for line in proc.stderr:
+            if b"Polling at" in line:
+                polls += 1
+                if polls == 2:
+                    break
+        proc.send_signal(signal.SIGTERM)
+        _, stderr = proc.communicate(timeout=60)
+        assert polls == 2
+        assert proc.returncode == 0
+        assert b"Daemon stopped" in stderr
+
 
 if __name__ == "__main__":
     unittest.main()
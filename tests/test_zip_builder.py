@@ -0,0 +1,136 @@
+import hashlib
+import io
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+import zipfile
+import zlib
+from pathlib import Path
+
+TEST_DIR = Path(__file__).parent
+sys.path.insert(0, str(TEST_DIR.parent / "src"))
+
+from zip_builder import HashingWriter, ZipBuilder, read_member_index  # noqa: E402
+
+
+class TestZipBuilder(unittest.TestCase):
+    def setUp(self):
+        """
+        Creates source files to stream into zips
+        """
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.fits = self.temp_dir / "raw_R22_S11.fits"
+        self.fits.write_bytes(bytes(range(256)) * 100)
+        self.json = self.temp_dir / "raw_R22_S11.json"
+        self.json.write_text('{"key": "value"}' * 50)
+
+    def tearDown(self):
+        """
+        Removes all test files created by tests
+        """
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_streamed_members(self):
+        buffer = io.BytesIO()
+        with ZipBuilder(buffer) as builder:
+            builder.add(self.fits.name, self.fits)
+            builder.add(self.json.name, self.json)
+            builder.add_bytes("_metadata_index.json", b"{}")
+            assert builder.namelist() == [
+                self.fits.name,
+                self.json.name,
+                "_metadata_index.json",
+            ]
+        with zipfile.ZipFile(buffer) as zip_file:
+            assert zip_file.testzip() is None
+            assert zip_file.read(self.fits.name) == self.fits.read_bytes()
+            assert zip_file.read(self.json.name) == self.json.read_bytes()
+            assert zip_file.read("_metadata_index.json") == b"{}"
+            infos = {info.filename: info for info in zip_file.infolist()}
+        assert infos[self.fits.name].compress_type == zipfile.ZIP_STORED
+        assert infos[self.json.name].compress_type == zipfile.ZIP_DEFLATED
+        assert infos["_metadata_index.json"].compress_type == zipfile.ZIP_DEFLATED
+
+    def test_single_pass_hashes(self):
+        buffer = io.BytesIO()
+        writer = HashingWriter(buffer)
+        with ZipBuilder(writer) as builder:
+            builder.add(self.fits.name, self.fits)
+            builder.add(self.json.name, self.json)
+        data = buffer.getvalue()
+        assert writer.hashes == (
+            len(data),
+            hashlib.md5(data).hexdigest(),
+            f"{zlib.adler32(data):08x}",
+        )
+        with zipfile.ZipFile(buffer) as zip_file:
+            assert zip_file.testzip() is None
+            assert zip_file.read(self.fits.name) == self.fits.read_bytes()
+        assert HashingWriter.hash_bytes(data) == writer.hashes
+
+    def test_aligned_members(self):
+        # Both seekable and streamed output
+        for seekable in (True, False):
+            buffer = io.BytesIO()
+            with ZipBuilder(buffer if seekable else HashingWriter(buffer)) as builder:
+                builder.add(self.fits.name, self.fits)
+                builder.add(self.json.name, self.json)
+                builder.add("other_detector.fits", self.fits)
+                builder.add_bytes("small.fits", b"SIMPLE")
+            data = buffer.getvalue()
+            with zipfile.ZipFile(buffer) as zip_file:
+                assert zip_file.testzip() is None
+                assert zip_file.read("small.fits") == b"SIMPLE"
+                for info in zip_file.infolist():
+                    # The padding is not in the central directory
+                    assert info.extra == b""
+                    lengths_start = info.header_offset + 26
+                    lengths_end = lengths_start + 4
+                    name_length, extra_length = struct.unpack("<HH", data[lengths_start:lengths_end])
+                    start = info.header_offset + 30 + name_length + extra_length
+                    if info.compress_type == zipfile.ZIP_STORED:
+                        assert start % 4096 == 0
+                        end = start + info.file_size
+                        assert data[start:end] == zip_file.read(info.filename)
+                    else:
+                        assert extra_length == 0
+
+        # Alignment can be turned off
+        buffer = io.BytesIO()
+        with ZipBuilder(buffer, alignment=1) as builder:
+            builder.add(self.fits.name, self.fits)
+        with zipfile.ZipFile(buffer) as zip_file:
+            assert zip_file.infolist()[0].header_offset == 0
+        assert len(buffer.getvalue()) < 4096 + self.fits.stat().st_size
+
+    def test_member_index(self):
+        buffer = io.BytesIO()
+        with ZipBuilder(HashingWriter(buffer)) as builder:
+            builder.add(self.fits.name, self.fits)
+            builder.add(self.json.name, self.json)
+            builder.add_bytes("_metadata_index.json", b"{}")
+        members = builder.member_index()
+        assert list(members) == [self.fits.name, self.json.name, "_metadata_index.json"]
+        # The same index can be read from the finished zip
+        assert read_member_index(buffer) == members
+
+        # One ranged read gets a member
+        data = buffer.getvalue()
+        entry = members[self.fits.name]
+        assert entry["compress_type"] == zipfile.ZIP_STORED
+        assert entry["size"] == entry["file_size"] == self.fits.stat().st_size
+        start, end = entry["offset"], entry["offset"] + entry["size"]
+        fits_data = data[start:end]
+        assert fits_data == self.fits.read_bytes()
+        assert entry["crc"] == f"{zlib.crc32(fits_data):08x}"
+        entry = members[self.json.name]
+        assert entry["compress_type"] == zipfile.ZIP_DEFLATED
+        start, end = entry["offset"], entry["offset"] + entry["size"]
+        compressed = data[start:end]
+        assert zlib.decompress(compressed, -15) == self.json.read_bytes()
+
+
+if __name__ == "__main__":
+    unittest.main()